@@ -0,0 +1,81 @@
+"""
+AOF load time
+
+Writes an AOF of N records to a temporary directory, then loads it the
+way the server does on startup (manifest, base, incremental files) and
+reports records and megabytes per second. The mixed workload is 60% SET,
+20% INCR, 10% RPUSH and 10% HSET over --keys keys.
+
+    python benchmarks/bench_aof_load.py --records 10000000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+WRITE_CHUNK = 100000
+
+
+def bulk(text):
+    data = text.encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+def record(index, keys, mix):
+    slot = index % 10 if mix == 'mixed' else 0
+    if slot < 6:
+        return b"*3\r\n$3\r\nSET\r\n" + bulk(f"key:{index % keys}") + bulk(f"value-{index}")
+    if slot < 8:
+        return b"*2\r\n$4\r\nINCR\r\n" + bulk(f"counter:{index % 1000}")
+    if slot < 9:
+        return b"*3\r\n$5\r\nRPUSH\r\n" + bulk(f"list:{index % 1000}") + bulk(f"item-{index}")
+    return b"*4\r\n$4\r\nHSET\r\n" + bulk(f"hash:{index % 5000}") + bulk(f"f{index % 50}") + bulk(f"v{index}")
+
+
+def write_aof(directory, records, keys, mix):
+    """A manifest with a single incremental file holding every record"""
+    name = "appendonly.aof.1.incr.aof"
+    with open(os.path.join(directory, "appendonly.aof.manifest"), 'w') as manifest:
+        manifest.write(f"file {name} seq 1 type i\n")
+    with open(os.path.join(directory, name), 'wb') as aof:
+        for start in range(0, records, WRITE_CHUNK):
+            aof.write(b"".join(record(index, keys, mix) for index in range(start, min(records, start + WRITE_CHUNK))))
+    return os.path.getsize(os.path.join(directory, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--source', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help='checkout containing the redis_server package')
+    parser.add_argument('--records', type=int, default=10000000)
+    parser.add_argument('--keys', type=int, default=1000000, help='distinct SET keys')
+    parser.add_argument('--mix', choices=('mixed', 'set'), default='mixed')
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.source)
+    from redis_server.storage import DataStore
+    from redis_server.persistence import RecoveryManager
+
+    directory = tempfile.mkdtemp(prefix='bench-aof-')
+    try:
+        start = time.perf_counter()
+        size = write_aof(directory, args.records, args.keys, args.mix)
+        print(f"source={args.source}")
+        print(f"wrote {args.records} records ({size / 1024 / 1024:.1f} MB) in {time.perf_counter() - start:.1f} s")
+
+        store = DataStore()
+        recovery = RecoveryManager(directory, "appendonly.aof")
+        start = time.perf_counter()
+        if not recovery.recover_data(store):
+            raise RuntimeError("AOF load failed")
+        elapsed = time.perf_counter() - start
+        print(f"load: {elapsed:.1f} s, {args.records / elapsed:,.0f} records/sec, "
+              f"{size / 1024 / 1024 / elapsed:.1f} MB/sec, {store.dbsize()} keys")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
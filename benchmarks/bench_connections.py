@@ -0,0 +1,127 @@
+"""
+Event loop throughput with many idle connections
+
+Starts a server in a subprocess, opens idle connections and then drives a
+fixed number of active clients doing SET request/response round trips.
+Run it against two checkouts (--source) to compare event loop versions.
+
+    python benchmarks/bench_connections.py --connections 10 1000 10000
+"""
+import argparse
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVER_SCRIPT = """
+import sys
+import redis_server
+from redis_server.persistence import PersistenceConfig
+config = PersistenceConfig({'aof_enabled': False, 'data_dir': sys.argv[2], 'temp_dir': sys.argv[2] + '/temp'})
+server_class = getattr(redis_server, sys.argv[3])
+server_class(port=int(sys.argv[1]), persistence_config=config).start()
+"""
+
+SERVER_CLASSES = {'select': 'RedisServer', 'asyncio': 'AsyncRedisServer'}
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def start_server(source, port, data_dir, io):
+    env = dict(os.environ, PYTHONPATH=source)
+    process = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT, str(port), data_dir, SERVER_CLASSES[io]],
+                               env=env, cwd=data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+def run_active_clients(port, active, duration):
+    """Drive active connections with one outstanding SET each, return ops/sec"""
+    selector = selectors.DefaultSelector()
+    request = b"*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nvalue\r\n"
+    for _ in range(active):
+        sock = socket.create_connection(('localhost', port))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        sock.send(request)
+    ops = 0
+    start = time.time()
+    end = start + duration
+    while time.time() < end:
+        events = selector.select(timeout=1.0)
+        if not events:
+            #No reply at all within a second, the server is stuck
+            break
+        for key, _ in events:
+            data = key.fileobj.recv(65536)
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            ops += data.count(b"\r\n")
+            key.fileobj.send(request)
+    elapsed = time.time() - start
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    return ops / elapsed if elapsed else 0.0
+
+
+def bench(source, port, connections, active, duration, io):
+    with tempfile.TemporaryDirectory() as data_dir:
+        server = start_server(source, port, data_dir, io)
+        idle = []
+        try:
+            for _ in range(max(0, connections - active)):
+                sock = socket.create_connection(('localhost', port), timeout=30)
+                idle.append(sock)
+            #A PING round trip proves the server accepted and registered each one
+            for sock in idle:
+                sock.sendall(b"PING\r\n")
+            for sock in idle:
+                sock.recv(16)
+            return run_active_clients(port, min(active, connections), duration)
+        except OSError as e:
+            print(f"  connection error: {e}")
+            return 0.0
+        finally:
+            for sock in idle:
+                sock.close()
+            server.kill()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--source', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help='checkout containing the redis_server package')
+    parser.add_argument('--port', type=int, default=6399)
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--active', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--io', choices=sorted(SERVER_CLASSES), default='select')
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    print(f"source={args.source} io={args.io} fd_limit={limit}")
+    for connections in args.connections:
+        ops = bench(args.source, args.port, connections, args.active, args.duration, args.io)
+        print(f"connections={connections:>6} active={min(args.active, connections):>3} ops/sec={ops:,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+DataStore memory per key and SET latency for large values
+
+Loads N keys into a DataStore and reports the bytes per key actually
+allocated (tracemalloc) next to what the store accounts for itself, then
+times overwrites of a large value. Use --source to compare checkouts.
+
+    python benchmarks/bench_memory.py --keys 1000000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--source', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help='checkout containing the redis_server package')
+    parser.add_argument('--keys', type=int, default=1000000)
+    parser.add_argument('--value-size', type=int, default=16)
+    parser.add_argument('--ttl-ratio', type=float, default=0.0, help='share of keys given an expiry')
+    parser.add_argument('--large-value', type=int, default=1024 * 1024)
+    parser.add_argument('--overwrites', type=int, default=200)
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.source)
+    from redis_server.storage import DataStore
+
+    #Build keys and values first so only the store's own structures are measured
+    keys = [f"key:{i:010d}" for i in range(args.keys)]
+    value = "v" * args.value_size
+    ttl_every = int(1 / args.ttl_ratio) if args.ttl_ratio else 0
+    expiry = time.time() + 3600
+
+    store = DataStore()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for index, key in enumerate(keys):
+        if ttl_every and index % ttl_every == 0:
+            store.set(key, value, expiry)
+        else:
+            store.set(key, value)
+    load_seconds = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    #Keys and values are shared with the lists above, add them back in
+    key_bytes = sum(sys.getsizeof(key) for key in keys)
+    value_bytes = sys.getsizeof(value) * len(keys)
+    per_key = (allocated + key_bytes + value_bytes) / args.keys
+    print(f"source={args.source}")
+    print(f"keys={args.keys} value_size={args.value_size} ttl_ratio={args.ttl_ratio}")
+    print(f"load: {args.keys / load_seconds:,.0f} sets/sec")
+    print(f"allocated by store: {allocated / args.keys:.1f} bytes/key (excluding key and value objects)")
+    print(f"total incl. key and value objects: {per_key:.1f} bytes/key")
+    print(f"store accounting (used_memory): {store.get_memory_usage() / args.keys:.1f} bytes/key")
+
+    large = "x" * args.large_value
+    store.set("large", large)
+    start = time.perf_counter()
+    for _ in range(args.overwrites):
+        store.set("large", large)
+    elapsed = time.perf_counter() - start
+    print(f"SET of a {args.large_value} byte value: {elapsed / args.overwrites * 1e6:.1f} us per overwrite")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,48 @@
-from redis_server import RedisServer
+import argparse
+from redis_server import RedisServer, AsyncRedisServer
+from redis_server.persistence import PersistenceConfig
+from redis_server.sharding import run_sharded, SHARD_MODES
 def  main():
-    server = RedisServer()
+    parser = argparse.ArgumentParser(description="Redis-style in-memory database server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--io", choices=["select", "asyncio"], default="select",
+                        help="network front end: hand written selector loop or asyncio (uvloop when installed)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="fork this many worker processes, each owning a slice of the hash slots")
+    parser.add_argument("--shard-mode", choices=SHARD_MODES, default="proxy",
+                        help="proxy: shared port, forward to the owner; moved: port+i per worker, reply -MOVED")
+    parser.add_argument("--async-loading", action="store_true",
+                        help="accept clients while the dataset loads, answering PING and INFO and -LOADING otherwise")
+    parser.add_argument("--replicaof", nargs=2, metavar=("HOST", "PORT"),
+                        help="start as a read-only replica of HOST PORT (selector front end only)")
+    parser.add_argument("--cluster-enabled", action="store_true",
+                        help="serve the hash slots assigned with CLUSTER ADDSLOTS, -MOVED for the others (selector front end only)")
+    args = parser.parse_args()
+    if args.replicaof and (args.io == "asyncio" or args.shards > 0):
+        parser.error("--replicaof needs the selector front end without --shards")
+    if args.cluster_enabled and (args.io == "asyncio" or args.shards > 0 or args.replicaof):
+        parser.error("--cluster-enabled needs the selector front end without --shards or --replicaof")
+    config_dict = {}
+    if args.async_loading:
+        config_dict['async_loading'] = True
+    if args.replicaof:
+        config_dict['replicaof'] = " ".join(args.replicaof)
+    if args.cluster_enabled:
+        config_dict['cluster_enabled'] = True
+    config_dict = config_dict or None
+    
+    if args.shards > 0:
+        run_sharded(args.shards, args.host, args.port, args.shard_mode, config_dict)
+        return
+    if args.io == "asyncio":
+        server = AsyncRedisServer(args.host, args.port, PersistenceConfig(config_dict))
+    else:
+        server = RedisServer(args.host, args.port, PersistenceConfig(config_dict))
     try:
         server.start()
     except  KeyboardInterrupt:
         print("\nshutting  down server....")
         server.stop()
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
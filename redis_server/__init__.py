@@ -1,3 +1,4 @@
 from .server import RedisServer
+from .async_server import AsyncRedisServer
 
-__all__ = ['RedisServer']
\ No newline at end of file
+__all__ = ['RedisServer', 'AsyncRedisServer']
@@ -0,0 +1,167 @@
+"""
+asyncio front end
+
+Serves the same CommandHandler and DataStore as RedisServer but lets the
+asyncio transport handle buffering, write readiness and backpressure.
+uvloop is used as the event loop when it is installed.
+"""
+import asyncio
+from .protocol import RESPParser
+from .server import RedisServer
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+#Seconds the background load pauses between two slices
+LOADING_YIELD = 0.001
+
+
+class RedisProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.parser = RESPParser()
+        self.transport = None
+        self.addr = None
+        self.limit_state = {"soft_limit_reached_time" : None}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.server.connections.add(self)
+        print(f"Client Connected from {self.addr}")
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        print(f"Client {self.addr} disconnected ")
+
+    def data_received(self, data):
+        self.parser.feed(data)
+        replies = []
+        for parts in self.parser.parse():
+            try:
+                replies.append(self.server.process_command(parts))
+            except Exception as e:
+                print(f"Error proccessing command: {e}")
+                replies.append(f"-ERR  {str(e)}\r\n".encode())
+        if self.parser.error:
+            replies.append(f"-ERR {self.parser.error}\r\n".encode())
+        #One write for the whole pipelined batch
+        close = self.parser.error is not None
+        if self.server.persistence_manager.aof_writer:
+            self.server.queue_reply(self, b"".join(replies), close)
+        else:
+            self.send(b"".join(replies), close)
+
+    def send(self, data, close=False):
+        if self.transport.is_closing():
+            return
+        if data:
+            self.transport.write(data)
+        if close:
+            self.transport.close()
+        elif self.server._output_buffer_limit_reached(self.transport.get_write_buffer_size(), self.limit_state):
+            print(f"Client {self.addr} closed for overcoming of output buffer limits")
+            self.transport.abort()
+
+    def pause_writing(self):
+        #Stop reading requests from a client that does not read its replies
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+
+class AsyncRedisServer(RedisServer):
+    """RedisServer running on asyncio instead of the hand-written selector loop"""
+
+    def __init__(self, host='localhost', port=6379, persistence_config=None, use_uvloop=True):
+        super().__init__(host, port, persistence_config)
+        self.use_uvloop = use_uvloop and uvloop is not None
+        self.connections = set()
+        #(protocol, data, close) waiting for the AOF flush of this iteration
+        self._pending_replies = []
+        self._aio_server = None
+        self._tasks = []
+
+    def start(self):
+        if self.use_uvloop:
+            uvloop.install()
+            print("Using uvloop event loop")
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.persistence_manager.start()
+        print("Recovering data from persistence files")
+        if self.persistence_config.get('async_loading', False):
+            self.persistence_manager.begin_loading(self.storage, self.command_handler)
+        else:
+            self._recovery_done(self.persistence_manager.recover_data(self.storage, self.command_handler))
+
+        loop = asyncio.get_running_loop()
+        self._aio_server = await loop.create_server(
+            lambda: RedisProtocol(self), self.host, self.port,
+            reuse_address=True, backlog=self.tcp_backlog)
+        self._tasks = [
+            asyncio.create_task(self._run_periodic(self.cleanup_interval, self._background_cleanup)),
+            asyncio.create_task(self._run_periodic(self.persistence_interval, self._background_persistence_task)),
+        ]
+        if self.persistence_manager.loading:
+            self._tasks.append(asyncio.create_task(self._run_loading()))
+        self.running = True
+        print(f"Redis-style server (asyncio) listening on {self.host} : {self.port}")
+        try:
+            async with self._aio_server:
+                await self._aio_server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            for connection in list(self.connections):
+                connection.transport.close()
+
+    def queue_reply(self, protocol, data, close=False):
+        """
+        Send a reply once the AOF holds the writes it acknowledges
+
+        Callbacks scheduled with call_soon run after every data_received of
+        the current loop iteration, so all of them share one AOF flush
+        """
+        if not self._pending_replies:
+            asyncio.get_running_loop().call_soon(self._flush_replies)
+        self._pending_replies.append((protocol, data, close))
+
+    def _flush_replies(self):
+        self.persistence_manager.flush_aof()
+        pending, self._pending_replies = self._pending_replies, []
+        for protocol, data, close in pending:
+            protocol.send(data, close)
+
+    async def _run_periodic(self, interval, callback):
+        while True:
+            await asyncio.sleep(interval)
+            callback()
+
+    async def _run_loading(self):
+        #Yield to the loop between slices so clients get PING, INFO or -LOADING.
+        #A timer wakeup runs after the reply flushes queued with call_soon,
+        #sleep(0) would run the next slice before them
+        while True:
+            success = self.persistence_manager.load_step()
+            if success is not None:
+                self._recovery_done(success)
+                return
+            await asyncio.sleep(LOADING_YIELD)
+
+    def stop(self):
+        #Sockets are closed when asyncio.run unwinds _serve
+        self.running = False
+        try:
+            self.persistence_manager.stop()
+        except Exception as e:
+            print(f"Error stopping persistence: {e}")
+        print("Server Stopped")
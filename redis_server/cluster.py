@@ -0,0 +1,894 @@
+"""
+Cluster mode
+
+The keyspace is split into the 16384 CRC16 hash slots of the sharding
+module, each node serving the slots assigned to it and answering
+
+  -MOVED <slot> <host>:<port>    the key belongs to another node
+  -ASK <slot> <host>:<port>      the slot is being migrated and the key is
+                                 no longer here, retry once on that node
+                                 after ASKING
+
+Nodes learn about each other with CLUSTER MEET. Every second a node sends
+CLUSTER PING to every node it knows over an outgoing connection to its
+client port, with its id, port, epochs, slots and the nodes it knows;
+the reply carries the same fields for the other side, so a single MEET
+spreads to the whole cluster. A slot claimed by a node with a greater
+config epoch than its current owner changes hands, which is how the
+result of a migration reaches every node.
+
+A slot is migrated the way Redis Cluster does it:
+
+  CLUSTER SETSLOT <slot> IMPORTING <source id>     on the target
+  CLUSTER SETSLOT <slot> MIGRATING <target id>     on the source
+  CLUSTER GETKEYSINSLOT <slot> <count>             on the source, then
+  MIGRATE <host> <port> "" 0 <timeout> KEYS ...    until no key is left
+  CLUSTER SETSLOT <slot> NODE <target id>          on both
+
+MIGRATE sends DUMP payloads as RESTORE-ASKING over a blocking connection
+kept for MIGRATE_SOCKET_IDLE seconds, like Redis it holds up the event
+loop for the round trip. Slot ownership, epochs and the known nodes are
+saved to cluster_config_file (nodes.conf) in the data directory.
+
+There are no replicas and no failover: a node that stops answering is
+only flagged as failing in CLUSTER NODES and CLUSTER INFO.
+"""
+import errno
+import os
+import selectors
+import socket
+import time
+from .protocol import RESPParser, RESPReplyParser, ProtocolError, encode_command
+from .response import ok, errorm, simple_string, bulk_string, integar, array
+from .sharding import HASH_SLOTS, key_hash_slot
+from .persistence.snapshot import dump_value
+
+#Commands the server hands to Cluster.command with the connection
+CLUSTER_COMMANDS = {"CLUSTER", "ASKING", "MIGRATE"}
+
+#Seconds between two PINGs to a node, and between connection attempts
+CLUSTER_PING_PERIOD = 1
+#Seconds an idle MIGRATE connection is kept open for the next MIGRATE
+MIGRATE_SOCKET_IDLE = 10
+#MIGRATE timeout used when the one given is 0
+MIGRATE_DEFAULT_TIMEOUT = 1.0
+#Bytes read from a cluster link or a MIGRATE connection at a time
+CLUSTER_READ_SIZE = 64 * 1024
+
+CLUSTER_DISABLED = b"-ERR This instance has cluster support disabled\r\n"
+
+
+def new_node_id() -> str:
+    return os.urandom(20).hex()
+
+
+def slot_ranges(slots) -> list:
+    """(first, last) of every run of consecutive slots, slots sorted"""
+    ranges = []
+    for slot in slots:
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1][1] = slot
+        else:
+            ranges.append([slot, slot])
+    return ranges
+
+
+def parse_slot_ranges(text: str) -> list:
+    """
+    Slots of "0-5460,5470" style text, as sent in CLUSTER PING
+
+    ValueError for a slot out of range or a range ending before it starts
+    """
+    slots = []
+    for part in text.split(",") if text else ():
+        first, _, last = part.partition("-")
+        first, last = int(first), int(last or first)
+        if not 0 <= first <= last < HASH_SLOTS:
+            raise ValueError(f"invalid slot range {part}")
+        slots.extend(range(first, last + 1))
+    return slots
+
+
+class Cluster:
+    """Slot table, known nodes and cluster links of a RedisServer"""
+
+    def __init__(self, server):
+        self.server = server
+        self.config = server.persistence_config
+        self.enabled = bool(self.config.get('cluster_enabled', False))
+        self.myself = None
+        self.current_epoch = 0
+        #Config epoch of this node, the greater one wins a slot claimed twice
+        self.config_epoch = 0
+        #Owner id of every slot, None when unassigned
+        self.slots = [None] * HASH_SLOTS
+        #slot -> id of the node it is moving to / coming from
+        self.migrating = {}
+        self.importing = {}
+        #Other nodes: id -> node state
+        self.nodes = {}
+        #Outgoing cluster links by socket
+        self.links = {}
+        #Clients whose next command may run in an importing slot
+        self.asking_clients = set()
+        #(host, port) -> [socket, last use] of MIGRATE connections
+        self.migrate_sockets = {}
+        #Address other nodes reach this one on, learned from their PINGs
+        self.my_ip = None
+        self.todo_save = False
+
+    def start(self) -> None:
+        """Load or create the node configuration, before the loop runs"""
+        if not self.enabled:
+            return
+        if os.path.exists(self._config_path()):
+            self._load_config()
+            print(f"Node configuration loaded, I'm {self.myself}")
+        else:
+            self.myself = new_node_id()
+            print(f"No cluster configuration found, I'm {self.myself}")
+            self._save_config()
+
+    def _config_path(self) -> str:
+        return os.path.join(self.config.data_dir, self.config.get('cluster_config_file', 'nodes.conf'))
+
+    def _my_host(self) -> str:
+        """
+        The IP peers list this node with, so every node gives clients the
+        same address for it; the resolved bind address until a peer pinged
+        """
+        if self.my_ip:
+            return self.my_ip
+        host = self.server.host
+        if host in ('', '0.0.0.0'):
+            return '127.0.0.1'
+        try:
+            return socket.gethostbyname(host)
+        except OSError:
+            return host
+
+    def _address(self, node_id: str) -> str:
+        if node_id == self.myself:
+            return f"{self._my_host()}:{self.server.port}"
+        node = self.nodes[node_id]
+        return f"{node['host']}:{node['port']}"
+
+    def _epoch_of(self, node_id: str) -> int:
+        if node_id == self.myself:
+            return self.config_epoch
+        return self.nodes[node_id]["epoch"]
+
+    def _bump_epoch(self) -> None:
+        """Become the only node with the greatest config epoch"""
+        if self.config_epoch and all(node["epoch"] < self.config_epoch for node in self.nodes.values()) \
+                and self.config_epoch == self.current_epoch:
+            return
+        self.current_epoch += 1
+        self.config_epoch = self.current_epoch
+        self.todo_save = True
+
+    def _add_node(self, node_id: str, host: str, port: int, flags=()):
+        node = {
+            "id" : node_id,
+            "host" : host,
+            "port" : port,
+            #master, handshake (met but id unknown yet), fail
+            "flags" : set(flags),
+            "epoch" : 0,
+            "link" : None,
+            "created" : time.time(),
+            "ping_sent" : 0.0,
+            "pong_received" : 0.0,
+            "last_connect_try" : 0.0,
+        }
+        self.nodes[node_id] = node
+        if "handshake" not in node["flags"]:
+            self.todo_save = True
+        return node
+
+    def _remove_node(self, node) -> None:
+        self._close_link(node)
+        self.nodes.pop(node["id"], None)
+
+    # Routing
+
+    def route(self, client, parts):
+        """Error reply redirecting a command, None when it runs here"""
+        asking = client in self.asking_clients
+        if asking:
+            self.asking_clients.discard(client)
+        handler = self.server.command_handler
+        keys = handler.get_keys(parts[0], parts[1:])
+        if not keys:
+            return None
+        slot = key_hash_slot(keys[0])
+        for key in keys[1:]:
+            if key_hash_slot(key) != slot:
+                return b"-CROSSSLOT Keys in request don't hash to the same slot\r\n"
+        owner = self.slots[slot]
+        if owner is None:
+            return b"-CLUSTERDOWN Hash slot not served\r\n"
+        if owner != self.myself:
+            if slot in self.importing and (asking or parts[0].upper() == "RESTORE-ASKING"):
+                return None
+            return f"-MOVED {slot} {self._address(owner)}\r\n".encode()
+        if slot in self.migrating:
+            present = self.server.storage.exists(*keys)
+            if not present:
+                #Moved already or never existed, the target has it or creates it
+                return f"-ASK {slot} {self._address(self.migrating[slot])}\r\n".encode()
+            if present < len(keys):
+                return b"-TRYAGAIN Multiple keys request during rehashing of slot\r\n"
+        return None
+
+    def client_closed(self, client) -> None:
+        self.asking_clients.discard(client)
+
+    # Commands
+
+    def command(self, client, parts):
+        """Run CLUSTER, ASKING or MIGRATE for client"""
+        name = parts[0].upper()
+        if name == "MIGRATE":
+            return self.migrate(parts[1:])
+        if not self.enabled:
+            return CLUSTER_DISABLED
+        if name == "ASKING":
+            self.asking_clients.add(client)
+            return ok()
+        if len(parts) < 2:
+            return errorm("wrong number of arguments for 'cluster' command")
+        subcommand = parts[1].upper()
+        args = parts[2:]
+        handler = getattr(self, f"_cluster_{subcommand.lower()}", None)
+        if handler is None:
+            return errorm(f"Unknown subcommand or wrong number of arguments for '{parts[1]}'")
+        reply = handler(client, args)
+        if self.todo_save:
+            self._save_config()
+        return reply
+
+    def _parse_slot(self, text):
+        try:
+            slot = int(text)
+        except ValueError:
+            return None
+        return slot if 0 <= slot < HASH_SLOTS else None
+
+    def _cluster_myid(self, client, args):
+        return bulk_string(self.myself)
+
+    def _cluster_keyslot(self, client, args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'cluster|keyslot' command")
+        return integar(key_hash_slot(args[0]))
+
+    def _cluster_countkeysinslot(self, client, args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'cluster|countkeysinslot' command")
+        slot = self._parse_slot(args[0])
+        if slot is None:
+            return errorm("Invalid slot")
+        return integar(self.server.storage.count_keys_in_slot(slot))
+
+    def _cluster_getkeysinslot(self, client, args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'cluster|getkeysinslot' command")
+        slot = self._parse_slot(args[0])
+        if slot is None:
+            return errorm("Invalid slot")
+        try:
+            count = int(args[1])
+        except ValueError:
+            count = -1
+        if count < 0:
+            return errorm("Invalid number of keys")
+        return array([bulk_string(key) for key in self.server.storage.get_keys_in_slot(slot, count)])
+
+    def _slot_list(self, args, ranges: bool):
+        """Slots of ADDSLOTS style arguments, or an error reply"""
+        if not args or (ranges and len(args) % 2):
+            return errorm("wrong number of arguments for 'cluster' command")
+        slots = []
+        if ranges:
+            for first, last in zip(args[0::2], args[1::2]):
+                first, last = self._parse_slot(first), self._parse_slot(last)
+                if first is None or last is None:
+                    return errorm("Invalid or out of range slot")
+                if first > last:
+                    return errorm(f"start slot number {first} is greater than end slot number {last}")
+                slots.extend(range(first, last + 1))
+        else:
+            for text in args:
+                slot = self._parse_slot(text)
+                if slot is None:
+                    return errorm("Invalid or out of range slot")
+                slots.append(slot)
+        if len(set(slots)) != len(slots):
+            return errorm("Slot specified multiple times")
+        return slots
+
+    def _add_slots(self, args, ranges):
+        slots = self._slot_list(args, ranges)
+        if isinstance(slots, bytes):
+            return slots
+        for slot in slots:
+            if self.slots[slot] is not None:
+                return errorm(f"Slot {slot} is already busy")
+        for slot in slots:
+            self.slots[slot] = self.myself
+            self.importing.pop(slot, None)
+        if not self.config_epoch:
+            self._bump_epoch()
+        self.todo_save = True
+        return ok()
+
+    def _cluster_addslots(self, client, args):
+        return self._add_slots(args, False)
+
+    def _cluster_addslotsrange(self, client, args):
+        return self._add_slots(args, True)
+
+    def _cluster_delslots(self, client, args):
+        slots = self._slot_list(args, False)
+        if isinstance(slots, bytes):
+            return slots
+        for slot in slots:
+            if self.slots[slot] is None:
+                return errorm(f"Slot {slot} is already unassigned")
+        for slot in slots:
+            self.slots[slot] = None
+            self.migrating.pop(slot, None)
+            self.importing.pop(slot, None)
+        self.todo_save = True
+        return ok()
+
+    def _cluster_setslot(self, client, args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'cluster|setslot' command")
+        slot = self._parse_slot(args[0])
+        if slot is None:
+            return errorm("Invalid or out of range slot")
+        action = args[1].upper()
+        if action == "STABLE":
+            self.migrating.pop(slot, None)
+            self.importing.pop(slot, None)
+            self.todo_save = True
+            return ok()
+        if action not in ("MIGRATING", "IMPORTING", "NODE") or len(args) != 3:
+            return errorm("Invalid CLUSTER SETSLOT action or number of arguments")
+        node_id = args[2]
+        if node_id != self.myself and node_id not in self.nodes:
+            return errorm(f"I don't know about node {node_id}")
+        if action == "MIGRATING":
+            if self.slots[slot] != self.myself:
+                return errorm(f"I'm not the owner of hash slot {slot}")
+            if node_id == self.myself:
+                return errorm("Can't MIGRATE to myself")
+            self.migrating[slot] = node_id
+        elif action == "IMPORTING":
+            if self.slots[slot] == self.myself:
+                return errorm(f"I'm already the owner of hash slot {slot}")
+            if node_id == self.myself:
+                return errorm("Can't IMPORT from myself")
+            self.importing[slot] = node_id
+        else:
+            if self.slots[slot] == self.myself and node_id != self.myself \
+                    and self.server.storage.count_keys_in_slot(slot):
+                return errorm(f"Can't assign hashslot {slot} to a different node while I still hold keys for this hash slot.")
+            self.migrating.pop(slot, None)
+            if node_id == self.myself and self.importing.pop(slot, None) is not None:
+                #The other nodes take the slot from the old owner once they
+                #see it claimed with a greater epoch
+                self._bump_epoch()
+            self.slots[slot] = node_id
+        self.todo_save = True
+        return ok()
+
+    def _cluster_meet(self, client, args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'cluster|meet' command")
+        try:
+            port = int(args[1])
+        except ValueError:
+            return errorm(f"Invalid base port specified: {args[1]}")
+        try:
+            #Peers list nodes by IP, a hostname here would be a second name
+            host = socket.gethostbyname(args[0])
+        except OSError:
+            return errorm(f"Invalid node address specified: {args[0]}:{args[1]}")
+        for node in self.nodes.values():
+            if (node["host"], node["port"]) == (host, port):
+                return ok()
+        #Named by its real id once it answers the first PING
+        self._add_node(new_node_id(), host, port, ("handshake",))
+        return ok()
+
+    def _cluster_forget(self, client, args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'cluster|forget' command")
+        if args[0] == self.myself:
+            return errorm("I tried hard but I can't forget myself...")
+        node = self.nodes.get(args[0])
+        if node is None:
+            return errorm(f"Unknown node {args[0]}")
+        for slot, owner in enumerate(self.slots):
+            if owner == node["id"]:
+                self.slots[slot] = None
+        self._remove_node(node)
+        self.todo_save = True
+        return ok()
+
+    def _cluster_saveconfig(self, client, args):
+        try:
+            self._save_config()
+        except OSError as e:
+            return errorm(f"error saving the cluster node config: {e}")
+        return ok()
+
+    def _state_ok(self) -> bool:
+        return all(owner is not None and (owner == self.myself or "fail" not in self.nodes[owner]["flags"])
+                   for owner in self.slots)
+
+    def _cluster_info(self, client, args):
+        assigned = sum(1 for owner in self.slots if owner is not None)
+        failing = sum(1 for owner in self.slots if owner is not None and owner != self.myself
+                      and "fail" in self.nodes[owner]["flags"])
+        lines = [
+            f"cluster_state:{'ok' if self._state_ok() else 'fail'}",
+            f"cluster_slots_assigned:{assigned}",
+            f"cluster_slots_ok:{assigned - failing}",
+            "cluster_slots_pfail:0",
+            f"cluster_slots_fail:{failing}",
+            f"cluster_known_nodes:{len(self.nodes) + 1}",
+            f"cluster_size:{len(set(owner for owner in self.slots if owner is not None))}",
+            f"cluster_current_epoch:{self.current_epoch}",
+            f"cluster_my_epoch:{self.config_epoch}",
+        ]
+        return bulk_string("\r\n".join(lines) + "\r\n")
+
+    def _cluster_slots(self, client, args):
+        items = []
+        start = 0
+        while start < HASH_SLOTS:
+            owner = self.slots[start]
+            end = start
+            while end + 1 < HASH_SLOTS and self.slots[end + 1] == owner:
+                end += 1
+            if owner is not None:
+                host, _, port = self._address(owner).rpartition(":")
+                items.append(array([integar(start), integar(end),
+                                    array([bulk_string(host), integar(int(port)), bulk_string(owner)])]))
+            start = end + 1
+        return array(items)
+
+    def _cluster_nodes(self, client, args):
+        lines = [self._node_line(self.myself)]
+        lines.extend(self._node_line(node_id) for node_id in self.nodes)
+        return bulk_string("".join(lines))
+
+    def _node_line(self, node_id: str) -> str:
+        """CLUSTER NODES line of a node, also the nodes.conf format"""
+        ranges = " ".join(f"{first}-{last}" if first != last else str(first)
+                          for first, last in slot_ranges(slot for slot, owner in enumerate(self.slots) if owner == node_id))
+        if node_id == self.myself:
+            flags, ping_sent, pong_received, link = "myself,master", 0, 0, "connected"
+            epoch = self.config_epoch
+            extra = [f"[{slot}->-{target}]" for slot, target in sorted(self.migrating.items())]
+            extra += [f"[{slot}-<-{source}]" for slot, source in sorted(self.importing.items())]
+            if extra:
+                ranges = " ".join(([ranges] if ranges else []) + extra)
+        else:
+            node = self.nodes[node_id]
+            flags = ",".join(["master"] + sorted(node["flags"]))
+            ping_sent = int(node["ping_sent"] * 1000)
+            pong_received = int(node["pong_received"] * 1000)
+            link = "connected" if node["link"] and node["link"]["state"] == 'connected' else "disconnected"
+            epoch = node["epoch"]
+        return f"{node_id} {self._address(node_id)} {flags} - {ping_sent} {pong_received} {epoch} {link} {ranges}".rstrip() + "\n"
+
+    # Cluster bus
+
+    def _header(self) -> list:
+        """Fields of CLUSTER PING and of its reply"""
+        mine = slot_ranges(slot for slot, owner in enumerate(self.slots) if owner == self.myself)
+        fields = [self.myself, str(self.server.port), str(self.current_epoch), str(self.config_epoch),
+                  ",".join(f"{first}-{last}" for first, last in mine)]
+        for node in self.nodes.values():
+            if "handshake" not in node["flags"]:
+                fields.extend((node["id"], node["host"], str(node["port"])))
+        return fields
+
+    def _cluster_ping(self, client, args):
+        """A PING from another node, answered with this node's fields"""
+        if len(args) < 5 or (len(args) - 5) % 3:
+            return errorm("wrong number of arguments for 'cluster|ping' command")
+        try:
+            self._process_header(args, self.server.clients[client]["addr"][0])
+        except ValueError as e:
+            return errorm(f"bad cluster PING: {e}")
+        #The local end of the connection is the address the peer uses for us
+        self.my_ip = client.getsockname()[0]
+        return encode_command(self._header())
+
+    def _process_header(self, fields, host: str, node=None) -> None:
+        """
+        Learn from the fields of a PING or of a PONG to a PING sent to node
+
+        node is None for PINGs received, the sender is added when unknown
+        """
+        #Every field is checked before anything is changed
+        node_id = fields[0]
+        port, current_epoch, config_epoch = int(fields[1]), int(fields[2]), int(fields[3])
+        if not node_id or not 0 < port < 65536 or current_epoch < 0 or config_epoch < 0:
+            raise ValueError("bad node id, port or epoch")
+        slots = parse_slot_ranges(fields[4])
+        gossip = []
+        for index in range(5, len(fields), 3):
+            gossip_id, gossip_host, gossip_port = fields[index:index + 3]
+            gossip_port = int(gossip_port)
+            if not gossip_id or not gossip_host or not 0 < gossip_port < 65536:
+                raise ValueError(f"bad gossip entry for node {gossip_id}")
+            gossip.append((gossip_id, gossip_host, gossip_port))
+        if node is not None and node["id"] != node_id:
+            #First PONG of a node met with CLUSTER MEET, now named by its id
+            self.nodes.pop(node["id"], None)
+            if node_id == self.myself or node_id in self.nodes:
+                self._close_link(node)
+                if node_id == self.myself:
+                    return
+                node = self.nodes[node_id]
+            else:
+                node["id"] = node_id
+                node["flags"].discard("handshake")
+                self.nodes[node_id] = node
+                self.todo_save = True
+                print(f"Handshake with node {node_id} completed")
+        elif node is None:
+            if node_id == self.myself:
+                return
+            node = self.nodes.get(node_id)
+            if node is None:
+                node = self._add_node(node_id, host, port)
+                print(f"Node {node_id} ({host}:{port}) joined the cluster")
+        if node["port"] != port:
+            node["port"] = port
+            self.todo_save = True
+        node["pong_received"] = time.time()
+        if "fail" in node["flags"]:
+            node["flags"].discard("fail")
+            print(f"Node {node_id} is reachable again")
+        if current_epoch > self.current_epoch:
+            self.current_epoch = current_epoch
+            self.todo_save = True
+        if node["epoch"] != config_epoch:
+            node["epoch"] = config_epoch
+            self.todo_save = True
+        self._update_slots(node, slots)
+        for gossip_id, gossip_host, gossip_port in gossip:
+            if gossip_id != self.myself and gossip_id not in self.nodes:
+                self._add_node(gossip_id, gossip_host, gossip_port)
+                print(f"Node {gossip_id} ({gossip_host}:{gossip_port}) learned from {node_id}")
+
+    def _update_slots(self, node, slots) -> None:
+        """Give node the slots it claims unless their owner has a greater epoch"""
+        node_id = node["id"]
+        for slot in slots:
+            owner = self.slots[slot]
+            if owner == node_id or slot in self.importing:
+                continue
+            if owner is not None and self._epoch_of(owner) >= node["epoch"]:
+                continue
+            if owner == self.myself:
+                print(f"Slot {slot} was taken over by node {node_id}")
+                self.migrating.pop(slot, None)
+            self.slots[slot] = node_id
+            self.todo_save = True
+
+    def cron(self) -> None:
+        """PINGs, reconnects and failure flags, run every persistence interval"""
+        now = time.time()
+        for address, (sock, last_use) in list(self.migrate_sockets.items()):
+            if now - last_use > MIGRATE_SOCKET_IDLE:
+                self._close_migrate_socket(address)
+        if not self.enabled:
+            return
+        timeout = int(self.config.get('cluster_node_timeout', 15000)) / 1000
+        for node in list(self.nodes.values()):
+            if "handshake" in node["flags"] and now - node["created"] > timeout:
+                print(f"Handshake with {node['host']}:{node['port']} timed out")
+                self._remove_node(node)
+                continue
+            link = node["link"]
+            if link is None:
+                if now - node["last_connect_try"] >= CLUSTER_PING_PERIOD:
+                    self._connect(node)
+            elif link["state"] == 'connecting':
+                if now - link["created"] > timeout / 2:
+                    self._close_link(node, "connection timeout")
+            elif node["ping_sent"]:
+                if now - node["ping_sent"] > timeout / 2:
+                    #Freshly connected links are tried before flagging the node
+                    self._close_link(node, "no PONG received")
+            elif now - node["pong_received"] >= CLUSTER_PING_PERIOD:
+                self._send_ping(link)
+            last_seen = max(node["pong_received"], node["created"])
+            if "handshake" not in node["flags"] and "fail" not in node["flags"] and now - last_seen > timeout:
+                node["flags"].add("fail")
+                print(f"Marking node {node['id']} as failing")
+        if self.todo_save:
+            self._save_config()
+
+    def _connect(self, node) -> None:
+        node["last_connect_try"] = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            error = sock.connect_ex((node["host"], node["port"]))
+            if error not in (0, errno.EINPROGRESS):
+                raise OSError(error, os.strerror(error))
+        except OSError:
+            sock.close()
+            return
+        link = {
+            "sock" : sock,
+            "node" : node,
+            #connecting, connected
+            "state" : 'connecting',
+            "out" : bytearray(),
+            "parser" : RESPReplyParser(),
+            "want_write" : True,
+            "created" : time.time(),
+        }
+        node["link"] = link
+        node["ping_sent"] = 0.0
+        self.links[sock] = link
+        self.server.selector.register(sock, selectors.EVENT_WRITE, self._handle_link)
+
+    def _close_link(self, node, reason=None) -> None:
+        link = node["link"]
+        if link is None:
+            return
+        node["link"] = None
+        node["ping_sent"] = 0.0
+        self.links.pop(link["sock"], None)
+        if reason and "handshake" not in node["flags"]:
+            print(f"Cluster link to {node['id']} closed: {reason}")
+        try:
+            self.server.selector.unregister(link["sock"])
+        except (KeyError, ValueError):
+            pass
+        link["sock"].close()
+
+    def _send_ping(self, link) -> None:
+        link["node"]["ping_sent"] = time.time()
+        link["out"] += encode_command(["CLUSTER", "PING"] + self._header())
+        self._flush_link(link)
+
+    def _flush_link(self, link) -> None:
+        sock = link["sock"]
+        try:
+            while link["out"]:
+                sent = sock.send(link["out"])
+                del link["out"][:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self._close_link(link["node"], e)
+            return
+        want_write = bool(link["out"])
+        if want_write != link["want_write"]:
+            link["want_write"] = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.server.selector.modify(sock, events, self._handle_link)
+
+    def _handle_link(self, sock, mask) -> None:
+        link = self.links.get(sock)
+        if link is None:
+            return
+        node = link["node"]
+        if link["state"] == 'connecting':
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._close_link(node, os.strerror(error))
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            link["state"] = 'connected'
+            #Registered for writability only so far, the flush re-registers
+            link["want_write"] = None
+            self._send_ping(link)
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._flush_link(link)
+            if node["link"] is not link:
+                return
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            data = sock.recv(CLUSTER_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close_link(node, e)
+            return
+        if not data:
+            self._close_link(node, "connection closed")
+            return
+        link["parser"].feed(data)
+        try:
+            replies = link["parser"].parse()
+        except ProtocolError as e:
+            self._close_link(node, e)
+            return
+        for reply in replies:
+            #A handshake PONG replaces the node the link belonged to
+            node = link["node"]
+            node["ping_sent"] = 0.0
+            if reply[:1] != b"*":
+                self._close_link(node, reply.decode(errors='replace').strip())
+                return
+            parser = RESPParser()
+            parser.feed(reply)
+            fields = next(iter(parser.parse()), None)
+            try:
+                if fields is None or len(fields) < 5 or (len(fields) - 5) % 3:
+                    raise ValueError("malformed PONG")
+                self._process_header(fields, node["host"], node)
+            except ValueError as e:
+                self._close_link(node, f"bad PONG: {e}")
+                return
+
+    # Node configuration
+
+    def _save_config(self) -> None:
+        path = self._config_path()
+        temp_path = path + ".tmp"
+        lines = [self._node_line(self.myself)]
+        lines.extend(self._node_line(node_id) for node_id, node in self.nodes.items()
+                     if "handshake" not in node["flags"])
+        lines.append(f"vars currentEpoch {self.current_epoch} lastVoteEpoch 0\n")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(temp_path, 'w') as file:
+            file.write("".join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        self.todo_save = False
+
+    def _load_config(self) -> None:
+        with open(self._config_path()) as file:
+            lines = [line.split() for line in file if line.strip()]
+        owners = []
+        for fields in lines:
+            if fields[0] == "vars":
+                values = dict(zip(fields[1::2], fields[2::2]))
+                self.current_epoch = int(values.get("currentEpoch", 0))
+                continue
+            node_id, address, flags = fields[0], fields[1], fields[2].split(",")
+            host, _, port = address.split("@")[0].rpartition(":")
+            epoch = int(fields[6])
+            if "myself" in flags:
+                self.myself = node_id
+                self.config_epoch = epoch
+            else:
+                self._add_node(node_id, host, int(port))["epoch"] = epoch
+            owners.append((node_id, fields[8:]))
+        for node_id, ranges in owners:
+            for text in ranges:
+                if text.startswith("["):
+                    slot, arrow, other = text[1:-1].partition("->-")
+                    if not arrow:
+                        slot, _, other = text[1:-1].partition("-<-")
+                        self.importing[int(slot)] = other
+                    else:
+                        self.migrating[int(slot)] = other
+                    continue
+                first, _, last = text.partition("-")
+                for slot in range(int(first), int(last or first) + 1):
+                    self.slots[slot] = node_id
+        if self.myself is None:
+            raise ValueError(f"{self._config_path()} has no myself node")
+        self.todo_save = False
+
+    # MIGRATE
+
+    def migrate(self, args):
+        """MIGRATE host port key|"" db timeout [COPY] [REPLACE] [KEYS key ...]"""
+        if len(args) < 5:
+            return errorm("wrong number of arguments for 'migrate' command")
+        host = args[0]
+        try:
+            port, db, timeout = int(args[1]), int(args[3]), int(args[4])
+        except ValueError:
+            return errorm("value is not an integer or out of range")
+        copy = replace = False
+        keys = [args[2]]
+        for index in range(5, len(args)):
+            option = args[index].upper()
+            if option == "COPY":
+                copy = True
+            elif option == "REPLACE":
+                replace = True
+            elif option == "KEYS":
+                if args[2]:
+                    return errorm("When using MIGRATE KEYS option, the key argument must be set to the empty string")
+                keys = list(args[index + 1:])
+                break
+            else:
+                return errorm("syntax error")
+        if db != 0:
+            return errorm("only database 0 is supported")
+        storage = self.server.storage
+        command = "RESTORE-ASKING" if self.enabled else "RESTORE"
+        now = time.time()
+        records = []
+        sent = []
+        for key in keys:
+            value = storage.get(key)
+            if value is None:
+                continue
+            expiry_time = storage.get_expiry_time(key)
+            ttl = 0 if expiry_time is None else max(1, int((expiry_time - now) * 1000))
+            restore = [command, key, str(ttl), dump_value(value)]
+            if replace:
+                restore.append("REPLACE")
+            records.append(encode_command(restore))
+            sent.append(key)
+        if not sent:
+            return simple_string("NOKEY")
+        address = (host, port)
+        try:
+            sock = self._migrate_socket(address, timeout / 1000 if timeout > 0 else MIGRATE_DEFAULT_TIMEOUT)
+            sock.sendall(b"".join(records))
+            replies = self._read_replies(sock, len(records))
+        except (OSError, ProtocolError) as e:
+            self._close_migrate_socket(address)
+            return f"-IOERR error or timeout writing to target instance: {e}\r\n".encode()
+        self.migrate_sockets[address][1] = time.time()
+        moved = []
+        error = None
+        for key, reply in zip(sent, replies):
+            if reply[:1] == b"-":
+                error = error or reply[1:].decode(errors='replace').strip()
+            else:
+                moved.append(key)
+        if moved and not copy:
+            #Logged to the AOF and replicas like any DEL
+            self.server.command_handler.execute("DEL", *moved)
+        if error:
+            return errorm(f"Target instance replied with error: {error}")
+        return ok()
+
+    def _migrate_socket(self, address, timeout: float):
+        cached = self.migrate_sockets.get(address)
+        if cached is not None:
+            cached[0].settimeout(timeout)
+            return cached[0]
+        sock = socket.create_connection(address, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.migrate_sockets[address] = [sock, time.time()]
+        return sock
+
+    def _close_migrate_socket(self, address) -> None:
+        cached = self.migrate_sockets.pop(address, None)
+        if cached is not None:
+            cached[0].close()
+
+    def _read_replies(self, sock, count: int) -> list:
+        parser = RESPReplyParser()
+        replies = []
+        while len(replies) < count:
+            data = sock.recv(CLUSTER_READ_SIZE)
+            if not data:
+                raise ConnectionError("connection closed by target instance")
+            parser.feed(data)
+            replies.extend(parser.parse())
+        return replies
+
+    def close(self) -> None:
+        for address in list(self.migrate_sockets):
+            self._close_migrate_socket(address)
+        for node in self.nodes.values():
+            self._close_link(node)
+        if self.enabled and self.todo_save:
+            self._save_config()
@@ -1,31 +1,229 @@
 from .storage import DataStore
 from  .response import *
+from .eviction import Evictor
+from .datatypes import QuickList, Hash, ZSet, Set
+from .protocol import encode_arg, format_double, canonical_int
+from .persistence.snapshot import SnapshotError, dump_value, restore_value
 import time
+import math
+import fnmatch
+
+#Positions of key arguments for commands that take keys, counted from the
+#first argument after the command name: (first, last, step). A last of -1
+#means every remaining argument.
+KEY_SPECS = {
+    "SET" : (0, 0, 1),
+    "GET" : (0, 0, 1),
+    "MGET" : (0, -1, 1),
+    "MSET" : (0, -1, 2),
+    "MSETNX" : (0, -1, 2),
+    "INCR" : (0, 0, 1),
+    "DECR" : (0, 0, 1),
+    "INCRBY" : (0, 0, 1),
+    "DECRBY" : (0, 0, 1),
+    "INCRBYFLOAT" : (0, 0, 1),
+    "APPEND" : (0, 0, 1),
+    "DEL" : (0, -1, 1),
+    "EXISTS" : (0, -1, 1),
+    "EXPIRE" : (0, 0, 1),
+    "EXPIREAT" : (0, 0, 1),
+    "PEXPIREAT" : (0, 0, 1),
+    "TTL" : (0, 0, 1),
+    "PTTL" : (0, 0, 1),
+    "PERSIST" : (0, 0, 1),
+    "TYPE" : (0, 0, 1),
+    "DUMP" : (0, 0, 1),
+    "RESTORE" : (0, 0, 1),
+    "RESTORE-ASKING" : (0, 0, 1),
+    "LPUSH" : (0, 0, 1),
+    "RPUSH" : (0, 0, 1),
+    "LPOP" : (0, 0, 1),
+    "RPOP" : (0, 0, 1),
+    "LRANGE" : (0, 0, 1),
+    "LLEN" : (0, 0, 1),
+    "LINDEX" : (0, 0, 1),
+    "LSET" : (0, 0, 1),
+    "LTRIM" : (0, 0, 1),
+    "LINSERT" : (0, 0, 1),
+    "HSET" : (0, 0, 1),
+    "HGET" : (0, 0, 1),
+    "HMGET" : (0, 0, 1),
+    "HDEL" : (0, 0, 1),
+    "HGETALL" : (0, 0, 1),
+    "HINCRBY" : (0, 0, 1),
+    "HLEN" : (0, 0, 1),
+    "HEXISTS" : (0, 0, 1),
+    "HSCAN" : (0, 0, 1),
+    "ZADD" : (0, 0, 1),
+    "ZREM" : (0, 0, 1),
+    "ZSCORE" : (0, 0, 1),
+    "ZRANK" : (0, 0, 1),
+    "ZREVRANK" : (0, 0, 1),
+    "ZCARD" : (0, 0, 1),
+    "ZRANGE" : (0, 0, 1),
+    "ZRANGEBYSCORE" : (0, 0, 1),
+    "ZCOUNT" : (0, 0, 1),
+    "ZINCRBY" : (0, 0, 1),
+    "ZPOPMIN" : (0, 0, 1),
+    "ZPOPMAX" : (0, 0, 1),
+    "SADD" : (0, 0, 1),
+    "SREM" : (0, 0, 1),
+    "SISMEMBER" : (0, 0, 1),
+    "SMISMEMBER" : (0, 0, 1),
+    "SMEMBERS" : (0, 0, 1),
+    "SCARD" : (0, 0, 1),
+    "SPOP" : (0, 0, 1),
+    "SRANDMEMBER" : (0, 0, 1),
+    "SINTER" : (0, -1, 1),
+    "SUNION" : (0, -1, 1),
+    "SDIFF" : (0, -1, 1),
+    "SINTERSTORE" : (0, -1, 1),
+    "SUNIONSTORE" : (0, -1, 1),
+    "SDIFFSTORE" : (0, -1, 1),
+    "SSCAN" : (0, 0, 1),
+}
+
+#Commands that may grow memory, refused while maxmemory cannot be honoured
+DENYOOM_COMMANDS = {"SET", "MSET", "MSETNX", "INCR", "DECR", "INCRBY", "DECRBY", "INCRBYFLOAT", "APPEND",
+                    "LPUSH", "RPUSH", "LSET", "LINSERT", "HSET", "HINCRBY",
+                    "ZADD", "ZINCRBY", "SADD", "SINTERSTORE", "SUNIONSTORE", "SDIFFSTORE",
+                    "RESTORE", "RESTORE-ASKING"}
+
+#Commands that modify the dataset. They are propagated to the AOF once
+#they succeed, as sent or as rewritten by the command through _propagate
+WRITE_COMMANDS = {"SET", "MSET", "MSETNX", "INCR", "DECR", "INCRBY", "DECRBY", "INCRBYFLOAT", "APPEND",
+                  "DEL", "EXPIRE", "EXPIREAT", "PEXPIREAT", "PERSIST", "FLUSHALL",
+                  "LPUSH", "RPUSH", "LPOP", "RPOP", "LSET", "LTRIM", "LINSERT",
+                  "HSET", "HDEL", "HINCRBY",
+                  "ZADD", "ZREM", "ZINCRBY", "ZPOPMIN", "ZPOPMAX",
+                  "SADD", "SREM", "SPOP", "SINTERSTORE", "SUNIONSTORE", "SDIFFSTORE",
+                  "RESTORE", "RESTORE-ASKING"}
+
+#Commands still served while the dataset is loading
+LOADING_OK_COMMANDS = {"PING", "INFO"}
+
+#Redis style CONFIG names that differ from the PersistenceConfig keys
+CONFIG_ALIASES = {
+    "maxmemory" : "max_memory_usage",
+    "auto-aof-rewrite-percentage" : "aof_rewrite_percentage",
+    "auto-aof-rewrite-min-size" : "aof_rewrite_min_size",
+}
+
+#CONFIG SET parameters that are pushed to the evictor when changed
+MEMORY_CONFIG = {"max_memory_usage", "maxmemory_policy", "maxmemory_samples"}
+
+class WrongTypeError(Exception):
+    """Raised by commands run against a key holding another type"""
 
 class CommandHandler:
     def __init__(self,storage, persistence_manager = None):
         self.storage =  storage
         self.command_count = 0
+        self.start_time = time.time()
         self.persistence_manager = persistence_manager
+        #Set by commands whose effect must be logged differently from how
+        #they were called: a list of argument lists, empty to log nothing
+        self._propagate = None
+        #Replication of the server, set by RedisServer: writes are streamed
+        #to replicas and refused while this node is a replica
+        self.replication = None
+        self.evictor = Evictor(storage, self._evicted)
+        if persistence_manager:
+            self.evictor.configure(persistence_manager.config)
         self.commands = {
             "PING" :self.ping,
             "ECHO" : self.echo,
              "SET" : self.set,
              "GET" :  self.get,
+             "MGET" : self.mget,
+             "MSET" : self.mset,
+             "MSETNX" : self.msetnx,
+             "INCR" : self.incr,
+             "DECR" : self.decr,
+             "INCRBY" : self.incrby,
+             "DECRBY" : self.decrby,
+             "INCRBYFLOAT" : self.incrbyfloat,
+             "APPEND" : self.append,
              "DEL" : self.delete,
              "EXISTS" : self.exists,
              "KEYS" : self.keys,
+             "SCAN" : self.scan,
+             "DBSIZE" : self.dbsize,
              "FLUSHALL" : self.flushall,
              "INFO" : self.info,
              "EXPIRE" : self.expire,
               "EXPIREAT" : self.expireat,
+              "PEXPIREAT" : self.pexpireat,
               "TTL" : self.ttl,
               "PTTL" : self.pttl,
               "PERSIST" : self.persist,
               "TYPE" : self.get_type,
+              "DUMP" : self.dump,
+              "RESTORE" : self.restore,
+              #Sent by MIGRATE in cluster mode, accepted for an importing slot
+              "RESTORE-ASKING" : self.restore,
+              
+              #Lists
+              "LPUSH" : self.lpush,
+              "RPUSH" : self.rpush,
+              "LPOP" : self.lpop,
+              "RPOP" : self.rpop,
+              "LRANGE" : self.lrange,
+              "LLEN" : self.llen,
+              "LINDEX" : self.lindex,
+              "LSET" : self.lset,
+              "LTRIM" : self.ltrim,
+              "LINSERT" : self.linsert,
+              
+              #Hashes
+              "HSET" : self.hset,
+              "HGET" : self.hget,
+              "HMGET" : self.hmget,
+              "HDEL" : self.hdel,
+              "HGETALL" : self.hgetall,
+              "HINCRBY" : self.hincrby,
+              "HLEN" : self.hlen,
+              "HEXISTS" : self.hexists,
+              "HSCAN" : self.hscan,
+              
+              #Sorted sets
+              "ZADD" : self.zadd,
+              "ZREM" : self.zrem,
+              "ZSCORE" : self.zscore,
+              "ZRANK" : self.zrank,
+              "ZREVRANK" : self.zrevrank,
+              "ZCARD" : self.zcard,
+              "ZRANGE" : self.zrange,
+              "ZRANGEBYSCORE" : self.zrangebyscore,
+              "ZCOUNT" : self.zcount,
+              "ZINCRBY" : self.zincrby,
+              "ZPOPMIN" : self.zpopmin,
+              "ZPOPMAX" : self.zpopmax,
+              
+              #Sets
+              "SADD" : self.sadd,
+              "SREM" : self.srem,
+              "SISMEMBER" : self.sismember,
+              "SMISMEMBER" : self.smismember,
+              "SMEMBERS" : self.smembers,
+              "SCARD" : self.scard,
+              "SPOP" : self.spop,
+              "SRANDMEMBER" : self.srandmember,
+              "SINTER" : self.sinter,
+              "SUNION" : self.sunion,
+              "SDIFF" : self.sdiff,
+              "SINTERSTORE" : self.sinterstore,
+              "SUNIONSTORE" : self.sunionstore,
+              "SDIFFSTORE" : self.sdiffstore,
+              "SSCAN" : self.sscan,
+              
+              "OBJECT" : self.object_command,
               
               #Persistence commands
               "BGREWRITEAOF" :  self.bgrewriteaof,
+              "SAVE" : self.save,
+              "BGSAVE" : self.bgsave,
+              "LASTSAVE" : self.lastsave,
               "CONFIG" : self.config_command,
               "DEBUG" : self.debug_command,
               
@@ -33,12 +231,83 @@ class CommandHandler:
         }
     def execute(self, command, *args):
         self.command_count += 1
-        cmd = self.commands.get(command.upper())
+        name = command.upper()
+        cmd = self.commands.get(name)
         if cmd:
-            if self.persistence_manager:
-                self.persistence_manager.log_write_command(command, *args)
-            return cmd(*args)
+            if self.persistence_manager and self.persistence_manager.loading and name not in LOADING_OK_COMMANDS:
+                return b"-LOADING Redis is loading the dataset in memory\r\n"
+            if name in WRITE_COMMANDS and self.replication is not None and self.replication.is_replica:
+                return b"-READONLY You can't write against a read only replica.\r\n"
+            #Evict before writes so the limit is honoured, refuse if impossible
+            if name in DENYOOM_COMMANDS and not self.evictor.free_memory_if_needed():
+                return b"-OOM command not allowed when used memory > 'maxmemory'.\r\n"
+            self._propagate = None
+            try:
+                reply = cmd(*args)
+            except WrongTypeError:
+                return wrongtype()
+            #Failed commands changed nothing and are not logged
+            if name in WRITE_COMMANDS and reply[:1] != b"-":
+                if self._propagate is None:
+                    self._log_write(name, *args)
+                else:
+                    for propagated in self._propagate:
+                        self._log_write(*propagated)
+            return reply
         return errorm(f"unknown command '{command}'")
+    def _evicted(self, key):
+        #Logged like a client DEL, a restart or a replica would keep the key otherwise
+        self._log_write("DEL", key)
+    def _log_write(self, *args):
+        """Propagate a write to the AOF and the replicas"""
+        if self.persistence_manager:
+            self.persistence_manager.log_write_command(*args)
+        if self.replication is not None:
+            self.replication.feed(args)
+    def execute_replicated(self, command, *args):
+        """
+        Run a command streamed by the master: no read-only or maxmemory
+        check, logged to the AOF as received
+        """
+        name = command.upper()
+        cmd = self.commands.get(name)
+        if cmd is None:
+            return errorm(f"unknown command '{command}'")
+        try:
+            reply = cmd(*args)
+        except WrongTypeError:
+            return wrongtype()
+        if self.persistence_manager and name in WRITE_COMMANDS and reply[:1] != b"-":
+            self.persistence_manager.log_write_command(name, *args)
+        return reply
+    def replay(self, command, *args):
+        """Run a command read back from the AOF: no logging, no maxmemory check"""
+        cmd = self.commands.get(command.upper())
+        if cmd is None:
+            return errorm(f"unknown command '{command}'")
+        try:
+            return cmd(*args)
+        except WrongTypeError:
+            return wrongtype()
+    def get_keys(self, command, args):
+        """Key arguments of a command, empty for keyless commands"""
+        spec = KEY_SPECS.get(command.upper())
+        if not spec or not args:
+            return []
+        first, last, step = spec
+        if last < 0:
+            last = len(args) + last
+        return list(args[first:last + 1:step])
+    def _get_typed(self, key, value_type):
+        """Value of key, None when missing, WrongTypeError for another type"""
+        value = self.storage.get(key)
+        if value is not None and not isinstance(value, value_type):
+            raise WrongTypeError(key)
+        return value
+    def _encoding_config(self, name, default):
+        if self.persistence_manager:
+            return int(self.persistence_manager.config.get(name, default))
+        return default
     def ping(self):
         return pong()
     def echo(self,  * args):
@@ -47,20 +316,134 @@ class CommandHandler:
         if(len(args) < 2):
             return  errorm("wrong number of arguments for 'set' command")
         key = args[0]
-        value=  " ".join(args[1:])
+        #Arguments are binary safe, the value is exactly one argument
+        value = args[1]
         expiry_time = None
-        if len(args) >= 4 and args[-2].upper() == "EX":
+        if len(args) == 4 and args[2].upper() in ("EX", "PXAT"):
             try:
-                seconds = int(args[-1])
-                expiry_time = time.time() + seconds
-                value =  " ".join(args[1:-2])
+                number = int(args[3])
             except ValueError:
                 return errorm("invalid expire time")
+            if number <= 0:
+                return errorm("invalid expire time in 'set' command")
+            if args[2].upper() == "EX":
+                expiry_time = time.time() + number
+                #Logged with the absolute deadline so a replay keeps it
+                self._propagate = [("SET", key, value, "PXAT", str(int(expiry_time * 1000)))]
+            else:
+                expiry_time = number / 1000
+        elif len(args) != 2:
+            return errorm("syntax error")
+        self.storage.set(key, self._string_value(value), expiry_time)
         return ok()
+    def _string_value(self, value):
+        """Strings that are canonical 64-bit integers are kept as int"""
+        number = canonical_int(value)
+        return value if number is None else number
     def get(self, *args):
         if len(args) != 1:
             return errorm("wrong number of arguments for 'get' command")
         return bulk_string(self.storage.get(args[0]))
+    def mget(self, *args):
+        if not args:
+            return errorm("wrong number of arguments for 'mget' command")
+        get = self.storage.get
+        replies = []
+        for key in args:
+            value = get(key)
+            #Keys holding another type read as missing, like Redis
+            replies.append(bulk_string(value if type(value) in (str, int) else None))
+        return array(replies)
+    def mset(self, *args):
+        if not args or len(args) % 2:
+            return errorm("wrong number of arguments for 'mset' command")
+        self._set_pairs(args)
+        return ok()
+    def msetnx(self, *args):
+        if not args or len(args) % 2:
+            return errorm("wrong number of arguments for 'msetnx' command")
+        if self.storage.exists(*args[::2]):
+            return integar(0)
+        self._set_pairs(args)
+        return integar(1)
+    def _set_pairs(self, args):
+        store = self.storage.set
+        for index in range(0, len(args), 2):
+            store(args[index], self._string_value(args[index + 1]))
+    def incr(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'incr' command")
+        return self._incr_by(args[0], 1)
+    def decr(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'decr' command")
+        return self._incr_by(args[0], -1)
+    def incrby(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'incrby' command")
+        increment = canonical_int(args[1])
+        if increment is None:
+            return errorm("value is not an integer or out of range")
+        return self._incr_by(args[0], increment)
+    def decrby(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'decrby' command")
+        decrement = canonical_int(args[1])
+        if decrement is None:
+            return errorm("value is not an integer or out of range")
+        return self._incr_by(args[0], -decrement)
+    def _incr_by(self, key, increment):
+        value = self._get_typed(key, (int, str))
+        if value is None:
+            current = 0
+        elif type(value) is int:
+            current = value
+        else:
+            current = canonical_int(value)
+            if current is None:
+                return errorm("value is not an integer or out of range")
+        number = current + increment
+        if not -2 ** 63 <= number < 2 ** 63:
+            return errorm("increment or decrement would overflow")
+        if value is None:
+            self.storage.set(key, number)
+        else:
+            #INCR keeps the TTL of the key
+            self.storage.update(key, number)
+        return integar(number)
+    def incrbyfloat(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'incrbyfloat' command")
+        increment = self._parse_float(args[1])
+        if increment is None:
+            return errorm("value is not a valid float")
+        key = args[0]
+        value = self._get_typed(key, (int, str))
+        current = 0.0
+        if value is not None:
+            current = self._parse_float(value) if type(value) is str else value
+            if current is None:
+                return errorm("value is not a valid float")
+        number = current + increment
+        if math.isnan(number) or math.isinf(number):
+            return errorm("increment would produce NaN or Infinity")
+        result = format_double(float(number))
+        if value is None:
+            self.storage.set(key, self._string_value(result))
+        else:
+            self.storage.update(key, self._string_value(result))
+        return bulk_string(result)
+    def append(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'append' command")
+        key = args[0]
+        value = self._get_typed(key, (int, str))
+        if value is None:
+            self.storage.set(key, self._string_value(args[1]))
+            return integar(len(encode_arg(args[1])))
+        result = str(value) + args[1]
+        self.storage.update(key, result)
+        return integar(len(encode_arg(result)))
     def delete(self,*args):
         if not args:
             return errorm("wrong number of arguments for 'del' command")
@@ -76,99 +459,881 @@ class CommandHandler:
             return array([])
         return array([bulk_string(key) for key in keys])
     
+    def scan(self, *args):
+        if not args:
+            return errorm("wrong number of arguments for 'scan' command")
+        try:
+            cursor = int(args[0])
+        except ValueError:
+            return errorm("invalid cursor")
+        options = self._parse_scan_options(args[1:], allow_type=True)
+        if isinstance(options, bytes):
+            return options
+        pattern, count, type_name = options
+        next_cursor, keys = self.storage.scan(cursor, count, pattern, type_name)
+        return array([bulk_string(str(next_cursor)), array([bulk_string(key) for key in keys])])
+    def dbsize(self, *args):
+        if args:
+            return errorm("wrong number of arguments for 'dbsize' command")
+        return integar(self.storage.dbsize())
+    
     def flushall(self,*args):
        self.storage.flush()
+       return ok()
     
     def persist(self, *args):
-        if(len(args) != 2):
-            return  errorm("wrong number of arguments for 'expire' command")
-        success = self.storage.persist(args[1])
+        if(len(args) != 1):
+            return  errorm("wrong number of arguments for 'persist' command")
+        success = self.storage.persist(args[0])
         return integar(1 if success else 0)
        
     def expire(self, *args):
         if(len(args) != 2):
          return  errorm("wrong number of arguments for 'expire' command")
         try:
-         seconds = int(args[1]) + time.time()
-         if seconds <= 0:
-             return integar(0)
-         success =self.storage.expire(args[0], seconds)
-         return integar(1 if success else 0)
+         seconds = int(args[1])
         except ValueError as e:
             return errorm("invalid expire time")
+        deadline = time.time() + seconds
+        success =self.storage.expire_at(args[0], deadline)
+        #Logged with the absolute deadline so a replay keeps it
+        self._propagate = [("PEXPIREAT", args[0], str(int(deadline * 1000)))] if success else []
+        return integar(1 if success else 0)
     def expireat(self, *args):
         if(len(args) != 2):
           return  errorm("wrong number of arguments for 'expireat' command")
         try:
-         time_stamp = args[1]
-         
-         if time_stamp <= time.time():
-             return integar(0)
-         success = self.storage.expire(args[0], time_stamp)
-         return integar(1 if success else 0)
+         time_stamp = int(args[1])
+        except ValueError as e:
+            return errorm("invalid timestamp")
+        success = self.storage.expire_at(args[0], time_stamp)
+        return integar(1 if success else 0)
+    def pexpireat(self, *args):
+        if(len(args) != 2):
+          return  errorm("wrong number of arguments for 'pexpireat' command")
+        try:
+         milliseconds = int(args[1])
         except ValueError as e:
             return errorm("invalid timestamp")
+        success = self.storage.expire_at(args[0], milliseconds / 1000)
+        return integar(1 if success else 0)
         
     def ttl(self, *args):
         if(len(args) != 1):
              return  errorm("wrong number of arguments for 'TTL' command")
-        value = self.storage.ttl(args[0])
-        if value == -2:
-            return simple_string("Key has expired: {args[0]}")
-        elif value == -1:
-            return simple_string("No expiration set for the key: {args[1]}")
-        return integar(value)
+        #-2 when the key does not exist, -1 when it has no expiry
+        return integar(self.storage.ttl(args[0]))
     
     def pttl(self, *args):
         if(len(args) != 1):
              return  errorm("wrong number of arguments for 'PTTL' command")
-        value = self.storage.ttl(args[0])
-        if value == -2:
-            return simple_string("Key has expired: {args[0]}")
-        elif value == -1:
-            return simple_string("No expiration set for the key: {args[1]}")
-        return integar(value)
+        return integar(self.storage.pttl(args[0]))
         
     def  info(self, *args):
         memory_usage = self.storage.get_memory_usage()
-        key_count = len(self.storage.keys())
+        key_count = self.storage.dbsize()
+        expire_stats = self.storage.stats
         info = {
             "server" :{
                  "redis_version": "7.0.0-custom",
                 "redis_mode": "standalone",
-                "uptime_in_seconds" :  int(time.time())
+                "uptime_in_seconds" :  int(time.time() - self.start_time)
             },
              "stats": {
-                "total_commands_processed": 0,  # Would track this in server
+                "total_commands_processed": self.command_count,
                 "keyspace_hits" : 0,
-                 "keyspace_missed" :0
+                 "keyspace_missed" :0,
+                "expired_keys" : expire_stats["expired_keys"],
+                "expired_stale_perc" : f"{expire_stats['expired_stale_perc'] * 100:.2f}",
+                "expired_time_cap_reached_count" : expire_stats["expired_time_cap_reached_count"],
+                "expire_cycle_cpu_milliseconds" : int(expire_stats["expire_cycle_cpu_milliseconds"]),
+                "evicted_keys" : self.evictor.evicted_keys,
             },
             "memory":{
                 "used_memory": memory_usage,
-                "used_memory_human": self.format_bytes(memory_usage)
+                "used_memory_human": self.format_bytes(memory_usage),
+                "maxmemory": self.evictor.maxmemory,
+                "maxmemory_human": self.format_bytes(self.evictor.maxmemory),
+                "maxmemory_policy": self.evictor.policy
             },
             "keyspace": {
-                "db0": f"keys={len(self.storage.keys())},expires=0"
+                "db0": f"keys={key_count},expires={self.storage.expires_count()}"
             }
             
         }
         if  self.persistence_manager:
             persistence_stats = self.persistence_manager.get_stats()
+            loading_stats = persistence_stats.get('loading', {})
             info["persistence"] = {
+                "loading" : int(loading_stats.get('loading', False)),
                 "aof_enabled" : int(persistence_stats.get('aof_enabled', False)),
                 "aof_last_sync_time" : persistence_stats.get('last_aof_sync_time', 0),
-                "aof_filename" : persistence_stats.get('aof_filename',' ')
+                "aof_filename" : persistence_stats.get('aof_filename',' '),
+                "aof_last_write_status" : persistence_stats.get('aof_last_write_status', 'ok'),
+                "aof_pending_bytes" : persistence_stats.get('aof_pending_bytes', 0),
+                "aof_delayed_fsync" : persistence_stats.get('aof_delayed_fsync', 0),
+                "aof_rewrite_in_progress" : int(persistence_stats.get('aof_rewrite_in_progress', False)),
+                "aof_rewrite_scheduled" : int(persistence_stats.get('aof_rewrite_scheduled', False)),
+                "aof_last_rewrite_time_sec" : persistence_stats.get('aof_last_rewrite_time_sec', -1),
+                "aof_current_rewrite_time_sec" : persistence_stats.get('aof_current_rewrite_time_sec', -1),
+                "aof_last_bgrewrite_status" : persistence_stats.get('aof_last_bgrewrite_status', 'ok'),
+                "aof_rewrites" : persistence_stats.get('aof_rewrites', 0),
+                "aof_current_size" : persistence_stats.get('aof_current_size', 0),
+                "aof_base_size" : persistence_stats.get('aof_base_size', 0),
+                "rdb_changes_since_last_save" : persistence_stats.get('changes_since_last_save', 0),
+                "rdb_bgsave_in_progress" : int(persistence_stats.get('bgsave_in_progress', False)),
+                "rdb_last_save_time" : persistence_stats.get('last_save_time', 0),
+                "rdb_last_bgsave_status" : persistence_stats.get('last_bgsave_status', 'ok'),
+                "rdb_last_bgsave_time_sec" : persistence_stats.get('last_bgsave_time_sec', -1),
             }
+            if loading_stats.get('loading'):
+                info["persistence"].update({
+                    "loading_start_time" : loading_stats['loading_start_time'],
+                    "loading_total_bytes" : loading_stats['loading_total_bytes'],
+                    "loading_loaded_bytes" : loading_stats['loading_loaded_bytes'],
+                    "loading_loaded_perc" : f"{loading_stats['loading_loaded_perc']:.2f}",
+                    "loading_eta_seconds" : loading_stats['loading_eta_seconds'],
+                })
+        if self.replication is not None:
+            info["replication"] = self.replication.info()
+        wanted = args[0].lower() if args else "all"
         sections = []
         for  section,data in info.items():
-            sections.append(f"#{section}")
+            if wanted not in ("all", "everything", "default", section):
+                continue
+            sections.append(f"# {section.capitalize()}")
             sections.extend(f"{k}:{v}" for k,v in data.items())
-            return bulk_string("\n".join(section))
-    def get_type(self,*args):
+            sections.append("")
+        return bulk_string("\r\n".join(sections))
+    def lpush(self, *args):
+        return self._push(args, "lpush", head=True)
+    def rpush(self, *args):
+        return self._push(args, "rpush", head=False)
+    def _push(self, args, name, head):
+        if len(args) < 2:
+            return errorm(f"wrong number of arguments for '{name}' command")
+        key = args[0]
+        quicklist = self._get_typed(key, QuickList)
+        created = quicklist is None
+        if created:
+            quicklist = QuickList(self._encoding_config('list_max_listpack_size', -2))
+        else:
+            size_before = quicklist.memory_usage()
+        push = quicklist.push_head if head else quicklist.push_tail
+        for value in args[1:]:
+            push(value)
+        if created:
+            self.storage.set(key, quicklist)
+        else:
+            self.storage.container_changed(key, size_before)
+        return integar(len(quicklist))
+    def lpop(self, *args):
+        return self._pop(args, "lpop", head=True)
+    def rpop(self, *args):
+        return self._pop(args, "rpop", head=False)
+    def _pop(self, args, name, head):
+        if len(args) not in (1, 2):
+            return errorm(f"wrong number of arguments for '{name}' command")
+        count = None
+        if len(args) == 2:
+            try:
+                count = int(args[1])
+            except ValueError:
+                return errorm("value is out of range, must be positive")
+            if count < 0:
+                return errorm("value is out of range, must be positive")
+        key = args[0]
+        quicklist = self._get_typed(key, QuickList)
+        if quicklist is None:
+            return null_array() if count is not None else null_bulk_string()
+        size_before = quicklist.memory_usage()
+        pop = quicklist.pop_head if head else quicklist.pop_tail
+        if count is None:
+            values = [pop()]
+        else:
+            values = [pop() for _ in range(min(count, len(quicklist)))]
+        self.storage.container_changed(key, size_before)
+        if count is None:
+            return bulk_string(values[0])
+        return array([bulk_string(value) for value in values])
+    def lrange(self, *args):
+        if len(args) != 3:
+            return errorm("wrong number of arguments for 'lrange' command")
+        try:
+            start, stop = int(args[1]), int(args[2])
+        except ValueError:
+            return errorm("value is not an integer or out of range")
+        quicklist = self._get_typed(args[0], QuickList)
+        if quicklist is None:
+            return array([])
+        return array([bulk_string(value) for value in quicklist.range(start, stop)])
+    def llen(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'llen' command")
+        quicklist = self._get_typed(args[0], QuickList)
+        return integar(len(quicklist) if quicklist is not None else 0)
+    def lindex(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'lindex' command")
+        try:
+            index = int(args[1])
+        except ValueError:
+            return errorm("value is not an integer or out of range")
+        quicklist = self._get_typed(args[0], QuickList)
+        if quicklist is None:
+            return null_bulk_string()
+        return bulk_string(quicklist.index(index))
+    def lset(self, *args):
+        if len(args) != 3:
+            return errorm("wrong number of arguments for 'lset' command")
+        try:
+            index = int(args[1])
+        except ValueError:
+            return errorm("value is not an integer or out of range")
+        key = args[0]
+        quicklist = self._get_typed(key, QuickList)
+        if quicklist is None:
+            return errorm("no such key")
+        size_before = quicklist.memory_usage()
+        if not quicklist.set(index, args[2]):
+            return errorm("index out of range")
+        self.storage.container_changed(key, size_before)
+        return ok()
+    def ltrim(self, *args):
+        if len(args) != 3:
+            return errorm("wrong number of arguments for 'ltrim' command")
+        try:
+            start, stop = int(args[1]), int(args[2])
+        except ValueError:
+            return errorm("value is not an integer or out of range")
+        key = args[0]
+        quicklist = self._get_typed(key, QuickList)
+        if quicklist is not None:
+            size_before = quicklist.memory_usage()
+            quicklist.trim(start, stop)
+            self.storage.container_changed(key, size_before)
+        return ok()
+    def linsert(self, *args):
+        if len(args) != 4:
+            return errorm("wrong number of arguments for 'linsert' command")
+        where = args[1].upper()
+        if where not in ("BEFORE", "AFTER"):
+            return errorm("syntax error")
+        key = args[0]
+        quicklist = self._get_typed(key, QuickList)
+        if quicklist is None:
+            return integar(0)
+        size_before = quicklist.memory_usage()
+        length = quicklist.insert(args[2], args[3], after=where == "AFTER")
+        if length > 0:
+            self.storage.container_changed(key, size_before)
+        return integar(length)
+    def hset(self, *args):
+        if len(args) < 3 or len(args) % 2 == 0:
+            return errorm("wrong number of arguments for 'hset' command")
+        key = args[0]
+        hash_value = self._get_typed(key, Hash)
+        created = hash_value is None
+        if created:
+            hash_value = Hash()
+        else:
+            size_before = hash_value.memory_usage()
+        max_entries = self._encoding_config('hash_max_listpack_entries', 128)
+        max_value = self._encoding_config('hash_max_listpack_value', 64)
+        added = 0
+        for index in range(1, len(args), 2):
+            if hash_value.set(args[index], args[index + 1], max_entries, max_value):
+                added += 1
+        if created:
+            self.storage.set(key, hash_value)
+        else:
+            self.storage.container_changed(key, size_before)
+        return integar(added)
+    def hget(self, *args):
         if len(args) != 2:
+            return errorm("wrong number of arguments for 'hget' command")
+        hash_value = self._get_typed(args[0], Hash)
+        if hash_value is None:
+            return null_bulk_string()
+        return bulk_string(hash_value.get(args[1]))
+    def hmget(self, *args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'hmget' command")
+        hash_value = self._get_typed(args[0], Hash)
+        if hash_value is None:
+            return array([null_bulk_string()] * (len(args) - 1))
+        return array([bulk_string(hash_value.get(field)) for field in args[1:]])
+    def hdel(self, *args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'hdel' command")
+        key = args[0]
+        hash_value = self._get_typed(key, Hash)
+        if hash_value is None:
+            return integar(0)
+        size_before = hash_value.memory_usage()
+        deleted = sum(1 for field in args[1:] if hash_value.delete(field))
+        self.storage.container_changed(key, size_before)
+        return integar(deleted)
+    def hgetall(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'hgetall' command")
+        hash_value = self._get_typed(args[0], Hash)
+        if hash_value is None:
+            return array([])
+        items = []
+        for field, value in hash_value.items():
+            items.append(bulk_string(field))
+            items.append(bulk_string(value))
+        return array(items)
+    def hincrby(self, *args):
+        if len(args) != 3:
+            return errorm("wrong number of arguments for 'hincrby' command")
+        increment = canonical_int(args[2])
+        if increment is None:
+            return errorm("value is not an integer or out of range")
+        key = args[0]
+        hash_value = self._get_typed(key, Hash)
+        current = hash_value.get(args[1]) if hash_value is not None else None
+        number = canonical_int(current) if current is not None else 0
+        if number is None:
+            return errorm("hash value is not an integer")
+        number += increment
+        if not -2 ** 63 <= number < 2 ** 63:
+            return errorm("increment or decrement would overflow")
+        self.hset(key, args[1], str(number))
+        return integar(number)
+    def hlen(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'hlen' command")
+        hash_value = self._get_typed(args[0], Hash)
+        return integar(len(hash_value) if hash_value is not None else 0)
+    def hexists(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'hexists' command")
+        hash_value = self._get_typed(args[0], Hash)
+        return integar(1 if hash_value is not None and args[1] in hash_value else 0)
+    def hscan(self, *args):
+        return self._scan_container(args, "hscan", Hash)
+    def sscan(self, *args):
+        return self._scan_container(args, "sscan", Set)
+    def _scan_container(self, args, name, value_type):
+        if len(args) < 2:
+            return errorm(f"wrong number of arguments for '{name}' command")
+        try:
+            cursor = int(args[1])
+        except ValueError:
+            return errorm("invalid cursor")
+        options = self._parse_scan_options(args[2:])
+        if isinstance(options, bytes):
+            return options
+        pattern, count, _ = options
+        value = self._get_typed(args[0], value_type)
+        if value is None:
+            return array([bulk_string("0"), array([])])
+        if value.encoding in ('listpack', 'intset'):
+            #Compact encodings are returned whole, like Redis does
+            next_cursor, batch = 0, list(value.items() if value_type is Hash else value)
+        else:
+            next_cursor, batch = value.scan(cursor, count)
+        reply = []
+        for element in batch:
+            member = element[0] if value_type is Hash else element
+            if pattern is not None and not fnmatch.fnmatchcase(member, pattern):
+                continue
+            reply.append(bulk_string(member))
+            if value_type is Hash:
+                reply.append(bulk_string(element[1]))
+        return array([bulk_string(str(next_cursor)), array(reply)])
+    def _parse_scan_options(self, options, allow_type = False):
+        """(pattern, count, type) from MATCH/COUNT/TYPE arguments, an error reply if invalid"""
+        pattern, count, type_name = None, 10, None
+        if len(options) % 2:
+            return errorm("syntax error")
+        for index in range(0, len(options), 2):
+            option, value = options[index].upper(), options[index + 1]
+            if option == "MATCH":
+                pattern = None if value == "*" else value
+            elif option == "COUNT":
+                try:
+                    count = int(value)
+                except ValueError:
+                    return errorm("value is not an integer or out of range")
+                if count < 1:
+                    return errorm("syntax error")
+            elif option == "TYPE" and allow_type:
+                type_name = value.lower()
+            else:
+                return errorm("syntax error")
+        return pattern, count, type_name
+    def _parse_float(self, text):
+        """float of a score argument, None when it is not a valid float"""
+        try:
+            value = float(text)
+        except ValueError:
+            return None
+        return None if math.isnan(value) else value
+    def _parse_score_bound(self, text):
+        """(score, exclusive) of a ZRANGEBYSCORE style bound such as (1.5 or -inf"""
+        exclusive = text.startswith("(")
+        score = self._parse_float(text[1:] if exclusive else text)
+        return None if score is None else (score, exclusive)
+    def _parse_lex_bound(self, text):
+        """'-', '+' or (member, exclusive) of a BYLEX bound, None when invalid"""
+        if text in ("-", "+"):
+            return text
+        if text[:1] in ("(", "["):
+            return (text[1:], text[0] == "(")
+        return None
+    def zadd(self, *args):
+        if len(args) < 3:
+            return errorm("wrong number of arguments for 'zadd' command")
+        flags = set()
+        index = 1
+        while index < len(args) and args[index].upper() in ("NX", "XX", "GT", "LT", "CH", "INCR"):
+            flags.add(args[index].upper())
+            index += 1
+        pairs = args[index:]
+        if not pairs or len(pairs) % 2:
+            return errorm("syntax error")
+        if "NX" in flags and "XX" in flags:
+            return errorm("XX and NX options at the same time are not compatible")
+        if "NX" in flags and ("GT" in flags or "LT" in flags) or "GT" in flags and "LT" in flags:
+            return errorm("GT, LT, and/or NX options at the same time are not compatible")
+        incr = "INCR" in flags
+        if incr and len(pairs) != 2:
+            return errorm("INCR option supports a single increment-element pair")
+        scores = []
+        for position in range(0, len(pairs), 2):
+            score = self._parse_float(pairs[position])
+            if score is None:
+                return errorm("value is not a valid float")
+            scores.append((score, pairs[position + 1]))
+        key = args[0]
+        zset = self._get_typed(key, ZSet)
+        created = zset is None
+        if created:
+            zset = ZSet()
+        else:
+            size_before = zset.memory_usage()
+        max_entries = self._encoding_config('zset_max_listpack_entries', 128)
+        max_value = self._encoding_config('zset_max_listpack_value', 64)
+        added = changed = 0
+        result = None
+        for score, member in scores:
+            current = zset.score(member)
+            if current is None:
+                if "XX" in flags:
+                    continue
+                zset.add(member, score, max_entries, max_value)
+                added += 1
+                result = score
+                continue
+            if "NX" in flags:
+                continue
+            new_score = current + score if incr else score
+            if math.isnan(new_score):
+                return errorm("resulting score is not a number (NaN)")
+            if "GT" in flags and new_score <= current or "LT" in flags and new_score >= current:
+                continue
+            result = new_score
+            if new_score != current:
+                zset.add(member, new_score, max_entries, max_value)
+                changed += 1
+        if created:
+            if len(zset):
+                self.storage.set(key, zset)
+        else:
+            self.storage.container_changed(key, size_before)
+        if incr:
+            return bulk_string(None if result is None else format_double(result))
+        return integar(added + changed if "CH" in flags else added)
+    def zincrby(self, *args):
+        if len(args) != 3:
+            return errorm("wrong number of arguments for 'zincrby' command")
+        return self.zadd(args[0], "INCR", args[1], args[2])
+    def zrem(self, *args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'zrem' command")
+        key = args[0]
+        zset = self._get_typed(key, ZSet)
+        if zset is None:
+            return integar(0)
+        size_before = zset.memory_usage()
+        removed = sum(1 for member in args[1:] if zset.remove(member))
+        self.storage.container_changed(key, size_before)
+        return integar(removed)
+    def zscore(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'zscore' command")
+        zset = self._get_typed(args[0], ZSet)
+        score = zset.score(args[1]) if zset is not None else None
+        return bulk_string(None if score is None else format_double(score))
+    def zcard(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'zcard' command")
+        zset = self._get_typed(args[0], ZSet)
+        return integar(len(zset) if zset is not None else 0)
+    def zrank(self, *args):
+        return self._zrank(args, "zrank", reverse=False)
+    def zrevrank(self, *args):
+        return self._zrank(args, "zrevrank", reverse=True)
+    def _zrank(self, args, name, reverse):
+        if len(args) not in (2, 3):
+            return errorm(f"wrong number of arguments for '{name}' command")
+        withscore = len(args) == 3
+        if withscore and args[2].upper() != "WITHSCORE":
+            return errorm("syntax error")
+        zset = self._get_typed(args[0], ZSet)
+        rank = zset.rank(args[1]) if zset is not None else None
+        if rank is None:
+            return null_array() if withscore else null_bulk_string()
+        if reverse:
+            rank = len(zset) - 1 - rank
+        if withscore:
+            return array([integar(rank), bulk_string(format_double(zset.score(args[1])))])
+        return integar(rank)
+    def zrange(self, *args):
+        if len(args) < 3:
+            return errorm("wrong number of arguments for 'zrange' command")
+        by, reverse, withscores, limit = "RANK", False, False, None
+        index = 3
+        while index < len(args):
+            option = args[index].upper()
+            if option in ("BYSCORE", "BYLEX"):
+                by = option[2:]
+            elif option == "REV":
+                reverse = True
+            elif option == "WITHSCORES":
+                withscores = True
+            elif option == "LIMIT" and index + 2 < len(args):
+                limit = (args[index + 1], args[index + 2])
+                index += 2
+            else:
+                return errorm("syntax error")
+            index += 1
+        if limit is not None and by == "RANK":
+            return errorm("syntax error, LIMIT is only supported in combination with either BYSCORE or BYLEX")
+        if withscores and by == "LEX":
+            return errorm("syntax error, WITHSCORES not supported in combination with BYLEX")
+        return self._zrange(args[0], args[1], args[2], by, reverse, withscores, limit)
+    def zrangebyscore(self, *args):
+        if len(args) < 3:
+            return errorm("wrong number of arguments for 'zrangebyscore' command")
+        withscores, limit = False, None
+        index = 3
+        while index < len(args):
+            option = args[index].upper()
+            if option == "WITHSCORES":
+                withscores = True
+            elif option == "LIMIT" and index + 2 < len(args):
+                limit = (args[index + 1], args[index + 2])
+                index += 2
+            else:
+                return errorm("syntax error")
+            index += 1
+        return self._zrange(args[0], args[1], args[2], "SCORE", False, withscores, limit)
+    def _zrange(self, key, start, stop, by, reverse, withscores, limit):
+        offset, count = 0, -1
+        if limit is not None:
+            try:
+                offset, count = int(limit[0]), int(limit[1])
+            except ValueError:
+                return errorm("value is not an integer or out of range")
+        if by == "RANK":
+            try:
+                start, stop = int(start), int(stop)
+            except ValueError:
+                return errorm("value is not an integer or out of range")
+        elif by == "SCORE":
+            start, stop = self._parse_score_bound(start), self._parse_score_bound(stop)
+            if start is None or stop is None:
+                return errorm("min or max is not a float")
+        else:
+            start, stop = self._parse_lex_bound(start), self._parse_lex_bound(stop)
+            if start is None or stop is None:
+                return errorm("min or max not valid string range item")
+        zset = self._get_typed(key, ZSet)
+        if zset is None:
+            return array([])
+        size = len(zset)
+        if by == "RANK":
+            if start < 0:
+                start += size
+            if stop < 0:
+                stop += size
+            start, stop = max(start, 0), min(stop, size - 1) + 1
+            if reverse:
+                start, stop = size - stop, size - start
+        else:
+            #REV takes the bounds as max then min
+            minimum, maximum = (stop, start) if reverse else (start, stop)
+            if by == "SCORE":
+                start, stop = zset.score_range(minimum, maximum)
+            elif minimum == "+" or maximum == "-":
+                start, stop = 0, 0
+            else:
+                start, stop = zset.lex_range(None if minimum == "-" else minimum,
+                                             None if maximum == "+" else maximum)
+            if offset < 0:
+                return array([])
+            if reverse:
+                stop -= offset
+                if count >= 0:
+                    start = max(start, stop - count)
+            else:
+                start += offset
+                if count >= 0:
+                    stop = min(stop, start + count)
+        pairs = zset.slice(start, stop)
+        if reverse:
+            pairs.reverse()
+        reply = []
+        for score, member in pairs:
+            reply.append(bulk_string(member))
+            if withscores:
+                reply.append(bulk_string(format_double(score)))
+        return array(reply)
+    def zcount(self, *args):
+        if len(args) != 3:
+            return errorm("wrong number of arguments for 'zcount' command")
+        minimum, maximum = self._parse_score_bound(args[1]), self._parse_score_bound(args[2])
+        if minimum is None or maximum is None:
+            return errorm("min or max is not a float")
+        zset = self._get_typed(args[0], ZSet)
+        if zset is None:
+            return integar(0)
+        start, stop = zset.score_range(minimum, maximum)
+        return integar(max(stop - start, 0))
+    def zpopmin(self, *args):
+        return self._zpop(args, "zpopmin", highest=False)
+    def zpopmax(self, *args):
+        return self._zpop(args, "zpopmax", highest=True)
+    def _zpop(self, args, name, highest):
+        if len(args) not in (1, 2):
+            return errorm(f"wrong number of arguments for '{name}' command")
+        count = 1
+        if len(args) == 2:
+            try:
+                count = int(args[1])
+            except ValueError:
+                return errorm("value is out of range, must be positive")
+            if count < 0:
+                return errorm("value is out of range, must be positive")
+        key = args[0]
+        zset = self._get_typed(key, ZSet)
+        if zset is None:
+            return array([])
+        size_before = zset.memory_usage()
+        popped = zset.pop(count, highest)
+        self.storage.container_changed(key, size_before)
+        reply = []
+        for score, member in popped:
+            reply.append(bulk_string(member))
+            reply.append(bulk_string(format_double(score)))
+        return array(reply)
+    def sadd(self, *args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'sadd' command")
+        key = args[0]
+        set_value = self._get_typed(key, Set)
+        max_intset = self._encoding_config('set_max_intset_entries', 512)
+        if set_value is None:
+            set_value = Set.from_members(args[1:], max_intset)
+            self.storage.set(key, set_value)
+            return integar(len(set_value))
+        size_before = set_value.memory_usage()
+        added = sum(1 for member in args[1:] if set_value.add(member, max_intset))
+        self.storage.container_changed(key, size_before)
+        return integar(added)
+    def srem(self, *args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'srem' command")
+        key = args[0]
+        set_value = self._get_typed(key, Set)
+        if set_value is None:
+            return integar(0)
+        size_before = set_value.memory_usage()
+        removed = sum(1 for member in args[1:] if set_value.remove(member))
+        self.storage.container_changed(key, size_before)
+        return integar(removed)
+    def sismember(self, *args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'sismember' command")
+        set_value = self._get_typed(args[0], Set)
+        return integar(1 if set_value is not None and args[1] in set_value else 0)
+    def smismember(self, *args):
+        if len(args) < 2:
+            return errorm("wrong number of arguments for 'smismember' command")
+        set_value = self._get_typed(args[0], Set)
+        return array([integar(1 if set_value is not None and member in set_value else 0) for member in args[1:]])
+    def smembers(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'smembers' command")
+        set_value = self._get_typed(args[0], Set)
+        if set_value is None:
+            return array([])
+        return array([bulk_string(member) for member in set_value])
+    def scard(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'scard' command")
+        set_value = self._get_typed(args[0], Set)
+        return integar(len(set_value) if set_value is not None else 0)
+    def spop(self, *args):
+        if len(args) not in (1, 2):
+            return errorm("wrong number of arguments for 'spop' command")
+        count = None
+        if len(args) == 2:
+            try:
+                count = int(args[1])
+            except ValueError:
+                return errorm("value is out of range, must be positive")
+            if count < 0:
+                return errorm("value is out of range, must be positive")
+        key = args[0]
+        set_value = self._get_typed(key, Set)
+        if set_value is None:
+            return array([]) if count is not None else null_bulk_string()
+        size_before = set_value.memory_usage()
+        popped = set_value.pop(1 if count is None else count)
+        self.storage.container_changed(key, size_before)
+        #The members are picked at random, a replay must remove the same ones
+        self._propagate = [("SREM", key, *popped)] if popped else []
+        if count is None:
+            return bulk_string(popped[0])
+        return array([bulk_string(member) for member in popped])
+    def srandmember(self, *args):
+        if len(args) not in (1, 2):
+            return errorm("wrong number of arguments for 'srandmember' command")
+        count = None
+        if len(args) == 2:
+            try:
+                count = int(args[1])
+            except ValueError:
+                return errorm("value is not an integer or out of range")
+        set_value = self._get_typed(args[0], Set)
+        if count is None:
+            members = set_value.random_members(1) if set_value is not None else []
+            return bulk_string(members[0] if members else None)
+        if set_value is None:
+            return array([])
+        #A negative count allows the same member to be returned several times
+        members = set_value.random_members(abs(count), distinct=count >= 0)
+        return array([bulk_string(member) for member in members])
+    def _set_operation(self, operation, keys):
+        """Members of the intersection, union or difference of the sets at keys"""
+        sets = [self._get_typed(key, Set) for key in keys]
+        if operation == "inter":
+            if any(set_value is None for set_value in sets):
+                return []
+            #Walk the smallest set and probe the others
+            sets.sort(key=len)
+            smallest, others = sets[0], sets[1:]
+            if smallest.encoding == 'intset':
+                return [str(value) for value in smallest.intset
+                        if all(other.has_int(value) for other in others)]
+            return [member for member in smallest if all(member in other for other in others)]
+        if operation == "union":
+            result = set()
+            for set_value in sets:
+                if set_value is not None:
+                    result.update(set_value)
+            return list(result)
+        first = sets[0]
+        if first is None:
+            return []
+        others = [set_value for set_value in sets[1:] if set_value is not None]
+        return [member for member in first if not any(member in other for other in others)]
+    def _set_operation_command(self, args, operation):
+        if not args:
+            return errorm(f"wrong number of arguments for 's{operation}' command")
+        return array([bulk_string(member) for member in self._set_operation(operation, args)])
+    def _set_operation_store(self, args, operation):
+        if len(args) < 2:
+            return errorm(f"wrong number of arguments for 's{operation}store' command")
+        destination = args[0]
+        members = self._set_operation(operation, args[1:])
+        self.storage.delete(destination)
+        if members:
+            max_intset = self._encoding_config('set_max_intset_entries', 512)
+            self.storage.set(destination, Set.from_members(members, max_intset))
+        return integar(len(members))
+    def sinter(self, *args):
+        return self._set_operation_command(args, "inter")
+    def sunion(self, *args):
+        return self._set_operation_command(args, "union")
+    def sdiff(self, *args):
+        return self._set_operation_command(args, "diff")
+    def sinterstore(self, *args):
+        return self._set_operation_store(args, "inter")
+    def sunionstore(self, *args):
+        return self._set_operation_store(args, "union")
+    def sdiffstore(self, *args):
+        return self._set_operation_store(args, "diff")
+    def object_command(self, *args):
+        if len(args) != 2 or args[0].upper() != "ENCODING":
+            return errorm("OBJECT subcommand must be ENCODING key")
+        value = self.storage.get(args[1])
+        if value is None:
+            return null_bulk_string()
+        encoding = getattr(value, 'encoding', None)
+        if type(value) is int:
+            encoding = "int"
+        elif encoding is None:
+            encoding = "embstr" if len(encode_arg(value)) <= 44 else "raw"
+        return bulk_string(encoding)
+    def get_type(self,*args):
+        if len(args) != 1:
              return  errorm("wrong number of arguments for 'TYPE' command")
-        data_type = self.storage.get_key_data_type(args[1])
+        data_type = self.storage.get_key_data_type(args[0])
         return simple_string(data_type)        
+    def dump(self, *args):
+        if len(args) != 1:
+            return errorm("wrong number of arguments for 'dump' command")
+        value = self.storage.get(args[0])
+        if value is None:
+            return null_bulk_string()
+        return bulk_string(dump_value(value))
+    def restore(self, *args):
+        """RESTORE key ttl payload [REPLACE] [ABSTTL], ttl in milliseconds, 0 for none"""
+        if len(args) < 3:
+            return errorm("wrong number of arguments for 'restore' command")
+        key = args[0]
+        replace = absttl = False
+        for option in args[3:]:
+            option = option.upper()
+            if option == "REPLACE":
+                replace = True
+            elif option == "ABSTTL":
+                absttl = True
+            else:
+                return errorm("syntax error")
+        try:
+            ttl = int(args[1])
+        except ValueError:
+            return errorm("value is not an integer or out of range")
+        if ttl < 0:
+            return errorm("Invalid TTL value, must be >= 0")
+        if not replace and self.storage.exists(key):
+            return b"-BUSYKEY Target key name already exists.\r\n"
+        try:
+            value = restore_value(encode_arg(args[2]), self._encoding_config('list_max_listpack_size', -2))
+        except SnapshotError as e:
+            return errorm(str(e))
+        expiry_time = None
+        if ttl:
+            expiry_time = ttl / 1000 if absttl else time.time() + ttl / 1000
+            if expiry_time <= time.time():
+                #Already expired: nothing to create, an old value is dropped
+                self._propagate = [("DEL", key)] if self.storage.delete(key) else []
+                return ok()
+        self.storage.set(key, value, expiry_time)
+        #Logged with the absolute deadline so a replay keeps it
+        propagated = ["RESTORE", key, "0", args[2], "REPLACE"]
+        if expiry_time is not None:
+            propagated[2] = str(int(expiry_time * 1000))
+            propagated.append("ABSTTL")
+        self._propagate = [propagated]
+        return ok()
     def format_bytes(self, bytes_count):
         for unit in ['B', 'K', 'M', 'G']:
             if bytes_count < 1024:
@@ -179,6 +1344,11 @@ class CommandHandler:
     def bgrewriteaof(self, *args):
         if not self.persistence_manager:
             return errorm("persistence not enabled")
+        if self.persistence_manager.aof_rewrite_child is not None:
+            return errorm("Background append only file rewriting already in progress")
+        if self.persistence_manager.aof_writer and self.persistence_manager.bgsave_child is not None:
+            self.persistence_manager.aof_rewrite_scheduled = True
+            return simple_string("Background append only file rewriting scheduled")
         try:
             success = self.persistence_manager.rewrite_aof_background(self.storage)
             if success:
@@ -187,18 +1357,46 @@ class CommandHandler:
                 return errorm("Background AOF rewrite failed to start")
         except Exception as e:
             return errorm(f"bgrewriteaof error: {e}")
+    def save(self, *args):
+        if args:
+            return errorm("wrong number of arguments for 'save' command")
+        if not self.persistence_manager:
+            return errorm("persistence not enabled")
+        if self.persistence_manager.bgsave_child is not None:
+            return errorm("Background save already in progress")
+        if self.persistence_manager.save(self.storage):
+            return ok()
+        return errorm("snapshot save failed, see the server log")
+    def bgsave(self, *args):
+        if args:
+            return errorm("wrong number of arguments for 'bgsave' command")
+        if not self.persistence_manager:
+            return errorm("persistence not enabled")
+        if self.persistence_manager.bgsave_child is not None:
+            return errorm("Background save already in progress")
+        if self.persistence_manager.aof_rewrite_child is not None:
+            return errorm("Another child process is active (AOF): can't BGSAVE right now")
+        if self.persistence_manager.bgsave(self.storage):
+            return simple_string("Background saving started")
+        return errorm("Background save failed to start")
+    def lastsave(self, *args):
+        if args:
+            return errorm("wrong number of arguments for 'lastsave' command")
+        if not self.persistence_manager:
+            return errorm("persistence not enabled")
+        return integar(self.persistence_manager.lastsave)
     def config_command(self, *args):
         if not args:
             return errorm("wrong number of arguments for 'config' command")
         subcommand = args[0].upper()
         
         if subcommand == 'GET':
-            if len(subcommand) != 2:
+            if len(args) != 2:
                 return errorm("wrong number of arguments for 'GET' command")
             
             parameter = args[1].lower()
             if self.persistence_manager:
-                config_value = self.persistence_manager.get(parameter)
+                config_value = self.persistence_manager.config.get(self._config_name(parameter))
                 if config_value is not None:
                     return array([bulk_string(parameter), bulk_string(str(config_value))])
             return array([])
@@ -206,19 +1404,25 @@ class CommandHandler:
         elif subcommand == 'SET':
             if len(args) != 3:
                     return errorm("wrong number of arguments for 'SET' command")
-            parameter = args[1].lower()
+            parameter = self._config_name(args[1].lower())
             value = args[2]
             if self.persistence_manager:
                 try:
                   if parameter in ['aof_enabled', 'persistence_enabled'] :
                       value = value.lower() in ('true', '1', 'yes', 'on')
                   self.persistence_manager.config.set(parameter, value)
+                  if parameter in MEMORY_CONFIG:
+                      self.evictor.configure(self.persistence_manager.config)
+                      if not self.evictor.free_memory_if_needed():
+                          print("Used memory is above the new maxmemory and nothing can be evicted")
                   return ok()
                 except Exception as e:
                      return errorm(f"config set error: {e}")
             return errorm("Persisntence not enabled")
         else:
             return errorm(f"unknown CONFIG subcommand '{subcommand}'")
+    def _config_name(self, parameter):
+        return CONFIG_ALIASES.get(parameter, parameter.replace('-', '_'))
     def debug_command(self, *args):
         
         """"Debug command for devloper testing"""
@@ -0,0 +1,7 @@
+from .listpack import Listpack
+from .quicklist import QuickList
+from .hash import Hash
+from .zset import ZSet
+from .set import Set
+
+__all__ = ['Listpack', 'QuickList', 'Hash', 'ZSet', 'Set']
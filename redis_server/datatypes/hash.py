@@ -0,0 +1,150 @@
+"""
+Hash type
+
+Small hashes are a listpack of alternating field and value entries, which
+costs a few bytes per field instead of a dict slot and two str objects.
+Lookups scan the listpack, which is cheap at the sizes it is used for.
+A hash with more than hash-max-listpack-entries fields, or a field or
+value longer than hash-max-listpack-value bytes, is converted to a dict
+and stays one. The fields of a dict are also kept in a ScanIndex, the
+order HSCAN walks them in.
+"""
+import sys
+from typing import Iterator, List, Optional, Tuple
+from .listpack import Listpack, encode_entry
+from .scan import ScanIndex
+from ..protocol import decode_arg, encode_arg
+
+
+class Hash(Listpack):
+    """
+    A hash is its own listpack rather than holding one, which saves an
+    object per key; the inherited entry methods are internal to this class
+    """
+    type_name = 'hash'
+    __slots__ = ('table', 'nbytes', 'scan_index')
+
+    def __init__(self):
+        super().__init__()
+        #dict once converted, the listpack is emptied then
+        self.table = None
+        #Size of the field and value objects of the dict encoding
+        self.nbytes = 0
+        #Fields of the dict in HSCAN order
+        self.scan_index = None
+
+    @classmethod
+    def from_table(cls, table: dict) -> 'Hash':
+        """A hashtable encoded hash that takes ownership of table"""
+        hash_value = cls()
+        hash_value.table = table
+        hash_value.nbytes = sum(sys.getsizeof(field) + sys.getsizeof(value) for field, value in table.items())
+        hash_value.scan_index = ScanIndex(table)
+        return hash_value
+
+    @property
+    def encoding(self) -> str:
+        return 'listpack' if self.table is None else 'hashtable'
+
+    def __len__(self) -> int:
+        if self.table is None:
+            return self.count // 2
+        return len(self.table)
+
+    def memory_usage(self) -> int:
+        if self.table is None:
+            return sys.getsizeof(self) + sys.getsizeof(self.data)
+        return (sys.getsizeof(self) + sys.getsizeof(self.table) + self.nbytes
+                + self.scan_index.memory_usage(len(self.table)))
+
+    def _find(self, field_data: bytes):
+        """Spans of the field and value entries in the listpack, None when absent"""
+        data = self.data
+        size = len(field_data)
+        spans = self.spans()
+        for field_span in spans:
+            value_span = next(spans)
+            _, start, end = field_span
+            if end - start == size and data[start:end] == field_data:
+                return field_span, value_span
+        return None
+
+    def get(self, field) -> Optional[str]:
+        if self.table is not None:
+            return self.table.get(field)
+        found = self._find(encode_arg(field))
+        if found is None:
+            return None
+        _, (_, start, end) = found
+        return decode_arg(bytes(self.data[start:end]))
+
+    def __contains__(self, field) -> bool:
+        if self.table is not None:
+            return field in self.table
+        return self._find(encode_arg(field)) is not None
+
+    def set(self, field, value, max_entries: int, max_value: int) -> bool:
+        """Set a field, converting to a dict past the limits. True if it is new"""
+        if self.table is None:
+            field_data, value_data = encode_arg(field), encode_arg(value)
+            if len(field_data) <= max_value and len(value_data) <= max_value:
+                found = self._find(field_data)
+                if found is not None:
+                    _, (value_start, _, _) = found
+                    self.splice(value_start, self.entry_end(value_start), encode_entry(value_data), 0)
+                    return False
+                if self.count // 2 < max_entries:
+                    #A new bytearray is allocated exactly, += would leave
+                    #growth headroom behind in every small hash
+                    self.data = self.data + encode_entry(field_data) + encode_entry(value_data)
+                    self.count += 2
+                    return True
+            self._convert()
+        table = self.table
+        old = table.get(field)
+        table[field] = value
+        if old is None:
+            self.nbytes += sys.getsizeof(field) + sys.getsizeof(value)
+            self.scan_index.add(field)
+            return True
+        self.nbytes += sys.getsizeof(value) - sys.getsizeof(old)
+        return False
+
+    def delete(self, field) -> bool:
+        if self.table is not None:
+            value = self.table.pop(field, None)
+            if value is None:
+                return False
+            self.nbytes -= sys.getsizeof(field) + sys.getsizeof(value)
+            self.scan_index.discard(field)
+            return True
+        found = self._find(encode_arg(field))
+        if found is None:
+            return False
+        (field_start, _, _), (value_start, _, _) = found
+        self.splice(field_start, self.entry_end(value_start), b"", -2)
+        return True
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        if self.table is not None:
+            return iter(self.table.items())
+        values = Listpack.__iter__(self)
+        return zip(values, values)
+
+    def scan(self, cursor: int, count: int) -> Tuple[int, List[Tuple[str, str]]]:
+        """One HSCAN step over a dict encoded hash, (next cursor, pairs)"""
+        next_cursor, fields = self.scan_index.scan(cursor, count)
+        table = self.table
+        return next_cursor, [(field, table[field]) for field in fields]
+
+    def _convert(self) -> None:
+        table = {}
+        nbytes = 0
+        for field, value in self.items():
+            table[field] = value
+            nbytes += sys.getsizeof(field) + sys.getsizeof(value)
+        self.table = table
+        self.nbytes = nbytes
+        self.scan_index = ScanIndex(table)
+        self.data = bytearray()
+        self.count = 0
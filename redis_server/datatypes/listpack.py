@@ -0,0 +1,244 @@
+"""
+Listpack: a small sequence packed into one bytearray
+
+Every entry is stored as
+
+    <length varint> <data> <backlen>
+
+where backlen is the size of the first two parts, written as a varint that
+is read from right to left. The length lets a reader walk forward and the
+backlen lets it walk backward, so both ends can be popped without keeping
+an index. A value shorter than 128 bytes costs its data plus 2 bytes,
+against a list pointer and a str object (~50 bytes) per element in a
+plain Python list.
+
+Values go in as str (or int) and come back as str, with the same
+surrogateescape encoding the protocol uses, so arbitrary bytes survive.
+"""
+from typing import Iterator, List, Optional
+from ..protocol import decode_arg, encode_arg
+
+
+def _varint(value: int) -> bytes:
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _varint_size(value: int) -> int:
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def encode_entry(value) -> bytes:
+    data = encode_arg(value)
+    header = _varint(len(data))
+    return header + data + _varint(len(header) + len(data))[::-1]
+
+
+def _entry_at(data, pos: int):
+    """(data start, data end, next entry) of the entry starting at pos"""
+    length = data[pos]
+    pos += 1
+    if length >= 0x80:
+        length &= 0x7F
+        shift = 7
+        while True:
+            byte = data[pos]
+            pos += 1
+            length |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+    end = pos + length
+    header_and_data = end - pos + _varint_size(length)
+    return pos, end, end + _varint_size(header_and_data)
+
+
+def _entry_before(data, end: int):
+    """Start of the entry that finishes at end"""
+    pos = end - 1
+    size = data[pos]
+    if size >= 0x80:
+        size &= 0x7F
+        shift = 7
+        while True:
+            pos -= 1
+            byte = data[pos]
+            size |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+    return pos - size
+
+
+def count_entries(data) -> int:
+    """
+    Number of entries in encoded listpack bytes, ValueError unless they
+    are a clean sequence of entries whose backlens lead back to them
+    """
+    size = len(data)
+    pos = 0
+    count = 0
+    while pos < size:
+        try:
+            start, end, next_pos = _entry_at(data, pos)
+            if next_pos > size or _entry_before(data, next_pos) != pos:
+                raise ValueError
+        except (IndexError, ValueError):
+            raise ValueError(f"listpack entry at offset {pos} is corrupt")
+        pos = next_pos
+        count += 1
+    return count
+
+
+class Listpack:
+    __slots__ = ('data', 'count')
+
+    def __init__(self, values=()):
+        self.data = bytearray()
+        self.count = 0
+        for value in values:
+            self.append(value)
+
+    @classmethod
+    def from_bytes(cls, data, count: int) -> 'Listpack':
+        """A listpack around entries already encoded, as read from a snapshot"""
+        listpack = cls()
+        listpack.data = bytearray(data)
+        listpack.count = count
+        return listpack
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def append(self, value) -> int:
+        """Add value at the tail, returns the bytes added"""
+        return self.append_entry(encode_entry(value))
+
+    def appendleft(self, value) -> int:
+        return self.appendleft_entry(encode_entry(value))
+
+    def append_entry(self, entry: bytes) -> int:
+        """Add an entry already built by encode_entry()"""
+        self.data += entry
+        self.count += 1
+        return len(entry)
+
+    def appendleft_entry(self, entry: bytes) -> int:
+        self.data[0:0] = entry
+        self.count += 1
+        return len(entry)
+
+    def pop(self) -> Optional[str]:
+        if not self.count:
+            return None
+        data = self.data
+        start = _entry_before(data, len(data))
+        value_start, value_end, _ = _entry_at(data, start)
+        value = decode_arg(bytes(data[value_start:value_end]))
+        del data[start:]
+        self.count -= 1
+        return value
+
+    def popleft(self) -> Optional[str]:
+        if not self.count:
+            return None
+        data = self.data
+        value_start, value_end, following = _entry_at(data, 0)
+        value = decode_arg(bytes(data[value_start:value_end]))
+        #Deleting from the front of a bytearray only moves its start pointer
+        del data[:following]
+        self.count -= 1
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        data = self.data
+        pos = 0
+        size = len(data)
+        while pos < size:
+            value_start, value_end, pos = _entry_at(data, pos)
+            yield decode_arg(bytes(data[value_start:value_end]))
+
+    def iter_raw(self) -> Iterator[bytes]:
+        """Entries as encoded bytes, cheap to compare against encode_arg()"""
+        data = self.data
+        pos = 0
+        size = len(data)
+        while pos < size:
+            value_start, value_end, pos = _entry_at(data, pos)
+            yield bytes(data[value_start:value_end])
+
+    def __reversed__(self) -> Iterator[str]:
+        data = self.data
+        end = len(data)
+        while end:
+            start = _entry_before(data, end)
+            value_start, value_end, _ = _entry_at(data, start)
+            yield decode_arg(bytes(data[value_start:value_end]))
+            end = start
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("listpack index out of range")
+        #Walk from whichever end is closer
+        if index <= self.count // 2:
+            for position, value in enumerate(self):
+                if position == index:
+                    return value
+        for position, value in enumerate(reversed(self)):
+            if position == self.count - 1 - index:
+                return value
+        raise IndexError("listpack index out of range")
+
+    def spans(self) -> Iterator[tuple]:
+        """(entry start, data start, data end) of every entry, in order"""
+        data = self.data
+        pos = 0
+        size = len(data)
+        while pos < size:
+            entry_start = pos
+            value_start, value_end, pos = _entry_at(data, pos)
+            yield entry_start, value_start, value_end
+
+    def entry_end(self, entry_start: int) -> int:
+        return _entry_at(self.data, entry_start)[2]
+
+    def splice(self, start: int, end: int, entries: bytes, count_delta: int) -> int:
+        """
+        Replace the encoded entries between two entry boundaries
+
+        Args:
+          entries: zero or more entries built by encode_entry()
+          count_delta: entries added minus entries removed
+        Returns the change in bytes
+        """
+        self.data[start:end] = entries
+        self.count += count_delta
+        return len(entries) - (end - start)
+
+    def to_list(self) -> List[str]:
+        return list(self)
+
+    def replace(self, values) -> int:
+        """Re-encode the whole listpack from values, returns the change in bytes"""
+        before = len(self.data)
+        self.data = bytearray()
+        self.count = 0
+        for value in values:
+            self.append(value)
+        return len(self.data) - before
@@ -0,0 +1,222 @@
+"""
+Quicklist: the list type
+
+A deque of listpack nodes. Pushes and pops touch only the head or tail
+node, so they are O(1) whatever the length of the list, and positional
+reads skip whole nodes by their entry count instead of visiting every
+element. Node size follows list-max-listpack-size with the Redis meaning:
+a positive value caps the entries per node, -1 to -5 cap the node at
+4, 8, 16, 32 or 64 KB.
+"""
+import sys
+from collections import deque
+from itertools import islice
+from typing import List, Optional
+from .listpack import Listpack, encode_entry
+
+#Byte limits for negative list-max-listpack-size values
+NODE_SIZE_LIMITS = (4096, 8192, 16384, 32768, 65536)
+#Entries per node are capped even with a count fill, like Redis
+NODE_SAFETY_LIMIT = 8192
+
+#Node object, its bytearray header and the deque slot pointing at it
+NODE_OVERHEAD = sys.getsizeof(Listpack()) + sys.getsizeof(bytearray()) + 8
+
+
+class QuickList:
+    type_name = 'list'
+    encoding = 'quicklist'
+    __slots__ = ('nodes', 'count', 'nbytes', 'fill')
+
+    def __init__(self, fill: int = -2):
+        self.nodes = deque()
+        self.count = 0
+        #Encoded size of every node, kept so memory_usage() is O(1)
+        self.nbytes = 0
+        self.fill = fill
+
+    @classmethod
+    def from_nodes(cls, nodes, fill: int = -2) -> 'QuickList':
+        """A quicklist made of existing listpack nodes, as read from a snapshot"""
+        quicklist = cls(fill)
+        quicklist.nodes.extend(nodes)
+        for node in quicklist.nodes:
+            quicklist.count += node.count
+            quicklist.nbytes += node.nbytes
+        return quicklist
+
+    def __len__(self) -> int:
+        return self.count
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.nodes) + len(self.nodes) * NODE_OVERHEAD + self.nbytes
+
+    def _fits(self, node: Listpack, entry_size: int) -> bool:
+        if not node.count:
+            return True
+        if self.fill >= 0:
+            return node.count < max(self.fill, 1) and node.nbytes + entry_size <= NODE_SAFETY_LIMIT
+        limit = NODE_SIZE_LIMITS[min(-self.fill, len(NODE_SIZE_LIMITS)) - 1]
+        return node.nbytes + entry_size <= limit
+
+    def push_head(self, value) -> None:
+        nodes = self.nodes
+        entry = encode_entry(value)
+        if not nodes or not self._fits(nodes[0], len(entry)):
+            nodes.appendleft(Listpack())
+        self.nbytes += nodes[0].appendleft_entry(entry)
+        self.count += 1
+
+    def push_tail(self, value) -> None:
+        nodes = self.nodes
+        entry = encode_entry(value)
+        if not nodes or not self._fits(nodes[-1], len(entry)):
+            nodes.append(Listpack())
+        self.nbytes += nodes[-1].append_entry(entry)
+        self.count += 1
+
+    def pop_head(self) -> Optional[str]:
+        if not self.count:
+            return None
+        node = self.nodes[0]
+        before = node.nbytes
+        value = node.popleft()
+        self.nbytes -= before - node.nbytes
+        self.count -= 1
+        if not node.count:
+            self.nodes.popleft()
+        return value
+
+    def pop_tail(self) -> Optional[str]:
+        if not self.count:
+            return None
+        node = self.nodes[-1]
+        before = node.nbytes
+        value = node.pop()
+        self.nbytes -= before - node.nbytes
+        self.count -= 1
+        if not node.count:
+            self.nodes.pop()
+        return value
+
+    def _locate(self, index: int):
+        """(node position, offset inside the node) of a non-negative index"""
+        nodes = self.nodes
+        if index < self.count // 2:
+            for position, node in enumerate(nodes):
+                if index < node.count:
+                    return position, index
+                index -= node.count
+        else:
+            index = self.count - 1 - index
+            last = len(nodes) - 1
+            for position, node in enumerate(reversed(nodes)):
+                if index < node.count:
+                    return last - position, node.count - 1 - index
+                index -= node.count
+        raise IndexError("quicklist index out of range")
+
+    def _normalize(self, index: int) -> int:
+        return index + self.count if index < 0 else index
+
+    def index(self, index: int) -> Optional[str]:
+        index = self._normalize(index)
+        if not 0 <= index < self.count:
+            return None
+        position, offset = self._locate(index)
+        return self.nodes[position][offset]
+
+    def set(self, index: int, value) -> bool:
+        index = self._normalize(index)
+        if not 0 <= index < self.count:
+            return False
+        position, offset = self._locate(index)
+        values = self.nodes[position].to_list()
+        values[offset] = value
+        self._replace_node(position, values)
+        return True
+
+    def range(self, start: int, stop: int) -> List[str]:
+        """Elements from start to stop inclusive, Redis index semantics"""
+        start = max(self._normalize(start), 0)
+        stop = min(self._normalize(stop), self.count - 1)
+        if start > stop:
+            return []
+        position, offset = self._locate(start)
+        wanted = stop - start + 1
+        result = []
+        for node in islice(self.nodes, position, None):
+            values = node if not offset else islice(node, offset, None)
+            result.extend(islice(values, wanted - len(result)))
+            offset = 0
+            if len(result) >= wanted:
+                break
+        return result
+
+    def __iter__(self):
+        for node in self.nodes:
+            yield from node
+
+    def trim(self, start: int, stop: int) -> None:
+        """Keep only the elements from start to stop inclusive"""
+        start = max(self._normalize(start), 0)
+        stop = min(self._normalize(stop), self.count - 1)
+        if start > stop:
+            self.nodes.clear()
+            self.count = 0
+            self.nbytes = 0
+            return
+        drop_tail = self.count - 1 - stop
+        nodes = self.nodes
+        #Whole nodes go without being decoded, partial ones are re-encoded
+        while start and start >= nodes[0].count:
+            node = nodes.popleft()
+            start -= node.count
+            self.count -= node.count
+            self.nbytes -= node.nbytes
+        while drop_tail and drop_tail >= nodes[-1].count:
+            node = nodes.pop()
+            drop_tail -= node.count
+            self.count -= node.count
+            self.nbytes -= node.nbytes
+        if start:
+            self._replace_node(0, nodes[0].to_list()[start:])
+        if drop_tail:
+            self._replace_node(len(nodes) - 1, nodes[-1].to_list()[:-drop_tail])
+
+    def insert(self, pivot, value, after: bool) -> int:
+        """
+        Insert value next to the first element equal to pivot
+
+        Returns the new length, or -1 when pivot is not in the list
+        """
+        for position, node in enumerate(self.nodes):
+            values = node.to_list()
+            if pivot in values:
+                offset = values.index(pivot) + (1 if after else 0)
+                values.insert(offset, value)
+                self._replace_node(position, values)
+                return self.count
+        return -1
+
+    def _replace_node(self, position: int, values: List[str]) -> None:
+        """Re-encode one node, splitting it when it outgrows the fill limit"""
+        nodes = self.nodes
+        old = nodes[position]
+        self.count -= old.count
+        self.nbytes -= old.nbytes
+        replacement = []
+        current = Listpack()
+        for value in values:
+            entry = encode_entry(value)
+            if not self._fits(current, len(entry)):
+                replacement.append(current)
+                current = Listpack()
+            current.append_entry(entry)
+        if current.count:
+            replacement.append(current)
+        del nodes[position]
+        for offset, node in enumerate(replacement):
+            nodes.insert(position + offset, node)
+            self.count += node.count
+            self.nbytes += node.nbytes
@@ -0,0 +1,149 @@
+"""
+Cursors for HSCAN and SSCAN
+
+Python dicts and sets expose no stable bucket order, so hash table
+encoded containers are walked in order of the CRC32 of each element
+instead. The cursor is the next CRC32 value to visit: an element present
+for the whole iteration is returned once its hash is passed, whatever
+is added or removed meanwhile.
+
+The order is kept by a ScanIndex next to the table, updated on every
+add and delete, so a SCAN step bisects to the cursor and costs O(COUNT)
+like the keyspace SCAN does through the slot index. Like a quicklist it
+is a run of small chunks, each a sorted array of hashes with the members
+alongside, so an insert moves at most a chunk rather than the whole
+index.
+"""
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from zlib import crc32
+from typing import Iterable, List, Tuple
+from ..protocol import encode_arg
+
+CURSOR_LIMIT = 1 << 32
+#A chunk is split in two once it holds twice this many members
+SCAN_CHUNK_SIZE = 256
+#Arrays, lists and first hash of a chunk, then a hash and a list slot per member
+CHUNK_OVERHEAD = sys.getsizeof(array('I')) + sys.getsizeof([]) + 4 + 16
+MEMBER_OVERHEAD = 4 + 8
+
+
+def member_hash(member) -> int:
+    return crc32(encode_arg(member))
+
+
+class ScanIndex:
+    """
+    Members of a container ordered by CRC32
+
+    Members sharing a hash are always in the same chunk, so the chunk
+    whose first hash is the last one not above a hash is the only place
+    it can be
+    """
+    __slots__ = ('firsts', 'hashes', 'members')
+
+    def __init__(self, members: Iterable = ()):
+        pairs = sorted((member_hash(member), member) for member in members)
+        #First hash of each chunk, the chunk lists are never empty
+        self.firsts = array('I')
+        self.hashes = []
+        self.members = []
+        start = 0
+        while start < len(pairs):
+            end = min(start + SCAN_CHUNK_SIZE, len(pairs))
+            while end < len(pairs) and pairs[end][0] == pairs[end - 1][0]:
+                end += 1
+            chunk = pairs[start:end]
+            self.firsts.append(chunk[0][0])
+            self.hashes.append(array('I', [element_hash for element_hash, _ in chunk]))
+            self.members.append([member for _, member in chunk])
+            start = end
+
+    def _chunk_for(self, element_hash: int) -> int:
+        return max(bisect_right(self.firsts, element_hash) - 1, 0)
+
+    def add(self, member) -> None:
+        """Index a member that is not in the container yet"""
+        element_hash = member_hash(member)
+        if not self.firsts:
+            self.firsts.append(element_hash)
+            self.hashes.append(array('I', [element_hash]))
+            self.members.append([member])
+            return
+        chunk = self._chunk_for(element_hash)
+        hashes = self.hashes[chunk]
+        position = bisect_right(hashes, element_hash)
+        hashes.insert(position, element_hash)
+        self.members[chunk].insert(position, member)
+        if position == 0:
+            self.firsts[chunk] = element_hash
+        if len(hashes) > 2 * SCAN_CHUNK_SIZE:
+            self._split(chunk)
+
+    def _split(self, chunk: int) -> None:
+        hashes = self.hashes[chunk]
+        middle = len(hashes) // 2
+        while middle < len(hashes) and hashes[middle] == hashes[middle - 1]:
+            middle += 1
+        if middle == len(hashes):
+            return
+        members = self.members[chunk]
+        self.hashes[chunk:chunk + 1] = [hashes[:middle], hashes[middle:]]
+        self.members[chunk:chunk + 1] = [members[:middle], members[middle:]]
+        self.firsts.insert(chunk + 1, hashes[middle])
+
+    def discard(self, member) -> None:
+        if not self.firsts:
+            return
+        element_hash = member_hash(member)
+        chunk = self._chunk_for(element_hash)
+        hashes = self.hashes[chunk]
+        members = self.members[chunk]
+        position = bisect_left(hashes, element_hash)
+        while position < len(hashes) and hashes[position] == element_hash:
+            if members[position] == member:
+                del hashes[position]
+                del members[position]
+                if not hashes:
+                    del self.firsts[chunk]
+                    del self.hashes[chunk]
+                    del self.members[chunk]
+                elif position == 0:
+                    self.firsts[chunk] = hashes[0]
+                return
+            position += 1
+
+    def scan(self, cursor: int, count: int) -> Tuple[int, List]:
+        """One step from cursor, (next cursor, members)"""
+        batch = []
+        if not self.firsts:
+            return 0, batch
+        chunk = self._chunk_for(cursor)
+        position = bisect_left(self.hashes[chunk], cursor)
+        last_hash = None
+        while chunk < len(self.hashes):
+            hashes = self.hashes[chunk]
+            if position < len(hashes):
+                if len(batch) >= count:
+                    #Members sharing the last hash go in the same batch,
+                    #the cursor skips it
+                    if hashes[position] != last_hash:
+                        next_cursor = last_hash + 1
+                        return (next_cursor if next_cursor < CURSOR_LIMIT else 0), batch
+                    end = bisect_right(hashes, last_hash, position)
+                else:
+                    end = min(len(hashes), position + count - len(batch))
+                batch.extend(self.members[chunk][position:end])
+                last_hash = hashes[end - 1]
+                position = end
+                continue
+            chunk += 1
+            position = 0
+        return 0, batch
+
+    def memory_usage(self, size: int) -> int:
+        """Estimate for an index of size members, O(1) like the containers"""
+        chunks = len(self.firsts)
+        return (sys.getsizeof(self) + sys.getsizeof(self.hashes) + sys.getsizeof(self.members)
+                + chunks * CHUNK_OVERHEAD + size * MEMBER_OVERHEAD)
@@ -0,0 +1,242 @@
+"""
+Set type
+
+A set whose members are all integers is an intset: a sorted array of
+machine integers searched with binary search. Like Redis the array starts
+with 16-bit items and is upgraded to 32 or 64 bits when a wider value is
+added, so a set of small IDs costs 2 to 8 bytes per member instead of a
+str object and a hash table slot. It is converted to a Python set once a
+member is not a canonical 64-bit integer or it grows past
+set-max-intset-entries. The members of a Python set are also kept in a
+ScanIndex, the order SSCAN walks them in.
+"""
+import random
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Iterable, List, Optional, Tuple
+from .scan import ScanIndex
+from ..protocol import canonical_int
+
+#Typecode and value range of each intset width, narrowest first
+INTSET_WIDTHS = (
+    ('h', -2 ** 15, 2 ** 15 - 1),
+    ('i', -2 ** 31, 2 ** 31 - 1),
+    ('q', -2 ** 63, 2 ** 63 - 1),
+)
+
+
+def as_intset_value(member) -> Optional[int]:
+    """The integer a member stands for, None unless it is written canonically"""
+    if isinstance(member, int):
+        return member if INTSET_WIDTHS[-1][1] <= member <= INTSET_WIDTHS[-1][2] else None
+    return canonical_int(member)
+
+
+def _typecode_for(value: int) -> str:
+    for typecode, low, high in INTSET_WIDTHS:
+        if low <= value <= high:
+            return typecode
+    raise OverflowError("intset value out of range")
+
+
+class Set:
+    type_name = 'set'
+    __slots__ = ('intset', 'table', 'members', 'nbytes', 'scan_index')
+
+    def __init__(self):
+        self.intset = array('h')
+        #Python set of str once converted
+        self.table = None
+        #Members of the table for O(1) random picks, may hold removed
+        #members that are dropped when picked, like DataStore._sample_keys
+        self.members = None
+        #Size of the member objects of the table encoding
+        self.nbytes = 0
+        #Members of the table in SSCAN order
+        self.scan_index = None
+
+    @classmethod
+    def from_members(cls, members: Iterable, max_intset: int) -> 'Set':
+        members = list(members)
+        result = cls()
+        values = []
+        for member in members:
+            value = as_intset_value(member)
+            if value is None:
+                values = None
+                break
+            values.append(value)
+        if values is not None:
+            values = sorted(set(values))
+            if len(values) <= max_intset:
+                if values:
+                    typecode = max(_typecode_for(values[0]), _typecode_for(values[-1]), key='hiq'.index)
+                    result.intset = array(typecode, values)
+                return result
+        result._convert()
+        for member in members:
+            result.add(member, max_intset)
+        return result
+
+    @classmethod
+    def from_intset(cls, intset: array) -> 'Set':
+        """An intset encoded set around a sorted array, as read from a snapshot"""
+        result = cls()
+        result.intset = intset
+        return result
+
+    @classmethod
+    def from_table(cls, table: set) -> 'Set':
+        """A hashtable encoded set that takes ownership of table"""
+        result = cls()
+        result.intset = None
+        result.table = table
+        result.members = list(table)
+        result.nbytes = sum(sys.getsizeof(member) for member in table)
+        result.scan_index = ScanIndex(table)
+        return result
+
+    @property
+    def encoding(self) -> str:
+        return 'intset' if self.table is None else 'hashtable'
+
+    def __len__(self) -> int:
+        if self.table is None:
+            return len(self.intset)
+        return len(self.table)
+
+    def memory_usage(self) -> int:
+        if self.table is None:
+            return sys.getsizeof(self) + sys.getsizeof(self.intset)
+        return (sys.getsizeof(self) + sys.getsizeof(self.table) + sys.getsizeof(self.members) + self.nbytes
+                + self.scan_index.memory_usage(len(self.table)))
+
+    def __contains__(self, member) -> bool:
+        if self.table is not None:
+            return member in self.table
+        value = as_intset_value(member)
+        if value is None:
+            return False
+        intset = self.intset
+        position = bisect_left(intset, value)
+        return position < len(intset) and intset[position] == value
+
+    def has_int(self, value: int) -> bool:
+        """Membership test of an intset value without going through str"""
+        if self.table is not None:
+            return str(value) in self.table
+        intset = self.intset
+        position = bisect_left(intset, value)
+        return position < len(intset) and intset[position] == value
+
+    def __iter__(self):
+        if self.table is not None:
+            return iter(self.table)
+        return map(str, self.intset)
+
+    def add(self, member, max_intset: int) -> bool:
+        """True when member was not in the set"""
+        if self.table is None:
+            value = as_intset_value(member)
+            if value is not None:
+                intset = self.intset
+                position = bisect_left(intset, value)
+                if position < len(intset) and intset[position] == value:
+                    return False
+                if len(intset) < max_intset:
+                    typecode = _typecode_for(value)
+                    if 'hiq'.index(typecode) > 'hiq'.index(intset.typecode):
+                        intset = self.intset = array(typecode, intset)
+                    intset.insert(position, value)
+                    return True
+            self._convert()
+        table = self.table
+        member = str(member)
+        if member in table:
+            return False
+        table.add(member)
+        self._remember(member)
+        self.scan_index.add(member)
+        self.nbytes += sys.getsizeof(member)
+        return True
+
+    def remove(self, member) -> bool:
+        if self.table is not None:
+            if member not in self.table:
+                return False
+            self.table.discard(member)
+            self.nbytes -= sys.getsizeof(member)
+            self.scan_index.discard(member)
+            return True
+        value = as_intset_value(member)
+        if value is None:
+            return False
+        intset = self.intset
+        position = bisect_left(intset, value)
+        if position < len(intset) and intset[position] == value:
+            del intset[position]
+            return True
+        return False
+
+    def _remember(self, member) -> None:
+        members = self.members
+        members.append(member)
+        if len(members) > 2 * len(self.table) + 64:
+            self.members = list(self.table)
+
+    def random_members(self, count: int, distinct: bool = True) -> List[str]:
+        """
+        Up to count random members, without repeats when distinct
+
+        Picks are O(1) each: by index in the intset and through the
+        members list for a table
+        """
+        size = len(self)
+        if not size:
+            return []
+        if self.table is None:
+            intset = self.intset
+            if distinct:
+                indexes = random.sample(range(size), min(count, size))
+            else:
+                indexes = [random.randrange(size) for _ in range(count)]
+            return [str(intset[index]) for index in indexes]
+        if distinct and count >= size:
+            return list(self.table)
+        picked = []
+        seen = set()
+        table = self.table
+        members = self.members
+        while len(picked) < count:
+            index = random.randrange(len(members))
+            member = members[index]
+            if member not in table:
+                #Swap-remove a member deleted since it was remembered
+                members[index] = members[-1]
+                members.pop()
+                continue
+            if distinct:
+                if member in seen:
+                    continue
+                seen.add(member)
+            picked.append(member)
+        return picked
+
+    def pop(self, count: int) -> List[str]:
+        popped = self.random_members(count)
+        for member in popped:
+            self.remove(member)
+        return popped
+
+    def scan(self, cursor: int, count: int) -> Tuple[int, List[str]]:
+        """One SSCAN step over a table encoded set, (next cursor, members)"""
+        return self.scan_index.scan(cursor, count)
+
+    def _convert(self) -> None:
+        members = [str(value) for value in self.intset]
+        self.table = set(members)
+        self.members = members
+        self.nbytes = sum(sys.getsizeof(member) for member in members)
+        self.scan_index = ScanIndex(self.table)
+        self.intset = None
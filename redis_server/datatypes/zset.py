@@ -0,0 +1,335 @@
+"""
+Sorted set type
+
+Small sorted sets are a listpack of member and score entries kept in
+(score, member) order; at most zset-max-listpack-entries of them, so
+every operation simply decodes, edits and re-encodes the listpack.
+
+Larger sets use a dict from member to score for O(1) ZSCORE, plus a
+SortedChunks index of (score, member) pairs. Redis uses a skiplist with
+span counters for the index; in Python a list of sorted chunks is much
+faster because the work inside a chunk is done by bisect and list
+insertion in C. A Fenwick tree over the chunk lengths provides the
+span counters, so insert, delete and rank are O(log n) and a range
+query is O(log n + m).
+"""
+import math
+import sys
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from typing import List, Optional, Tuple
+from .listpack import Listpack, encode_entry
+from ..protocol import encode_arg, format_double
+
+#Chunks are split once they hold twice this many entries
+CHUNK_LOAD = 512
+
+#Tuple and float of an index entry plus its slot in the chunk list
+INDEX_ENTRY_OVERHEAD = sys.getsizeof((0.0, "")) + sys.getsizeof(0.0) + 8
+
+
+class SortedChunks:
+    """Sorted sequence with O(log n) insert, delete, rank and select"""
+
+    __slots__ = ('chunks', 'maxes', 'tree', 'size')
+
+    def __init__(self, items=()):
+        items = sorted(items)
+        self.chunks = [items[start:start + CHUNK_LOAD] for start in range(0, len(items), CHUNK_LOAD)]
+        #Last item of every chunk, bisected to find the chunk of an item
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.size = len(items)
+        self._rebuild_tree()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _rebuild_tree(self) -> None:
+        #Fenwick tree of chunk lengths, 1-based: tree[i] covers chunks i-lowbit(i)..i-1
+        tree = [0] + [len(chunk) for chunk in self.chunks]
+        for index in range(1, len(tree)):
+            parent = index + (index & -index)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def _tree_add(self, position: int, delta: int) -> None:
+        tree = self.tree
+        index = position + 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def _prefix(self, position: int) -> int:
+        """Number of items in the chunks before position"""
+        tree = self.tree
+        total = 0
+        while position:
+            total += tree[position]
+            position -= position & -position
+        return total
+
+    def _locate(self, rank: int) -> Tuple[int, int]:
+        """(chunk position, offset in the chunk) of the item at rank"""
+        tree = self.tree
+        position = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            candidate = position + step
+            if candidate < len(tree) and tree[candidate] <= rank:
+                position = candidate
+                rank -= tree[candidate]
+            step >>= 1
+        return position, rank
+
+    def add(self, item) -> None:
+        maxes = self.maxes
+        self.size += 1
+        if not maxes:
+            self.chunks.append([item])
+            maxes.append(item)
+            self._rebuild_tree()
+            return
+        position = bisect_left(maxes, item)
+        if position == len(maxes):
+            position -= 1
+            self.chunks[position].append(item)
+            maxes[position] = item
+        else:
+            insort(self.chunks[position], item)
+        chunk = self.chunks[position]
+        if len(chunk) > 2 * CHUNK_LOAD:
+            self.chunks[position:position + 1] = [chunk[:CHUNK_LOAD], chunk[CHUNK_LOAD:]]
+            maxes[position:position + 1] = [chunk[CHUNK_LOAD - 1], chunk[-1]]
+            self._rebuild_tree()
+        else:
+            self._tree_add(position, 1)
+
+    def remove(self, item) -> bool:
+        maxes = self.maxes
+        position = bisect_left(maxes, item)
+        if position == len(maxes):
+            return False
+        chunk = self.chunks[position]
+        offset = bisect_left(chunk, item)
+        if chunk[offset] != item:
+            return False
+        del chunk[offset]
+        self.size -= 1
+        if not chunk:
+            del self.chunks[position]
+            del maxes[position]
+            self._rebuild_tree()
+        else:
+            maxes[position] = chunk[-1]
+            self._tree_add(position, -1)
+        return True
+
+    def bisect_left(self, item) -> int:
+        position = bisect_left(self.maxes, item)
+        if position == len(self.maxes):
+            return self.size
+        return self._prefix(position) + bisect_left(self.chunks[position], item)
+
+    def bisect_right(self, item) -> int:
+        position = bisect_right(self.maxes, item)
+        if position == len(self.maxes):
+            return self.size
+        return self._prefix(position) + bisect_right(self.chunks[position], item)
+
+    def __getitem__(self, rank: int):
+        position, offset = self._locate(rank)
+        return self.chunks[position][offset]
+
+    def slice(self, start: int, stop: int) -> list:
+        """Items with rank in [start, stop)"""
+        if start >= stop:
+            return []
+        position, offset = self._locate(start)
+        wanted = stop - start
+        result = []
+        for chunk in islice(self.chunks, position, None):
+            result.extend(chunk[offset:offset + wanted - len(result)])
+            offset = 0
+            if len(result) >= wanted:
+                break
+        return result
+
+
+class ZSet(Listpack):
+    """
+    Holds the listpack encoding itself, like Hash, and switches to
+    table/index once converted
+    """
+    type_name = 'zset'
+    __slots__ = ('table', 'index', 'nbytes')
+
+    def __init__(self):
+        super().__init__()
+        self.table = None
+        self.index = None
+        #Size of the members, scores and index entries once converted
+        self.nbytes = 0
+
+    @classmethod
+    def from_pairs(cls, pairs) -> 'ZSet':
+        """A skiplist encoded sorted set from (score, member) pairs"""
+        zset = cls()
+        zset._convert(pairs)
+        return zset
+
+    @property
+    def encoding(self) -> str:
+        #Reported under the Redis name, clients compare against it
+        return 'listpack' if self.table is None else 'skiplist'
+
+    def __len__(self) -> int:
+        if self.table is None:
+            return self.count // 2
+        return len(self.table)
+
+    def memory_usage(self) -> int:
+        if self.table is None:
+            return sys.getsizeof(self) + sys.getsizeof(self.data)
+        return (sys.getsizeof(self) + sys.getsizeof(self.table) + self.nbytes
+                + len(self.index.chunks) * sys.getsizeof([]))
+
+    def _pairs(self) -> List[Tuple[float, str]]:
+        """The listpack decoded into sorted (score, member) pairs"""
+        values = Listpack.__iter__(self)
+        return [(float(score), member) for member, score in zip(values, values)]
+
+    def _store(self, pairs) -> None:
+        entries = []
+        for score, member in pairs:
+            entries.append(encode_entry(member))
+            entries.append(encode_entry(format_double(score)))
+        self.data = bytearray(b"".join(entries))
+        self.count = len(entries)
+
+    def _sorted(self):
+        """The (score, member) pairs as a sequence supporting bisect and rank"""
+        if self.table is None:
+            return self._pairs()
+        return self.index
+
+    def score(self, member) -> Optional[float]:
+        if self.table is not None:
+            return self.table.get(member)
+        for score, pair_member in self._pairs():
+            if pair_member == member:
+                return score
+        return None
+
+    def add(self, member, score: float, max_entries: int, max_value: int) -> None:
+        """Insert member or move it to a new score"""
+        if self.table is None:
+            pairs = self._pairs()
+            for position, (_, pair_member) in enumerate(pairs):
+                if pair_member == member:
+                    del pairs[position]
+                    break
+            insort(pairs, (score, member))
+            if len(pairs) <= max_entries and len(encode_arg(member)) <= max_value:
+                self._store(pairs)
+                return
+            self._convert(pairs)
+            return
+        table = self.table
+        old = table.get(member)
+        if old is not None:
+            self.index.remove((old, member))
+        else:
+            self.nbytes += sys.getsizeof(member) + INDEX_ENTRY_OVERHEAD
+        table[member] = score
+        self.index.add((score, member))
+
+    def remove(self, member) -> bool:
+        if self.table is None:
+            pairs = self._pairs()
+            for position, (_, pair_member) in enumerate(pairs):
+                if pair_member == member:
+                    del pairs[position]
+                    self._store(pairs)
+                    return True
+            return False
+        score = self.table.pop(member, None)
+        if score is None:
+            return False
+        self.index.remove((score, member))
+        self.nbytes -= sys.getsizeof(member) + INDEX_ENTRY_OVERHEAD
+        return True
+
+    def rank(self, member) -> Optional[int]:
+        score = self.score(member)
+        if score is None:
+            return None
+        if self.table is None:
+            return self._pairs().index((score, member))
+        return self.index.bisect_left((score, member))
+
+    def score_range(self, minimum: Tuple[float, bool], maximum: Tuple[float, bool]) -> Tuple[int, int]:
+        """
+        Ranks [start, stop) of the members with a score between two bounds
+
+        Args:
+          minimum, maximum: (score, exclusive)
+        """
+        pairs = self._sorted()
+        return (self._score_rank(pairs, minimum, is_max=False),
+                self._score_rank(pairs, maximum, is_max=True))
+
+    def _score_rank(self, pairs, bound, is_max: bool) -> int:
+        score, exclusive = bound
+        #(score,) sorts before every (score, member) pair
+        if is_max == exclusive:
+            #Inclusive minimum or exclusive maximum: first score >= score
+            return self._bisect(pairs, (score,))
+        #Exclusive minimum or inclusive maximum: first score > score
+        if score == float('inf'):
+            return len(pairs)
+        return self._bisect(pairs, (math.nextafter(score, float('inf')),))
+
+    def lex_range(self, minimum, maximum) -> Tuple[int, int]:
+        """
+        Ranks [start, stop) of the members between two lex bounds, which
+        are None for -/+ or (member, exclusive). Assumes equal scores
+        """
+        pairs = self._sorted()
+        if not len(pairs):
+            return 0, 0
+        score = pairs[0][0]
+        start = 0 if minimum is None else (
+            self._bisect(pairs, (score, minimum[0]), right=minimum[1]))
+        stop = len(pairs) if maximum is None else (
+            self._bisect(pairs, (score, maximum[0]), right=not maximum[1]))
+        return start, stop
+
+    def _bisect(self, pairs, item, right: bool = False) -> int:
+        if isinstance(pairs, SortedChunks):
+            return pairs.bisect_right(item) if right else pairs.bisect_left(item)
+        return bisect_right(pairs, item) if right else bisect_left(pairs, item)
+
+    def slice(self, start: int, stop: int) -> List[Tuple[float, str]]:
+        """(score, member) pairs with rank in [start, stop), ascending"""
+        pairs = self._sorted()
+        start = max(start, 0)
+        stop = min(stop, len(pairs))
+        if isinstance(pairs, SortedChunks):
+            return pairs.slice(start, stop)
+        return pairs[start:stop]
+
+    def pop(self, count: int, highest: bool) -> List[Tuple[float, str]]:
+        size = len(self)
+        count = min(count, size)
+        popped = self.slice(size - count, size)[::-1] if highest else self.slice(0, count)
+        for _, member in popped:
+            self.remove(member)
+        return popped
+
+    def _convert(self, pairs) -> None:
+        self.table = {member: score for score, member in pairs}
+        self.index = SortedChunks(pairs)
+        self.nbytes = sum(sys.getsizeof(member) + INDEX_ENTRY_OVERHEAD for _, member in pairs)
+        self.data = bytearray()
+        self.count = 0
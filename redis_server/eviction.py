@@ -0,0 +1,166 @@
+"""
+maxmemory enforcement
+
+Keys are evicted with the approximated algorithms Redis uses: a few keys
+are sampled at random, scored by idle time (LRU), access frequency (LFU)
+or time to live, and the best candidates are kept in a small eviction
+pool across calls. No global ordering of keys is maintained.
+"""
+import random
+import time
+
+EVICTION_POLICIES = (
+    'noeviction',
+    'allkeys-lru',
+    'volatile-lru',
+    'allkeys-lfu',
+    'volatile-lfu',
+    'allkeys-random',
+    'volatile-random',
+    'volatile-ttl',
+)
+
+EVPOOL_SIZE = 16
+
+#Morris counter parameters, same defaults as Redis
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1  # minutes of inactivity that decrement the counter by one
+
+
+def lru_clock() -> int:
+    """Access clock with one second resolution"""
+    return int(time.monotonic())
+
+
+def lfu_minutes() -> int:
+    return int(time.monotonic() // 60) & 0xFFFF
+
+
+def lfu_decr_and_return(packed: int) -> int:
+    """Counter of a packed (minutes << 8 | counter) value after decay"""
+    last_minutes = packed >> 8
+    counter = packed & 0xFF
+    elapsed = (lfu_minutes() - last_minutes) & 0xFFFF
+    periods = elapsed // LFU_DECAY_TIME if LFU_DECAY_TIME else 0
+    return max(0, counter - periods)
+
+
+def lfu_log_incr(counter: int) -> int:
+    """Logarithmic increment: the higher the counter, the less likely it grows"""
+    if counter == 255:
+        return 255
+    baseval = max(0, counter - LFU_INIT_VAL)
+    if random.random() < 1.0 / (baseval * LFU_LOG_FACTOR + 1):
+        counter += 1
+    return counter
+
+
+def lfu_touch(packed) -> int:
+    counter = LFU_INIT_VAL if packed is None else lfu_decr_and_return(packed)
+    return (lfu_minutes() << 8) | lfu_log_incr(counter)
+
+
+def parse_memory(value) -> int:
+    """Parse sizes such as 1048576, 100mb or 2gb into bytes"""
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().lower()
+    units = (('gb', 1024 ** 3), ('mb', 1024 ** 2), ('kb', 1024), ('g', 1000 ** 3),
+             ('m', 1000 ** 2), ('k', 1000), ('b', 1))
+    for suffix, multiplier in units:
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * multiplier)
+    return int(text)
+
+
+class Evictor:
+
+    def __init__(self, storage, on_evict=None):
+        self.storage = storage
+        #Called with every evicted key so the deletion reaches the AOF and replicas
+        self.on_evict = on_evict
+        self.maxmemory = 0
+        self.policy = 'noeviction'
+        self.samples = 5
+        #(score, key) sorted ascending, best candidate last
+        self.pool = []
+        self.evicted_keys = 0
+
+    def configure(self, config) -> None:
+        self.maxmemory = parse_memory(config.get('max_memory_usage', 0))
+        policy = config.get('maxmemory_policy', 'noeviction')
+        if policy != self.policy:
+            self.pool = []
+        self.policy = policy
+        self.samples = int(config.get('maxmemory_samples', 5))
+        if policy.endswith('-lru'):
+            self.storage.set_access_tracking('lru')
+        elif policy.endswith('-lfu'):
+            self.storage.set_access_tracking('lfu')
+        else:
+            self.storage.set_access_tracking(None)
+
+    def free_memory_if_needed(self) -> bool:
+        """
+        Evict keys until used memory is under maxmemory
+
+        Returns False when memory is still over the limit, which means
+        commands that may grow memory have to be refused
+        """
+        if not self.maxmemory:
+            return True
+        storage = self.storage
+        while storage.get_memory_usage() > self.maxmemory:
+            if self.policy == 'noeviction':
+                return False
+            key = self._select_victim()
+            if key is None:
+                return False
+            storage.delete(key)
+            self.evicted_keys += 1
+            if self.on_evict is not None:
+                self.on_evict(key)
+        return True
+
+    def _select_victim(self):
+        volatile = self.policy.startswith('volatile-')
+        if self.policy.endswith('-random'):
+            keys = self.storage.sample_keys(1, volatile)
+            return keys[0] if keys else None
+
+        self._populate_pool(volatile)
+        storage = self.storage
+        while self.pool:
+            _, key = self.pool.pop()
+            #The pool outlives a call, its keys may have been deleted since
+            if storage.exists(key) and (not volatile or storage.ttl(key) >= 0):
+                return key
+        return None
+
+    def _populate_pool(self, volatile):
+        pool = self.pool
+        for key in self.storage.sample_keys(self.samples, volatile):
+            score = self._score(key)
+            if len(pool) >= EVPOOL_SIZE and score <= pool[0][0]:
+                continue
+            if any(pooled == key for _, pooled in pool):
+                continue
+            index = 0
+            while index < len(pool) and pool[index][0] < score:
+                index += 1
+            pool.insert(index, (score, key))
+            if len(pool) > EVPOOL_SIZE:
+                pool.pop(0)
+
+    def _score(self, key):
+        """Higher means a better eviction candidate"""
+        storage = self.storage
+        if self.policy == 'volatile-ttl':
+            return -storage.get_expiry_time(key)
+        access = storage.get_access(key)
+        if self.policy.endswith('-lfu'):
+            return 255 - (lfu_decr_and_return(access) if access is not None else 0)
+        if access is None:
+            return float('inf')
+        return lru_clock() - access
@@ -2,5 +2,8 @@ from .config import PersistenceConfig
 from .manager import PersistenceManager
 from .aof import AOFWriter
 from .recovery import RecoveryManager
+from .manifest import AOFManifest, ManifestError
+from .snapshot import SnapshotError, save_snapshot, load_snapshot
 
-__all__ = ['PersistenceConfig' ,'PersistenceManager' , 'AOFWriter',  'RecoveryManager']
\ No newline at end of file
+__all__ = ['PersistenceConfig' ,'PersistenceManager' , 'AOFWriter',  'RecoveryManager',
+           'SnapshotError', 'save_snapshot', 'load_snapshot', 'AOFManifest', 'ManifestError']
\ No newline at end of file
@@ -1,153 +1,417 @@
+"""
+Append-only file
+
+Every write command is stored as a RESP multi-bulk record, the same bytes a
+client sends, so arguments may hold spaces, newlines or any binary data
+and replay is unambiguous.
+
+Commands are first appended to an in-memory buffer. The event loop calls
+flush_buffer() once per iteration, before any reply of that iteration is
+sent, which writes the whole buffer with one write():
+
+  always   - the write is followed by one fsync, so every command of the
+             iteration is durable before its reply (group commit)
+  everysec - fsync runs on a background thread about once a second, the
+             event loop never waits for the disk
+  no       - the kernel decides when to flush
+
+The AOF is a directory of a base and incremental files tracked by a
+manifest (see manifest.py). A rewrite (BGREWRITEAOF) first switches the
+writer to a new incremental file, then a forked child writes a new base
+from its copy-on-write view of the dataset; once it is done the manifest
+replaces the old base and incremental files with it.
+
+The size of the AOF once a base is installed, or as found on startup, is
+kept as base_size; needs_rewrite() compares the current size against it.
+"""
 import os
 import time
 import threading
-import shutil
+from .manifest import AOFManifest
+from .snapshot import write_snapshot
+from ..protocol import encode_command, format_double
+
+#everysec: writes wait at most this long for an fsync still in progress
+MAX_WRITE_POSTPONE = 2.0
+
+#Elements per command when a rewrite rebuilds a container
+AOF_REWRITE_ITEMS_PER_CMD = 64
+
+#Rewrite records are collected up to this size before each write
+REWRITE_WRITE_CHUNK = 1024 * 1024
+
+
+def rewrite_commands(key, value, expiry_time):
+    """Commands that recreate key with its value and absolute expiry"""
+    type_name = getattr(value, 'type_name', 'string')
+    if type_name == 'string':
+        yield ['SET', key, value]
+    else:
+        if type_name == 'list':
+            command, items = 'RPUSH', ([item] for item in value)
+        elif type_name == 'hash':
+            command, items = 'HSET', (list(pair) for pair in value.items())
+        elif type_name == 'zset':
+            command, items = 'ZADD', ([format_double(score), member] for score, member in value.slice(0, len(value)))
+        else:
+            command, items = 'SADD', ([member] for member in value)
+        args = [command, key]
+        for item in items:
+            args.extend(item)
+            if len(args) - 2 >= AOF_REWRITE_ITEMS_PER_CMD * len(item):
+                yield args
+                args = [command, key]
+        if len(args) > 2:
+            yield args
+    if expiry_time is not None:
+        yield ['PEXPIREAT', key, str(int(expiry_time * 1000))]
+
+
+def _write_commands(data_store, file) -> int:
+    keys = 0
+    parts = []
+    pending = 0
+    for key, value, expiry_time in data_store.snapshot_items():
+        for args in rewrite_commands(key, value, expiry_time):
+            record = encode_command(args)
+            parts.append(record)
+            pending += len(record)
+        keys += 1
+        if pending >= REWRITE_WRITE_CHUNK:
+            file.write(b"".join(parts))
+            parts = []
+            pending = 0
+    file.write(b"".join(parts))
+    return keys
+
+
+def write_rewrite(data_store, filename: str, use_rdb: bool = True) -> int:
+    """
+    Write a base file that rebuilds data_store to filename and fsync it
+
+    Args:
+    use_rdb: write a snapshot instead of RESP commands, it loads faster
+
+    Returns the number of keys written
+    """
+    with open(filename, 'wb', buffering=REWRITE_WRITE_CHUNK) as file:
+        if use_rdb:
+            keys = write_snapshot(data_store, file)
+        else:
+            keys = _write_commands(data_store, file)
+        file.flush()
+        os.fsync(file.fileno())
+    return keys
+
 
 class AOFWriter:
-    
-    def __init__(self, filename : str, sync_policy: str = 'everysec'):
+
+    def __init__(self, dirname: str, basename: str, sync_policy: str = 'everysec',
+                 legacy_filename: str = None):
         """"
         Initialize AOF writer
-        
+
         Args:
-        filename: path to AOF file
+        dirname: directory of the manifest and AOF files
+        basename: prefix of the file names
         sync_policy: Sync policy ('always', 'everysec' , 'no')
-        
+        legacy_filename: single-file AOF of older versions, it becomes the
+          base when there is no manifest yet
+
         """
-        self.filename = filename
+        self.manifest = AOFManifest(dirname, basename)
+        self.legacy_filename = legacy_filename
+        #The incremental file being appended to, set by open()
+        self.filename = None
         self.sync_policy = sync_policy
-        self.file_handle = None
+        self.fd = None
+        #Records of this event loop iteration, not written yet
+        self.buffer = bytearray()
         self.last_sync_time = time.time()
-        self.pending_writes = 0
+        #Bytes written so far and how many of them are known to be on disk.
+        #write_offset only moves on the event loop, sync_offset only where
+        #the fsync runs, so they are read across threads without a lock
+        self.write_offset = 0
+        self.sync_offset = 0
+        #Size of every listed file, kept up to date by the writes, and what
+        #it was after the last rewrite
+        self.current_size = 0
+        self.base_size = 0
+        #Guards fd against close() and the switch to a new incremental file
         self._lock = threading.Lock()
-        #Write commands that should be logged
-        self.write_commands = {
-            'SET' , 'DEL' , 'EXPIRE' , 'EXPIREAT', 'PERSIST', 'FLUSHALL'
-        }
-        
+
+        #everysec fsync thread
+        self._fsync_requested = threading.Event()
+        self._fsync_idle = threading.Event()
+        self._fsync_idle.set()
+        self._fsync_thread = None
+        self._closing = False
+        self._postponed_since = None
+        self.delayed_fsync = 0
+        self.last_write_status = 'ok'
+
         #Ensure Directory exsists
-        os.makedirs(os.path.dirname(filename) , exist_ok=True)
-        
-        
+        os.makedirs(dirname, exist_ok=True)
+
+
     def open(self) -> None:
-         #Open AOF file for writing
-         
+         #Open the last incremental file for appending, creating the manifest if needed
+
+         manifest = self.manifest
          try:
-             self.file_handle = open (self.filename, 'a', encoding = 'utf-8')
-         except IOError as e:
-             raise RuntimeError (f'Failed to  open AOF file {self.filename} : {e}')
-         
+             if manifest.exists():
+                 manifest.load()
+             elif self.legacy_filename and os.path.exists(self.legacy_filename):
+                 name, _ = manifest.set_base(False, 1)
+                 os.replace(self.legacy_filename, os.path.join(manifest.dirname, name))
+                 print(f"Moved {self.legacy_filename} into {manifest.dirname} as the AOF base")
+             if not manifest.incrs:
+                 manifest.add_incr()
+                 manifest.save()
+             self.filename = manifest.files()[-1]
+             self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+             self.current_size = self.get_file_size()
+             self.base_size = self.current_size
+         except Exception as e:
+             raise RuntimeError (f'Failed to  open AOF file {self.filename or manifest.path} : {e}')
+         self._remove_files(manifest.unlisted_files())
+         if self.sync_policy == 'everysec' and self._fsync_thread is None:
+             self._closing = False
+             self._fsync_thread = threading.Thread(target=self._fsync_loop, name='aof-fsync', daemon=True)
+             self._fsync_thread.start()
+
     def close(self) -> None:
-            """"Close AOF file"""
-            
-            if self.file_handle:
-                   self.sync_to_disk() #Final sync before closing
-                   self.file_handle.close()
-                   self.file_handle = None
-                   
+            """"Write what is buffered, fsync and close the AOF file"""
+
+            if self.fd is None:
+                return
+            self.flush_buffer(force=True)
+            self._stop_fsync_thread()
+            with self._lock:
+                try:
+                    os.fsync(self.fd)
+                except OSError as e:
+                    print(f"Error syncing AOF file: {e}")
+                os.close(self.fd)
+                self.fd = None
+
     def log_command(self, command:str, *args) -> None:
             """"
-            Log a command to the file if it's a write command 
+            Buffer a write command, it reaches the file at the next flush_buffer()
             """
-            if not self.file_handle  or command.upper() not in self.write_commands:
+            if self.fd is None:
                 return
-            
-            with   self._lock:
+            self.buffer += encode_command((command,) + args)
+
+    def flush_buffer(self, force: bool = False) -> None:
+        """
+        Write the buffered records, called once per event loop iteration
+
+        Args:
+          force: write even while a background fsync is in progress
+        """
+        if not self.buffer or self.fd is None:
+            return
+        if self.sync_policy == 'everysec' and not force and not self._fsync_idle.is_set():
+            #A write() may block behind the fsync on the same file, wait a bit
+            now = time.time()
+            if self._postponed_since is None:
+                self._postponed_since = now
+                return
+            if now - self._postponed_since < MAX_WRITE_POSTPONE:
+                return
+            self.delayed_fsync += 1
+        self._postponed_since = None
+        with self._lock:
+            view = memoryview(self.buffer)
+            written = 0
+            error = None
+            try:
+                while written < len(view):
+                    written += os.write(self.fd, view[written:])
+            except OSError as e:
+                #Only the message is kept, the traceback would hold the view
+                error = str(e)
+            view.release()
+            #Whatever reached the file is accounted once, the rest is kept
+            #and retried at the next iteration
+            self.write_offset += written
+            self.current_size += written
+            del self.buffer[:written]
+            if error is not None:
+                self.last_write_status = 'err'
+                print(f"Error writing to AOF file: {error}")
+                return
+            self.last_write_status = 'ok'
+            if self.sync_policy == 'always':
                 try:
-                    formatted_command = self._format_command(command, *args)
-                    self.file_handle.write(formatted_command)
-                    self.pending_writes += 1
-                    
-                    if self.sync_policy == 'Always' :
-                        self.file_handle.flush()
-                        os.fsync(self.file_handle.fileno())
-                        self.last_sync_time = time.time()
-                        self.pending_writes = 0
-                except IOError as e:
-                    print(f"Error writing to AOF file: {e}")
-                    
-        
-    def _format_command(self, command: str, *args) -> str:
-            timestamp = int(time.time())
-            formmated_args = ' '.join( str(arg) for arg in args)
-            return f"{timestamp} {command} {formmated_args}"
-        
+                    #One fsync for every command of the iteration
+                    os.fsync(self.fd)
+                    self.last_sync_time = time.time()
+                    self.sync_offset = self.write_offset
+                except OSError as e:
+                    self.last_write_status = 'err'
+                    print(f"Error syncing AOF file: {e}")
+
     def sync_to_disk(self) -> None:
-        if not self.file_handle or self.pending_writes == 0:
+        """"fsync what was written, on the background thread for everysec"""
+        if self.fd is None or self.sync_offset == self.write_offset:
                 return
+        if self.sync_policy == 'everysec' and self._fsync_thread is not None:
+            if self._fsync_idle.is_set():
+                self._fsync_idle.clear()
+                self._fsync_requested.set()
+            return
         with self._lock:
              try:
-                 self.file_handle.flush()
-                 os.fsync(self.file_handle.fileno())
+                 os.fsync(self.fd)
                  self.last_sync_time = time.time()
-                 self.pending_writes = 0
-             except IOError as e:
+                 self.sync_offset = self.write_offset
+             except OSError as e:
                  print(f"Error syncing AOF file: {e}")
-                 
-                 
+
+    def _fsync_loop(self) -> None:
+        while True:
+            self._fsync_requested.wait()
+            self._fsync_requested.clear()
+            if self._closing:
+                self._fsync_idle.set()
+                return
+            fd = self.fd
+            #Writes made during the fsync stay pending for the next one
+            offset = self.write_offset
+            try:
+                if fd is not None:
+                    os.fsync(fd)
+                self.last_sync_time = time.time()
+                self.sync_offset = offset
+            except OSError as e:
+                print(f"Error syncing AOF file: {e}")
+            finally:
+                self._fsync_idle.set()
+
+    def _stop_fsync_thread(self) -> None:
+        if self._fsync_thread is None:
+            return
+        self._fsync_idle.wait()
+        self._closing = True
+        self._fsync_requested.set()
+        self._fsync_thread.join()
+        self._fsync_thread = None
+
     def should_sync(self) -> bool:
             if self.sync_policy == 'always':
-                return False #Already synced during log
+                return False #Already synced during flush
             elif self.sync_policy == 'everysec':
-                return time.time() - self.last_sync_time >= 1.0
+                return self.sync_offset != self.write_offset and time.time() - self.last_sync_time >= 1.0
             else:
                 return False # os based sync
-    def rewrite_aof(self,  data_store, temp_filename: str) -> bool:
-          """"
-          Create a compacted version of the AOF file
-         
-          Args:
-           data_store: Current data store state
-           temp_filename: Temporary file to write
-           
-          Returns True if rewrite was successfull
-          """
-          try:
-             with open(temp_filename, 'w', encoding = 'utf-8') as temp_file:
-                 current_time = time.time()
-                 for key in data_store.keys():
-                      value = data_store.get(key)
-                      if value is not None:
-                          "GET ttl if exist"
-                          ttl = data_store.ttl(key)
-                          
-                          "Write SET command"
-                          temp_file.write(f"{current_time} SET {key}  {value}\n")
-                          
-                          "Write Expire command if TTL exists"
-                          
-                          if ttl > 0:
-                              temp_file.write(f"{current_time} EXPIRE {key} {ttl}\n")
-             "Replace original  file"
-             shutil.move(temp_filename, self.filename)
-             
-             "Reopen file handle if it was open"
-             if self.file_handle:
-                 self.file_handle.close()
-                 self.open()
-          except Exception as e:
-               print(f"Error during AOF rewrite: {e}")
-               
-               if  os.path.exists(temp_filename):
-                    os.remove(temp_filename)
-               return  False
+    def rotate(self) -> int:
+        """
+        Continue logging in a new incremental file, at the start of a rewrite
+
+        The rewrite's base replaces every file before it. Returns the seq
+        of the new file
+        """
+        manifest = self.manifest
+        self.flush_buffer(force=True)
+        previous = list(manifest.incrs)
+        name = manifest.add_incr()
+        filename = os.path.join(manifest.dirname, name)
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except OSError:
+            manifest.incrs = previous
+            raise
+        try:
+            manifest.save()
+        except OSError:
+            manifest.incrs = previous
+            os.close(fd)
+            os.remove(filename)
+            raise
+        with self._lock:
+            old_fd, self.fd = self.fd, fd
+            self.filename = filename
+            #Whatever the old file still needs is fsynced below
+            self.sync_offset = self.write_offset
+        if old_fd is not None:
+            threading.Thread(target=self._close_rotated, args=(old_fd,), daemon=True).start()
+        return manifest.incrs[-1][1]
+
+    def _close_rotated(self, fd: int) -> None:
+        #A background fsync may still be using the old descriptor
+        self._fsync_idle.wait()
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            print(f"Error syncing AOF file: {e}")
+        os.close(fd)
+
+    def install_base(self, temp_filename: str, use_rdb: bool, first_incr_seq: int) -> bool:
+        """
+        Make a rewritten base the start of the AOF
+
+        The incremental files before first_incr_seq and the previous base
+        are dropped from the manifest and deleted. The file being appended
+        to is not touched. Returns True if the manifest now lists the base
+        """
+        manifest = self.manifest
+        previous = (manifest.base, list(manifest.incrs))
+        name, replaced = manifest.set_base(use_rdb, first_incr_seq)
+        try:
+            os.replace(temp_filename, os.path.join(manifest.dirname, name))
+            manifest.save()
+        except OSError as e:
+            print(f"Error installing AOF base: {e}")
+            manifest.base, manifest.incrs = previous
+            return False
+        self._remove_files([os.path.join(manifest.dirname, old) for old in replaced])
+        self.current_size = self.get_file_size()
+        self.base_size = self.current_size
+        return True
+
+    @staticmethod
+    def _remove_files(paths) -> None:
+        """Delete files on a thread, freeing a large file can take a while"""
+        if not paths:
+            return
+        def remove():
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Error removing old AOF file {path}: {e}")
+        threading.Thread(target=remove, daemon=True).start()
+
     def get_file_size(self) -> int:
-            try:
-                return os.path.getsize(self.filename)
-            except OSError:
-                return  0
-    
+            """Total size of the base and incremental files"""
+            size = 0
+            for path in self.manifest.files():
+                try:
+                    size += os.path.getsize(path)
+                except OSError:
+                    pass
+            return size
+
     def needs_rewrite(self, min_size: int, percentage: int) -> bool:
-        
+
         """"
         Check if AOF needs rewriting based on size thresholds
-        
+
+        Args:
+          min_size: no rewrite below this size
+          percentage: growth over base_size that triggers a rewrite, 0
+            disables automatic rewrites
+
         Returns:
           True if AOF should be rewritten
-        
+
         """
-        current_size = self.get_file_size()
+        if percentage <= 0 or self.fd is None:
+            return False
+        current_size = self.current_size
         if current_size < min_size:
             return False
-        
-        return current_size > min_size * 2
\ No newline at end of file
+        base_size = self.base_size or 1
+        return (current_size - base_size) * 100 >= percentage * base_size
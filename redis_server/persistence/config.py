@@ -1,6 +1,6 @@
 import os
-import  time
-from typing import List,Tuple, Dict,Any
+from typing import List,Tuple, Dict,Any, Optional
+from ..eviction import EVICTION_POLICIES, parse_memory
 
 class   PersistenceConfig:
     
@@ -23,10 +23,21 @@ class   PersistenceConfig:
             #AOF configuration
             'aof_enabled': True,
             'aof_filename': 'appendonly.aof',
+            #Multi-part AOF: base and incremental files plus a manifest,
+            #the base is written as a snapshot when rdb_preamble is on
+            'aof_dirname': 'appendonlydir',
+            'aof_use_rdb_preamble' : True,
             'aof_sync_policy' : 'everysec',
+             #Rewrite once the AOF grew this many percent over its size after
+             #the last rewrite and is at least min_size, 0 disables it
              'aof_rewrite_percentage' : 100,
              'aof_rewrite_min_size' : 1024  * 1024,
              
+             #Snapshot configuration: BGSAVE after <seconds> when at least
+             #<changes> writes happened, pairs separated by spaces, "" disables
+            'snapshot_filename' : 'dump.rdb',
+            'save' : '3600 1 300 100 60 10000',
+             
              #Directory Configuration
             'data_dir' : './data',
             'temp_dir' : './data/temp',
@@ -34,7 +45,48 @@ class   PersistenceConfig:
             #General Settings
             'persistence_enabled' : True,
             'recovery_on_startup' : True,
-            'max_memory_usage' : 100 * 1024 * 1024,
+            #Load the dataset in slices of loading_slice_ms between event
+            #loop iterations, answering PING and INFO meanwhile
+            'async_loading' : False,
+            'loading_slice_ms' : 20,
+            #0 means no limit, like Redis
+            'max_memory_usage' : 0,
+            'maxmemory_policy' : 'noeviction',
+            'maxmemory_samples' : 5,
+            
+            #Replication: "<host> <port>" of the master to follow on startup,
+            #bytes of stream kept for partial resyncs and the link timeout
+            'replicaof' : '',
+            'repl_backlog_size' : 1024 * 1024,
+            'repl_timeout' : 60,
+            
+            #Cluster mode: hash slots served by this node, the node table is
+            #kept in cluster_config_file inside data_dir; nodes silent for
+            #cluster_node_timeout milliseconds are flagged as failing
+            'cluster_enabled' : False,
+            'cluster_config_file' : 'nodes.conf',
+            'cluster_node_timeout' : 15000,
+            
+            #Client output buffer limits, 0 disables a limit
+            'client_output_buffer_hard_limit' : 256 * 1024 * 1024,
+            'client_output_buffer_soft_limit' : 64 * 1024 * 1024,
+            'client_output_buffer_soft_seconds' : 60,
+            
+            #Active expiry: share of each 100ms cleanup tick the slow cycle may
+            #use, and the stale percentage above which fast cycles run
+            'active_expire_cycle_time_percent' : 25,
+            'active_expire_acceptable_stale' : 10,
+            
+            #Quicklist node size: entries per node when positive, -1 to -5
+            #for 4KB to 64KB nodes
+            'list_max_listpack_size' : -2,
+            #Hashes move from listpack to a dict past either limit
+            'hash_max_listpack_entries' : 128,
+            'hash_max_listpack_value' : 64,
+            'zset_max_listpack_entries' : 128,
+            'zset_max_listpack_value' : 64,
+            #Integer-only sets stay intsets up to this many members
+            'set_max_intset_entries' : 512,
              
             
         }
@@ -47,13 +99,53 @@ class   PersistenceConfig:
              
       if not self._config['aof_filename'] :
           raise ValueError("AOF filename cannot be empty")
+      
+      if not self._config['aof_dirname'] or os.sep in self._config['aof_dirname']:
+          raise ValueError("AOF dirname must be a directory name inside data_dir")
+      
+      self._config['aof_rewrite_percentage'] = int(self._config['aof_rewrite_percentage'])
+      if self._config['aof_rewrite_percentage'] < 0:
+          raise ValueError("aof_rewrite_percentage cannot be negative, 0 disables automatic rewrites")
+      self._config['aof_rewrite_min_size'] = parse_memory(self._config['aof_rewrite_min_size'])
+      
+      if not self._config['snapshot_filename'] :
+          raise ValueError("Snapshot filename cannot be empty")
+      
+      self.save_points
+      
+      if self._config['maxmemory_policy'] not in EVICTION_POLICIES:
+          raise ValueError(f"Invalid maxmemory policy. Must be one of {EVICTION_POLICIES}")
+      self._config['maxmemory_samples'] = int(self._config['maxmemory_samples'])
+      if self._config['maxmemory_samples'] < 1:
+          raise ValueError("maxmemory_samples must be at least 1")
+      
+      #Accept sizes like 100mb, stored as bytes
+      self._config['max_memory_usage'] = parse_memory(self._config['max_memory_usage'])
+      
+      self._config['repl_backlog_size'] = parse_memory(self._config['repl_backlog_size'])
+      if self._config['repl_backlog_size'] < 16 * 1024:
+          raise ValueError("repl_backlog_size must be at least 16kb")
+      self._config['repl_timeout'] = int(self._config['repl_timeout'])
+      self.master_address
+      
+      if not self._config['cluster_config_file'] or os.sep in self._config['cluster_config_file']:
+          raise ValueError("cluster_config_file must be a file name inside data_dir")
+      self._config['cluster_node_timeout'] = int(self._config['cluster_node_timeout'])
+      if self._config['cluster_node_timeout'] <= 0:
+          raise ValueError("cluster_node_timeout must be positive")
     
     def get(self, key: str, default = None):
         return self._config.get(key, default)
     
     def set (self, key : str, value : Any) -> None:
+        previous = self._config.copy()
         self._config[key] = value
-        self._validate_config()
+        try:
+            self._validate_config()
+        except Exception:
+            #Keep the last valid configuration
+            self._config = previous
+            raise
     def update(self, config_dict:  Dict[str, Any]) -> None:
         self._config.update(config_dict)
         self._validate_config()
@@ -70,10 +162,41 @@ class   PersistenceConfig:
     def aof_filename(self) -> str:
         return os.path.join(self._config['data_dir'], self._config['aof_filename'])
     
+    @property
+    def aof_dir(self) -> str:
+        return os.path.join(self._config['data_dir'], self._config['aof_dirname'])
+    
     @property
     def aof_sync_policy(self) -> str:
         return self._config['aof_sync_policy']
     
+    @property
+    def snapshot_filename(self) -> str:
+        return os.path.join(self._config['data_dir'], self._config['snapshot_filename'])
+    
+    @property
+    def save_points(self) -> List[Tuple[int, int]]:
+        """(seconds, changes) pairs of the save schedule"""
+        values = str(self._config['save']).split()
+        if len(values) % 2:
+            raise ValueError("Invalid save schedule. Must be <seconds> <changes> pairs")
+        try:
+            numbers = [int(value) for value in values]
+        except ValueError:
+            raise ValueError("Invalid save schedule. Must be <seconds> <changes> pairs")
+        return list(zip(numbers[::2], numbers[1::2]))
+    
+    @property
+    def master_address(self) -> Optional[Tuple[str, int]]:
+        """(host, port) of the replicaof setting, None when unset"""
+        if not self._config['replicaof']:
+            return None
+        try:
+            host, port = str(self._config['replicaof']).split()
+            return host, int(port)
+        except ValueError:
+            raise ValueError("replicaof must be '<host> <port>'")
+    
     @property 
     def data_dir(self) ->   str:
         return self._config['data_dir']
@@ -87,8 +210,13 @@ class   PersistenceConfig:
         os.makedirs(self.temp_dir,exist_ok=True)
 
     def get_aof_temp_filename(self) -> str:
-           
-        return os.path.join(self.temp_dir, f"temp-rewrite-aof-{int(time.time())}.aof")
+        #Written next to the AOF files so installing it is a rename, the
+        #AOF prefix lets startup remove one left by a crash
+        return os.path.join(self.aof_dir, f"{self._config['aof_filename']}.rewrite-{os.getpid()}.tmp")
+    
+    def get_snapshot_temp_filename(self) -> str:
+        #The pid keeps a SAVE and a BGSAVE child from sharing a file
+        return os.path.join(self.temp_dir, f"temp-{os.getpid()}.rdb")
     def __repr__(self):
         
         return f"PersistenceConfig({self._config})"
@@ -1,9 +1,19 @@
+import gc
+import os
+import signal
+import sys
 import time
 import threading
 from typing import Optional, Dict, Any
 from .config import PersistenceConfig
-from .aof import AOFWriter
-from .recovery import RecoveryManager
+from .aof import AOFWriter, write_rewrite
+from .recovery import RecoveryManager, SLICED_PARSE_WINDOW
+from .snapshot import LOAD_BATCH, save_snapshot
+
+#Seconds before a scheduled BGSAVE is retried after a failed one
+BGSAVE_RETRY_DELAY = 5
+#Seconds before an automatic AOF rewrite is retried after a failed one
+AOF_REWRITE_RETRY_DELAY = 5
 
 class  PersistenceManager:
     
@@ -17,6 +27,30 @@ class  PersistenceManager:
         self.recovery_manager = None
         self.last_aof_sync_time = time.time()
         
+        #Write commands since the last successful snapshot
+        self.dirty = 0
+        self.lastsave = int(time.time())
+        #pid of the forked BGSAVE child while one is running
+        self.bgsave_child = None
+        self.bgsave_start_time = 0.0
+        self.dirty_before_bgsave = 0
+        self.last_bgsave_try = 0.0
+        self.last_bgsave_status = 'ok'
+        self.last_bgsave_time_sec = -1
+        #pid of the forked AOF rewrite child and the file it writes
+        self.aof_rewrite_child = None
+        self.aof_rewrite_temp_filename = None
+        #seq of the incremental file opened when the rewrite started
+        self.aof_rewrite_first_incr = 0
+        self.aof_rewrite_start_time = 0.0
+        self.last_aof_rewrite_try = 0.0
+        #BGREWRITEAOF arrived during a BGSAVE, it starts once that ends
+        self.aof_rewrite_scheduled = False
+        self.last_aof_rewrite_status = 'ok'
+        self.last_aof_rewrite_time_sec = -1
+        #Rewrites that completed since startup
+        self.aof_rewrites = 0
+        
         self._lock =  threading.Lock()
         
         self._initialize_components()
@@ -26,12 +60,18 @@ class  PersistenceManager:
         
      if self.config.aof_enabled:
          self.aof_writer = AOFWriter(
-             self.config.aof_filename,
-             self.config.aof_sync_policy
+             self.config.aof_dir,
+             self.config.get('aof_filename'),
+             self.config.aof_sync_policy,
+             legacy_filename=self.config.aof_filename
          )
          
      self.recovery_manager = RecoveryManager(
-         self.config.aof_filename
+         self.config.aof_dir,
+         self.config.get('aof_filename'),
+         self.config.snapshot_filename,
+         self.config.aof_enabled,
+         int(self.config.get('list_max_listpack_size', -2))
      )
      
     def start(self) -> None:
@@ -42,8 +82,10 @@ class  PersistenceManager:
         print(f"Persistence manager started  with   AOF enabled:{self.config.aof_enabled}")
         
     def stop(self) -> None:
+     if self.aof_rewrite_child is not None:
+         self._kill_aof_rewrite()
      if self.aof_writer:
-         self.aof_writer.open()
+         self.aof_writer.close()
      print("Persistence manager stopped")   
      
     def recover_data(self, data_store, command_handler = None) -> bool:
@@ -54,19 +96,52 @@ class  PersistenceManager:
            return self.recovery_manager.recover_data(data_store, command_handler)
            
        return True
+    
+    @property
+    def loading(self) -> bool:
+        """True while the dataset is still being loaded in the background"""
+        return self.recovery_manager is not None and self.recovery_manager.loading
+    
+    def begin_loading(self, data_store, command_handler = None) -> None:
+        """Start a load that the event loop runs with load_step()"""
+        if not self.config.get('recovery_on_startup', True):
+            print("Recovery on startup disabled")
+            return
+        if self.recovery_manager:
+            self.recovery_manager.begin_loading(data_store, command_handler,
+                                                SLICED_PARSE_WINDOW, LOAD_BATCH)
+    
+    def load_step(self) -> Optional[bool]:
+        """
+        Load for one time slice (loading_slice_ms)
+        
+        Returns None while loading goes on, then whether it succeeded
+        """
+        if not self.recovery_manager:
+            return True
+        return self.recovery_manager.load_step(self.config.get('loading_slice_ms', 20) / 1000.0)
        
     def log_write_command(self, command: str, *args) ->  None:  
         """"
         Log a write command (FOR AOF)
         
+        Called by CommandHandler.execute once a write command succeeded,
+        with the command as it should be replayed
+        
         Args:
         command: Command Name
         *args : Command arguments
         """
-        if self.aof_writer and self._is_write_command(command):
+        self.dirty += 1
+        if self.aof_writer:
           self.aof_writer.log_command(command,  *args)
+    
+    def flush_aof(self) -> None:
+        """Write the AOF buffer, the event loop calls it before sending replies"""
+        if self.aof_writer:
+            self.aof_writer.flush_buffer()
         
-    def periodic_tasks(self) -> None:
+    def periodic_tasks(self, data_store = None) -> None:
     
       """"
       This is for periodic  persistence  tasks
@@ -75,48 +150,228 @@ class  PersistenceManager:
       current_time = time.time()
       
       if self.aof_writer:
+          #Retries a write postponed behind a slow fsync even when idle
+          self.aof_writer.flush_buffer()
           if self.aof_writer.should_sync():
                self.aof_writer.sync_to_disk()
-               self.last_aof_sync_time  = current_time
+          self.last_aof_sync_time = self.aof_writer.last_sync_time
+      
+      if self.loading:
+          #No child may snapshot a dataset that is only partly loaded
+          return
+      if self.aof_rewrite_child is not None:
+          self._reap_aof_rewrite()
+      elif self.bgsave_child is not None:
+          self._reap_bgsave()
+      elif data_store is not None and self.aof_rewrite_scheduled:
+          self.rewrite_aof_background(data_store)
+      elif data_store is not None and self._aof_growth_reached(current_time):
+          print(f"Starting automatic rewriting of AOF on {self._aof_growth():.0f}% growth")
+          self.rewrite_aof_background(data_store)
+      elif data_store is not None and self._save_point_reached(current_time):
+          self.bgsave(data_store)
+    
+    def _save_point_reached(self, current_time: float) -> bool:
+        if self.last_bgsave_status != 'ok' and current_time - self.last_bgsave_try < BGSAVE_RETRY_DELAY:
+            return False
+        elapsed = current_time - self.lastsave
+        return any(self.dirty >= changes and elapsed >= seconds
+                   for seconds, changes in self.config.save_points)
+    
+    def _aof_growth_reached(self, current_time: float) -> bool:
+        if not self.aof_writer:
+            return False
+        if self.last_aof_rewrite_status != 'ok' and current_time - self.last_aof_rewrite_try < AOF_REWRITE_RETRY_DELAY:
+            return False
+        return self.aof_writer.needs_rewrite(self.config.get('aof_rewrite_min_size'),
+                                             self.config.get('aof_rewrite_percentage'))
+    
+    def _aof_growth(self) -> float:
+        """Growth of the AOF since the last rewrite, in percent"""
+        base_size = self.aof_writer.base_size or 1
+        return (self.aof_writer.current_size - base_size) * 100.0 / base_size
+    
+    def save(self, data_store) -> bool:
+        """Write a snapshot in the foreground, blocking every client"""
+        try:
+            keys = save_snapshot(data_store, self.config.snapshot_filename,
+                                 self.config.get_snapshot_temp_filename())
+        except Exception as e:
+            print(f"Error saving snapshot: {e}")
+            return False
+        print(f"DB saved on disk ({keys} keys)")
+        self.dirty = 0
+        self.lastsave = int(time.time())
+        return True
+    
+    def bgsave(self, data_store) -> bool:
+        """
+        Fork a child that writes the snapshot while this process keeps serving
+        
+        The child sees the dataset as it was at fork time; pages are only
+        copied when the parent modifies them. Returns False if a BGSAVE or
+        an AOF rewrite is already running or the fork failed
+        """
+        if self.bgsave_child is not None or self.aof_rewrite_child is not None:
+            return False
+        self.last_bgsave_try = time.time()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            print(f"Can't save in background: fork: {e}")
+            self.last_bgsave_status = 'err'
+            return False
+        if pid == 0:
+            #A collection would write to the header of every object and copy
+            #every page of the parent, the child exits before it matters
+            gc.disable()
+            exit_code = 1
+            try:
+                keys = save_snapshot(data_store, self.config.snapshot_filename,
+                                     self.config.get_snapshot_temp_filename())
+                print(f"DB saved on disk ({keys} keys)")
+                exit_code = 0
+            except Exception as e:
+                print(f"Error saving snapshot: {e}")
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+        print(f"Background saving started by pid {pid}")
+        self.bgsave_child = pid
+        self.bgsave_start_time = time.time()
+        self.dirty_before_bgsave = self.dirty
+        return True
+    
+    def _reap_bgsave(self) -> None:
+        try:
+            pid, status = os.waitpid(self.bgsave_child, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = self.bgsave_child, 1
+        if pid == 0:
+            return
+        self.bgsave_child = None
+        self.last_bgsave_time_sec = int(time.time() - self.bgsave_start_time)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            print("Background saving terminated with success")
+            #Writes made while the child was saving are not in the snapshot
+            self.dirty -= self.dirty_before_bgsave
+            self.lastsave = int(self.bgsave_start_time)
+            self.last_bgsave_status = 'ok'
+        else:
+            print("Background saving error")
+            self.last_bgsave_status = 'err'
      
     def rewrite_aof_background(self, data_store) -> bool:
-          if not  self.aof_writer:
-              return False
-          
-          try:
-              def background_rewrite():
-                  
-                  temp_filename = self.config.get_aof_temp_filename()
-                  success = self.aof_writer.rewrite_aof(data_store, temp_filename)
-                  if success:
-                      print("Background AOF rewrite completed")
-                  else:
-                      print("Background AOF rewrite failed")
-                  
-              thread = threading.Thread(target=background_rewrite, daemon = True)
-              thread.start()
-              return True
-          except Exception as e:
-              print(f"Error starting background AOF rewrite: {e}")
-              return False
+        """
+        Fork a child that writes a new AOF base from its copy-on-write view
+        
+        Writes go to a new incremental file from now on, the base replaces
+        the files before it once the child is done. Returns False if a
+        child is already running or the fork failed
+        """
+        if not self.aof_writer:
+            return False
+        if self.aof_rewrite_child is not None or self.bgsave_child is not None:
+            return False
+        self.aof_rewrite_scheduled = False
+        self.last_aof_rewrite_try = time.time()
+        temp_filename = self.config.get_aof_temp_filename()
+        use_rdb = bool(self.config.get('aof_use_rdb_preamble', True))
+        try:
+            first_incr = self.aof_writer.rotate()
+            pid = os.fork()
+        except OSError as e:
+            print(f"Can't rewrite append only file in background: {e}")
+            self.last_aof_rewrite_status = 'err'
+            return False
+        if pid == 0:
+            gc.disable()
+            exit_code = 1
+            try:
+                keys = write_rewrite(data_store, temp_filename, use_rdb)
+                print(f"AOF rewrite: {keys} keys written")
+                exit_code = 0
+            except Exception as e:
+                print(f"Error during AOF rewrite: {e}")
+            finally:
+                sys.stdout.flush()
+                os._exit(exit_code)
+        print(f"Background append only file rewriting started by pid {pid}")
+        self.aof_rewrite_child = pid
+        self.aof_rewrite_temp_filename = temp_filename
+        self.aof_rewrite_use_rdb = use_rdb
+        self.aof_rewrite_first_incr = first_incr
+        self.aof_rewrite_start_time = time.time()
+        return True
+    
+    def restart_aof(self, data_store) -> None:
+        """
+        Rebuild the AOF from data_store, after a replica replaced its dataset
+        
+        A rewrite already running covers the old dataset and is dropped
+        """
+        if not self.aof_writer:
+            return
+        if self.aof_rewrite_child is not None:
+            self._kill_aof_rewrite()
+        if not self.rewrite_aof_background(data_store):
+            self.aof_rewrite_scheduled = True
+    
+    def _reap_aof_rewrite(self) -> None:
+        try:
+            pid, status = os.waitpid(self.aof_rewrite_child, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = self.aof_rewrite_child, 1
+        if pid == 0:
+            return
+        self.aof_rewrite_child = None
+        temp_filename, self.aof_rewrite_temp_filename = self.aof_rewrite_temp_filename, None
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0 and self.aof_writer.install_base(
+                temp_filename, self.aof_rewrite_use_rdb, self.aof_rewrite_first_incr):
+            print("Background AOF rewrite terminated with success")
+            self.last_aof_rewrite_status = 'ok'
+            self.aof_rewrites += 1
+        else:
+            #The incremental files still hold every write, nothing is lost
+            print("Background AOF rewrite error")
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            self.last_aof_rewrite_status = 'err'
+        self.last_aof_rewrite_time_sec = int(time.time() - self.aof_rewrite_start_time)
+    
+    def _kill_aof_rewrite(self) -> None:
+        try:
+            os.kill(self.aof_rewrite_child, signal.SIGKILL)
+            os.waitpid(self.aof_rewrite_child, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        self.aof_rewrite_child = None
+        if os.path.exists(self.aof_rewrite_temp_filename):
+            os.remove(self.aof_rewrite_temp_filename)
+        self.aof_rewrite_temp_filename = None
       
     def get_stats(self) -> Dict[str, Any]:
         """Get persistence statistics"""
         return{
             'aof_enabled':self.config.aof_enabled,
             'last_aof_sync_time' : int(self.last_aof_sync_time),
-             'aof_filename' :   self.config.aof_filename  if self.config.aof_enabled else None
-           }
-      
-        
-    def _is_write_command(self, command : str) -> bool:
-        """" 
-        Check if command is a write command that should be logged
-        """
-        write_commands = {
-            'SET', 'DEL',  'EXPIRE' , 'EXPIREAT', 'PERSIST', 'FLUSHALL', 'SETEX', 'SETNX', 'MSET', 'MSETNX', 'APPEND', 'INCR',
-             'DECR', 'INCRBY', 'DECRBY', 'LPUSH', 'RPUSH', 'LPOP', 'RPOP', 'SADD',
-             'SREM', 'SPOP', 'HSET', 'HDEL', 'HINCRBY', 'ZADD', 'ZREM'
-        }
-        
-        return command.upper() in write_commands
\ No newline at end of file
+             'aof_filename' :   self.aof_writer.filename  if self.aof_writer else None,
+            'changes_since_last_save' : self.dirty,
+            'bgsave_in_progress' : self.bgsave_child is not None,
+            'last_save_time' : self.lastsave,
+            'last_bgsave_status' : self.last_bgsave_status,
+            'last_bgsave_time_sec' : self.last_bgsave_time_sec,
+            'aof_pending_bytes' : len(self.aof_writer.buffer) if self.aof_writer else 0,
+            'aof_delayed_fsync' : self.aof_writer.delayed_fsync if self.aof_writer else 0,
+            'aof_last_write_status' : self.aof_writer.last_write_status if self.aof_writer else 'ok',
+            'aof_rewrite_in_progress' : self.aof_rewrite_child is not None,
+            'aof_rewrite_scheduled' : self.aof_rewrite_scheduled,
+            'aof_last_rewrite_time_sec' : self.last_aof_rewrite_time_sec,
+            'aof_current_rewrite_time_sec' : int(time.time() - self.aof_rewrite_start_time)
+                                             if self.aof_rewrite_child is not None else -1,
+            'aof_last_bgrewrite_status' : self.last_aof_rewrite_status,
+            'aof_rewrites' : self.aof_rewrites,
+            'aof_current_size' : self.aof_writer.current_size if self.aof_writer else 0,
+            'aof_base_size' : self.aof_writer.base_size if self.aof_writer else 0,
+            'loading' : self.recovery_manager.loading_info() if self.recovery_manager else {},
+           }
\ No newline at end of file
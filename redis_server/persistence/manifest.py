@@ -0,0 +1,142 @@
+"""
+Multi-part AOF manifest
+
+The AOF is a directory of files listed by a manifest, one line per file:
+
+    file appendonly.aof.3.base.rdb seq 3 type b
+    file appendonly.aof.7.incr.aof seq 7 type i
+    file appendonly.aof.8.incr.aof seq 8 type i
+
+The base holds the dataset as of a rewrite, as a snapshot or as RESP
+commands, and the incremental files the commands logged after it, in seq
+order. Writes always go to the last incremental file. A rewrite opens a
+new incremental file first, then replaces the base and every older
+incremental file with the one it wrote, so nothing is copied and the
+active file is never touched. The manifest is replaced atomically, files
+it no longer lists are deleted.
+"""
+import os
+from typing import List, Optional, Tuple
+
+TYPE_BASE = 'b'
+TYPE_INCR = 'i'
+
+
+class ManifestError(Exception):
+    """Raised for a manifest that cannot be parsed or lists no usable files"""
+
+
+def fsync_directory(dirname: str) -> None:
+    """Make renames and new files in dirname durable"""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AOFManifest:
+
+    def __init__(self, dirname: str, basename: str):
+        """
+        Args:
+        dirname: directory holding the manifest and the files it lists
+        basename: prefix of every file name, the aof_filename setting
+        """
+        self.dirname = dirname
+        self.basename = basename
+        #(file name, seq) of the base, None before the first rewrite
+        self.base: Optional[Tuple[str, int]] = None
+        #(file name, seq) of the incremental files in replay order
+        self.incrs: List[Tuple[str, int]] = []
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.dirname, f"{self.basename}.manifest")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self) -> None:
+        base = None
+        incrs = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                info = dict(zip(fields[::2], fields[1::2]))
+                if len(fields) % 2 or not {'file', 'seq', 'type'} <= info.keys():
+                    raise ManifestError(f"invalid manifest line {number}: {line.strip()}")
+                try:
+                    entry = (info['file'], int(info['seq']))
+                except ValueError:
+                    raise ManifestError(f"invalid seq on manifest line {number}")
+                if os.sep in entry[0]:
+                    raise ManifestError(f"manifest file name {entry[0]} is not in the AOF directory")
+                if info['type'] == TYPE_BASE:
+                    if base is not None:
+                        raise ManifestError("manifest lists more than one base file")
+                    base = entry
+                elif info['type'] == TYPE_INCR:
+                    incrs.append(entry)
+                #History entries of Redis manifests are ignored, those
+                #files are no longer part of the dataset
+        incrs.sort(key=lambda entry: entry[1])
+        self.base = base
+        self.incrs = incrs
+
+    def save(self) -> None:
+        """Write the manifest to a temp file, fsync it and rename it over the old one"""
+        lines = []
+        if self.base is not None:
+            lines.append(f"file {self.base[0]} seq {self.base[1]} type {TYPE_BASE}\n")
+        for name, seq in self.incrs:
+            lines.append(f"file {name} seq {seq} type {TYPE_INCR}\n")
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        fsync_directory(self.dirname)
+
+    def files(self) -> List[str]:
+        """Paths of every listed file, base first"""
+        names = [self.base[0]] if self.base is not None else []
+        names.extend(name for name, _ in self.incrs)
+        return [os.path.join(self.dirname, name) for name in names]
+
+    def add_incr(self) -> str:
+        """List a new incremental file after the last one and return its name"""
+        seq = self.incrs[-1][1] + 1 if self.incrs else 1
+        name = f"{self.basename}.{seq}.incr.aof"
+        self.incrs.append((name, seq))
+        return name
+
+    def set_base(self, rdb: bool, first_incr_seq: int) -> Tuple[str, List[str]]:
+        """
+        List a new base that covers every incremental file before first_incr_seq
+
+        Returns the new base name and the names no longer listed
+        """
+        seq = self.base[1] + 1 if self.base is not None else 1
+        name = f"{self.basename}.{seq}.base.{'rdb' if rdb else 'aof'}"
+        replaced = [self.base[0]] if self.base is not None else []
+        replaced.extend(incr for incr, incr_seq in self.incrs if incr_seq < first_incr_seq)
+        self.base = (name, seq)
+        self.incrs = [entry for entry in self.incrs if entry[1] >= first_incr_seq]
+        return name, replaced
+
+    def unlisted_files(self) -> List[str]:
+        """Files of this AOF left behind by a crash or an interrupted rewrite"""
+        listed = {self.base[0]} if self.base is not None else set()
+        listed.update(name for name, _ in self.incrs)
+        listed.add(os.path.basename(self.path))
+        prefix = self.basename + '.'
+        try:
+            names = os.listdir(self.dirname)
+        except OSError:
+            return []
+        return [os.path.join(self.dirname, name) for name in names
+                if name.startswith(prefix) and name not in listed]
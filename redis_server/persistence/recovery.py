@@ -1,136 +1,388 @@
 
 """
 Data Recovery management
-it recovers data from AOF file in startup
+it recovers data from AOF file or snapshot in startup
+
+Like Redis the AOF wins when it is enabled, it holds every write while a
+snapshot only holds the state at its last save. The AOF is loaded as
+its manifest lists it: the base, then every incremental file in order.
+
+AOF files are memory-mapped and parsed in batches of records. Runs of
+plain SET records, most of a typical AOF, go into the data store with
+one DataStore.load() call per batch; every other command is replayed
+through the command table.
+
+Loading is a generator that stops after every batch, so a server can
+also load in time slices between event loop iterations (load_step).
 """
+import mmap
 import os
 import time
+from itertools import compress
 from typing import Optional, Dict
-from .aof import AOFWriter
+from .manifest import AOFManifest
+from .snapshot import MAGIC, load_snapshot_steps
+from ..protocol import ENCODING, ENCODING_ERRORS, RESPParser, canonical_int
+
+#Bytes of AOF handed to the parser at a time
+AOF_READ_CHUNK = 1024 * 1024
+#Seconds between two loading progress lines
+LOADING_LOG_INTERVAL = 2.0
+#Replay errors printed before they are only counted
+MAX_REPORTED_FAILURES = 10
+
+
+#Bytes of AOF decoded and split at a time by the parser
+AOF_PARSE_WINDOW = 256 * 1024
+#Smaller steps when loading in time slices, about 15ms of work each
+SLICED_PARSE_WINDOW = 32 * 1024
+#Headers the parser resolves with a dict lookup, others take the slow path
+_MULTIBULK_HEADERS = {f"*{count}": count for count in range(1, 1025)}
+_BULK_HEADERS = {f"${length}": length for length in range(0, 4097)}
+
+
+class AOFFormatError(ValueError):
+    """Raised for bytes that are not a RESP multi-bulk record"""
+
+
+def _parse_record(data, pos: int, size: int):
+    """One record at pos, (args, end) or (None, pos) if it is incomplete"""
+    find = data.find
+    if data[pos] != 42:  # '*'
+        raise AOFFormatError(f"expected '*' at offset {pos}")
+    end = find(b"\r\n", pos)
+    if end == -1:
+        return None, pos
+    try:
+        argc = int(data[pos + 1:end])
+    except ValueError:
+        raise AOFFormatError(f"invalid multibulk length at offset {pos}")
+    args = []
+    cursor = end + 2
+    for _ in range(argc):
+        end = find(b"\r\n", cursor)
+        if end == -1:
+            return None, pos
+        if data[cursor] != 36:  # '$'
+            raise AOFFormatError(f"expected '$' at offset {cursor}")
+        try:
+            start = end + 2
+            cursor = start + int(data[cursor + 1:end]) + 2
+        except ValueError:
+            raise AOFFormatError(f"invalid bulk length at offset {cursor}")
+        if cursor > size:
+            return None, pos
+        if data[cursor - 2:cursor] != b"\r\n":
+            raise AOFFormatError(f"bulk not terminated by CRLF at offset {cursor - 2}")
+        args.append(str(data[start:cursor - 2], ENCODING, ENCODING_ERRORS))
+    return args, cursor
+
+
+def parse_aof_records(data, pos: int, window_size: int = AOF_PARSE_WINDOW):
+    """
+    Parse the records of data that start in the window at pos
+
+    The window is decoded and split on CRLF in one go and each record is
+    a slice of the pieces. The pieces are then checked in bulk: every
+    argument must be as long as its header says, which fails for an
+    argument holding CRLF or non-ASCII text. Such windows, long values
+    and malformed records are parsed record by record from the bytes.
+    Returns (commands, end of the last record); no commands means the
+    record at pos is incomplete, which can only happen at the end of file.
+    A malformed record raises AOFFormatError only when it is the one at
+    pos, the records before it are returned first
+    """
+    window = data[pos:pos + window_size]
+    #The piece after the last CRLF is incomplete
+    pieces = str(window, ENCODING, ENCODING_ERRORS).split("\r\n")
+    last = len(pieces) - 1
+    multibulk_headers = _MULTIBULK_HEADERS.get
+    commands = []
+    starts = []
+    index = 0
+    while index < last:
+        argc = multibulk_headers(pieces[index])
+        if argc is None:
+            break
+        end = index + 1 + 2 * argc
+        if end > last:
+            break
+        starts.append(index)
+        commands.append(pieces[index + 2:end:2])
+        index = end
+    if commands:
+        #Headers and arguments alternate once the record headers are dropped
+        mask = bytearray(b"\x01") * index
+        for start in starts:
+            mask[start] = 0
+        body = list(compress(pieces[:index], mask))
+        if list(map(len, body[1::2])) == list(map(_BULK_HEADERS.get, body[0::2])):
+            #Every argument is ASCII, so characters count bytes
+            return commands, pos + sum(map(len, pieces[:index])) + 2 * index
+    commands = []
+    size = len(data)
+    window_end = pos + window_size
+    while pos < size and (pos < window_end or not commands):
+        try:
+            args, end = _parse_record(data, pos, size)
+        except AOFFormatError:
+            if not commands:
+                raise
+            #The next call starts at the bad record and reports it
+            break
+        if args is None:
+            break
+        if args:
+            commands.append(args)
+        pos = end
+    return commands, pos
 
 
 class  RecoveryManager:
     
-    def __init__(self, aof_filename:str):
-        self.aof_filename = aof_filename
+    def __init__(self, aof_dir: str, aof_basename: str, snapshot_filename: Optional[str] = None,
+                 aof_enabled: bool = True, list_fill: int = -2):
+        self.manifest = AOFManifest(aof_dir, aof_basename)
+        self.snapshot_filename = snapshot_filename
+        self.aof_enabled = aof_enabled
+        #Node fill of the quicklists rebuilt from a snapshot
+        self.list_fill = list_fill
         self.aof_handler = None
+        #Loading progress, for the log and the loading_* fields of INFO
+        self.loading = False
+        self.loading_start_time = 0.0
+        self.loading_total_bytes = 0
+        self.loading_loaded_bytes = 0
+        self._last_progress_log = 0.0
+        self._loader = None
+        self._window_size = AOF_PARSE_WINDOW
+        self._batch = None
         
     def recover_data(self, data_store, command_handler = None) -> bool:
+        """Load the whole dataset, returns False if it could not be loaded"""
+        self.begin_loading(data_store, command_handler)
+        return self.load_step()
+    
+    def begin_loading(self, data_store, command_handler = None, window_size: int = AOF_PARSE_WINDOW,
+                      batch: Optional[int] = None) -> None:
+        """
+        Prepare a load that load_step() then runs
+        
+        Args:
+        window_size: AOF bytes parsed per step
+        batch: snapshot keys loaded per step, None loads a snapshot in one step
+        """
+        self._window_size = window_size
+        self._batch = batch
+        self.loading = True
+        self.loading_start_time = time.time()
+        self._last_progress_log = self.loading_start_time
+        self.loading_loaded_bytes = 0
+        self.loading_total_bytes = 0
+        self._loader = self._load_steps(data_store, command_handler)
+    
+    def load_step(self, time_limit: Optional[float] = None) -> Optional[bool]:
+        """
+        Load for about time_limit seconds, everything left when it is None
         
+        A step ends after the batch during which time ran out. Returns None
+        while there is more to load, then whether recovery succeeded
+        """
+        if self._loader is None:
+            return True
+        deadline = None if time_limit is None else time.monotonic() + time_limit
         try:
-            aof_exists = os.path.exists(self.aof_filename)
-            if not aof_exists:
-                print("No AOF file found, starting with empty database")
-                return  True
-            print(f"Loading datafrom AOF file: {self.aof_filename}")
-            return self._replay_aof(data_store,  command_handler)
+            for _ in self._loader:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+            success = True
         except Exception as e:
             print(f"Error during data recovery {e}")
-            return self._handle_corruption(e)
+            success = self._handle_corruption(e)
+        self._loader = None
+        self._stop_loading()
+        return success
+    
+    def _load_steps(self, data_store, command_handler):
+        if self.aof_enabled and self.manifest.exists():
+            print(f"Loading data from AOF manifest: {self.manifest.path}")
+            yield from self._load_aof(data_store, command_handler)
+        elif self.snapshot_filename and os.path.exists(self.snapshot_filename):
+            print(f"Loading data from snapshot: {self.snapshot_filename}")
+            self.loading_total_bytes = os.path.getsize(self.snapshot_filename)
+            yield from self._load_snapshot(data_store, self.snapshot_filename)
+        else:
+            print("No AOF file or snapshot found, starting with empty database")
+    
+    def _stop_loading(self) -> None:
+        self.loading = False
+        if not self.loading_total_bytes:
+            return
+        elapsed = time.time() - self.loading_start_time
+        rate = self.loading_loaded_bytes / elapsed / (1024 * 1024) if elapsed else 0.0
+        print(f"Loaded {self.loading_loaded_bytes} bytes in {elapsed:.3f} seconds ({rate:.1f} MB/s)")
+    
+    def _report_progress(self) -> None:
+        now = time.time()
+        if now - self._last_progress_log < LOADING_LOG_INTERVAL:
+            return
+        self._last_progress_log = now
+        info = self.loading_info()
+        print(f"Loading: {info['loading_loaded_perc']:.1f}% of {self.loading_total_bytes} bytes, "
+              f"{info['loading_rate_mb_per_sec']:.1f} MB/s, ETA {info['loading_eta_seconds']} seconds")
+    
+    def loading_info(self) -> Dict[str, float]:
+        """Loading progress as the loading_* fields of INFO"""
+        elapsed = time.time() - self.loading_start_time
+        loaded = self.loading_loaded_bytes
+        total = self.loading_total_bytes
+        rate = loaded / elapsed if elapsed > 0 else 0.0
+        return {
+            'loading' : self.loading,
+            'loading_start_time' : int(self.loading_start_time),
+            'loading_total_bytes' : total,
+            'loading_loaded_bytes' : loaded,
+            'loading_loaded_perc' : loaded * 100.0 / total if total else 0.0,
+            'loading_rate_mb_per_sec' : rate / (1024 * 1024),
+            'loading_eta_seconds' : int((total - loaded) / rate) if rate else -1,
+        }
+    
+    def _load_snapshot(self, data_store, filename: str):
+        start = time.time()
+        loaded_before = self.loading_loaded_bytes
+        keys = 0
+        for keys, loaded in load_snapshot_steps(data_store, filename, self.list_fill, self._batch):
+            self.loading_loaded_bytes = loaded_before + loaded
+            self._report_progress()
+            yield
+        print(f"Loaded {keys} keys from snapshot in {time.time() - start:.3f} seconds")
+    
+    def _load_aof(self, data_store, command_handler):
+        self.manifest.load()
+        if command_handler is None:
+            from ..command import CommandHandler
+            command_handler = CommandHandler(data_store)
+        files = self.manifest.files()
+        for path in files:
+            if not os.path.exists(path):
+                raise ValueError(f"AOF file {path} listed in the manifest is missing")
+        self.loading_total_bytes = sum(os.path.getsize(path) for path in files)
+        for index, path in enumerate(files):
+            if path.endswith('.rdb'):
+                yield from self._load_snapshot(data_store, path)
+            else:
+                #Only the file being appended to can end in a partial write
+                yield from self._replay_aof(path, command_handler, index == len(files) - 1)
         
-    def _replay_aof(self, data_store, command_handler) -> bool:
-         
-         
-         try:
-             commands_replayed = 0
-             with open(self.aof_filename, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f,1):
-                    line = line.strip()
-                    if not line:
-                        continue
+    def _replay_aof(self, filename: str, command_handler, truncate_tail: bool = True):
+        """
+        Replay the RESP records of an AOF file, a step per batch of records
+
+        A record cut short at the end of the file, as left by a crash in
+        the middle of a write, is truncated away and loading goes on
+        """
+        commands_replayed = 0
+        failed = 0
+        loaded_before = self.loading_loaded_bytes
+        size = os.path.getsize(filename)
+        pos = 0
+        if size:
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while pos < size:
                     try:
-                       parts = line.split(' ',2)
-                       if len(parts) < 2:
-                           continue
-                       timestamp = parts[0]
-                       command = parts[1]
-                       args = parts[2].split() if len(parts) > 2 else []
-                       
-                       #execute command direct on data store.
-                       
-                       self._execute_recovery_command(data_store,command, args)
-                       commands_replayed += 1
-                       
-                    except Exception as e:
-                        print(f"Error replaying command at line {line_num} : {e}")
-                        print(f"Problematic line: {line}")
-                        continue
-                print(f"Replayed {commands_replayed} commands from  AOF")
-                    
-         except Exception as e:
-             print("Error replay AOF file: {e}")
-             return False
-    def _execute_recovery_command(self, data_store, command: str, args: list) -> None:
+                        commands, pos = parse_aof_records(data, pos, self._window_size)
+                    except AOFFormatError as e:
+                        raise ValueError(f"AOF is corrupt after {commands_replayed} commands: {e}")
+                    if not commands:
+                        break
+                    failed += self._apply_commands(commands, command_handler, failed)
+                    commands_replayed += len(commands)
+                    self.loading_loaded_bytes = loaded_before + pos
+                    self._report_progress()
+                    yield
+        if size > pos:
+            if not truncate_tail:
+                raise ValueError(f"AOF file {filename} ends with an incomplete command")
+            print(f"AOF ends with an incomplete command, truncating it to {pos} bytes")
+            os.truncate(filename, pos)
+        self.loading_loaded_bytes = loaded_before + size
+        if failed:
+            print(f"{failed} commands from {os.path.basename(filename)} returned an error")
+        print(f"Replayed {commands_replayed} commands from {os.path.basename(filename)}")
+    
+    def _apply_commands(self, commands, command_handler, failed: int = 0) -> int:
+        """
+        Apply a batch of records in order, returns how many failed
         
-        try:
-          if command == 'SET':
-             if len(args) >= 2:
-                 key = args[0]
-                 value = ' '.join(args[1:])
-                 data_store.set(key, value)
-                 
-          elif command == 'DEL':
-               if args:
-                   data_store.delete(*args)
-          elif command == 'EXPIRE':
-               if len(args) == 2:
-                   key = args[0]
-                   seconds = int(args[1])
-                   data_store.expire(key, seconds)
-          elif command =='EXPIREAT':
-               if len(args) == 2:
-                    key = args[0]
-                    timestamp = int(args[1])
-                    data_store.expire(key, timestamp)
-          elif command == 'PERSIST':
-              if len(args) == 1:
-                  key = args[0]
-                  data_store.persist(key)
-          elif command == 'FLUSHALL':
-              data_store.flush()
-          else:
-              #unknown command - ignore during startup
-              pass
-        except Exception as e:
-            print(f"Error executing recovery command {command}: {e}")
+        Plain SETs are collected and stored with one DataStore.load() call,
+        the batch is applied first whenever a command that touches one of
+        its keys, or a keyless one such as FLUSHALL, comes along. Errors
+        are printed until failed reaches MAX_REPORTED_FAILURES
+        """
+        errors = 0
+        data_store = command_handler.storage
+        replay = command_handler.replay
+        get_keys = command_handler.get_keys
+        pending = {}
+        for args in commands:
+            name = args[0].upper()
+            if name == 'SET' and len(args) == 3:
+                number = canonical_int(args[2])
+                pending[args[1]] = args[2] if number is None else number
+                continue
+            if pending:
+                keys = get_keys(name, args[1:])
+                if not keys or any(key in pending for key in keys):
+                    data_store.load((key, value, None) for key, value in pending.items())
+                    pending = {}
+            reply = replay(*args)
+            if reply[:1] == b"-":
+                errors += 1
+                if failed + errors <= MAX_REPORTED_FAILURES:
+                    print(f"Error replaying {args[0]} from AOF: {reply.decode(errors='replace').strip()}")
+        if pending:
+            data_store.load((key, value, None) for key, value in pending.items())
+        return errors
+            
     def _handle_corruption(self, e) -> bool:
-        """This is for handling corrupted persistence files
+        """
+        Called when a persistence file cannot be loaded, returns False
         
-           it returns true if recovery should continue with empty database
+        Only a command cut short at the end of the last AOF file is
+        truncated away during loading. Anything else leaves a partly loaded
+        store, and new writes would be appended behind the bad bytes where
+        the next restart cannot read them, so like Redis the server does
+        not start
         """
         print(f"Persistence file corruption detected: {e}")
-        print("Starting with an empty database. Consider restoring from backup")
-        #In production, we might want to:
-        # 1.Create backup of corrupted files
-        # Attempt partial recovery
-        # Send alerts to administrators
-        
-        return True # Continue with empty database
+        print("Fix or restore the file from a backup before restarting")
+        return False
     def validate_files(self) -> Dict[str, bool]:
         """"
-        Validate AOF file without loading it
+        Validate the AOF manifest and the start of every file it lists without loading them
         
         """
         results = {
-            'aof_exists' : os.path.exists(self.aof_filename),
+            'aof_exists' : self.manifest.exists(),
             'aof_valid' : False
         }
         if results ['aof_exists'] :
             try:
-                with open(self.aof_filename, 'r', encoding='utf-8') as f:
-                    #try to read first 5 lines
-                    for i, line in enumerate(f):
-                        if i >= 5:
-                             break
-                        parts = line.strip.split(' ',2)
-                         
-                        if len(parts) >= 2:
-                             try:
-                                 int(parts[0])
-                             except:
-                                 break
-                    else:
-                        results['aof_valid'] = True
+                self.manifest.load()
+                valid = True
+                for path in self.manifest.files():
+                    with open(path, 'rb') as f:
+                        head = f.read(AOF_READ_CHUNK)
+                    if path.endswith('.rdb'):
+                        valid = valid and head[:len(MAGIC)] == MAGIC
+                        continue
+                    #The first records must parse as RESP multi-bulk commands
+                    parser = RESPParser()
+                    parser.feed(head)
+                    commands = parser.parse()
+                    valid = valid and (not head or (head[:1] == b"*" and not parser.error
+                                                    and (bool(commands) or len(head) < AOF_READ_CHUNK)))
+                results['aof_valid'] = valid
             except  Exception:
                   results['aof_valid'] = False
-        return results
\ No newline at end of file
+        return results
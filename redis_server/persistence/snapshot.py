@@ -0,0 +1,426 @@
+"""
+Binary point-in-time snapshots (SAVE, BGSAVE)
+
+A snapshot file is
+
+    MAGIC VERSION <record>* EOF <crc32>
+
+Each key is one record: an optional EXPIRETIME opcode followed by the
+absolute expiry in unix milliseconds, a type byte, the key and the value.
+Strings and lengths are length-prefixed, the CRC32 of everything before
+it closes the file and is checked before anything is loaded.
+
+Compact encodings are written as they are held in memory: a quicklist
+node, a small hash or sorted set is its listpack bytes and an intset is
+its array, so loading them is a copy instead of re-inserting every
+element. Only hashtable encoded containers are written element by
+element.
+"""
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from typing import Optional
+from itertools import islice
+from ..datatypes import Listpack, QuickList, Hash, ZSet, Set
+from ..datatypes.listpack import count_entries
+from ..protocol import ENCODING, ENCODING_ERRORS, decode_arg, encode_arg
+
+MAGIC = b"PYRDB"
+VERSION = b"0001"
+
+#Value types
+TYPE_STRING = 0
+TYPE_INT = 1
+TYPE_LIST_QUICKLIST = 2
+TYPE_HASH_LISTPACK = 3
+TYPE_HASH = 4
+TYPE_ZSET_LISTPACK = 5
+TYPE_ZSET = 6
+TYPE_SET_INTSET = 7
+TYPE_SET = 8
+
+#Opcodes, never used as a type byte
+OP_EXPIRETIME_MS = 0xFC
+OP_EOF = 0xFF
+
+#Lengths below LENGTH_32 fit in their single byte
+LENGTH_32 = 0xFE
+LENGTH_64 = 0xFF
+
+#Encoded records are collected up to this size before each write
+WRITE_CHUNK = 1024 * 1024
+
+#Keys handed to DataStore.load() at a time when loading in steps
+LOAD_BATCH = 2000
+
+#Array typecodes of the intset widths Set uses
+INTSET_TYPECODES = ('h', 'i', 'q')
+
+_INT64 = struct.Struct("<q")
+_UINT32 = struct.Struct("<I")
+_UINT64 = struct.Struct("<Q")
+_DOUBLE = struct.Struct("<d")
+
+
+class SnapshotError(Exception):
+    """Raised for a snapshot file that is truncated, corrupt or not a snapshot"""
+
+
+def _length(value: int) -> bytes:
+    if value < LENGTH_32:
+        return bytes((value,))
+    if value < 1 << 32:
+        return bytes((LENGTH_32,)) + _UINT32.pack(value)
+    return bytes((LENGTH_64,)) + _UINT64.pack(value)
+
+
+def _string(value) -> bytes:
+    data = encode_arg(value)
+    return _length(len(data)) + data
+
+
+def _intset_bytes(intset: array) -> bytes:
+    if sys.byteorder == 'big':
+        intset = array(intset.typecode, intset)
+        intset.byteswap()
+    return intset.tobytes()
+
+
+def _encode_value(value) -> bytes:
+    """Type byte and payload of a value"""
+    if isinstance(value, str):
+        return bytes((TYPE_STRING,)) + _string(value)
+    if isinstance(value, int):
+        return bytes((TYPE_INT,)) + _INT64.pack(value)
+    if isinstance(value, QuickList):
+        parts = [bytes((TYPE_LIST_QUICKLIST,)), _length(len(value.nodes))]
+        for node in value.nodes:
+            parts.append(_length(node.count))
+            parts.append(_length(len(node.data)))
+            parts.append(node.data)
+        return b"".join(parts)
+    if isinstance(value, Hash):
+        if value.table is None:
+            return bytes((TYPE_HASH_LISTPACK,)) + _length(value.count) + _length(len(value.data)) + value.data
+        parts = [bytes((TYPE_HASH,)), _length(len(value.table))]
+        for field, field_value in value.table.items():
+            parts.append(_string(field))
+            parts.append(_string(field_value))
+        return b"".join(parts)
+    if isinstance(value, ZSet):
+        if value.table is None:
+            return bytes((TYPE_ZSET_LISTPACK,)) + _length(value.count) + _length(len(value.data)) + value.data
+        #Written in index order so the loader hands SortedChunks sorted pairs
+        parts = [bytes((TYPE_ZSET,)), _length(len(value.index))]
+        pack_score = _DOUBLE.pack
+        for chunk in value.index.chunks:
+            for score, member in chunk:
+                parts.append(_string(member))
+                parts.append(pack_score(score))
+        return b"".join(parts)
+    if isinstance(value, Set):
+        if value.table is None:
+            data = _intset_bytes(value.intset)
+            return bytes((TYPE_SET_INTSET,)) + value.intset.typecode.encode() + _length(len(data)) + data
+        parts = [bytes((TYPE_SET,)), _length(len(value.table))]
+        parts.extend(_string(member) for member in value.table)
+        return b"".join(parts)
+    raise SnapshotError(f"cannot snapshot a value of type {type(value).__name__}")
+
+
+def dump_value(value) -> bytes:
+    """
+    DUMP payload of a value: its snapshot encoding, the snapshot version
+    and a CRC32 of both
+    """
+    payload = _encode_value(value) + VERSION
+    return payload + _UINT32.pack(zlib.crc32(payload))
+
+
+def restore_value(payload: bytes, list_fill: int = -2):
+    """Value of a DUMP payload, SnapshotError when it is not a valid one"""
+    end = len(payload) - 4 - len(VERSION)
+    if end < 1 or payload[end:-4] != VERSION or zlib.crc32(payload[:-4]) != _UINT32.unpack_from(payload, end + len(VERSION))[0]:
+        raise SnapshotError("DUMP payload version or checksum are wrong")
+    reader = _Reader(payload)
+    try:
+        value = _read_value(reader, reader.byte(), list_fill, True)
+    except (IndexError, struct.error, ValueError) as e:
+        raise SnapshotError(f"DUMP payload is corrupt: {e}")
+    if reader.pos != end:
+        raise SnapshotError("DUMP payload is corrupt: trailing bytes")
+    return value
+
+
+def write_snapshot(data_store, file) -> int:
+    """
+    Write every live key of data_store to an open binary file
+
+    Returns the number of keys written
+    """
+    crc = 0
+    keys = 0
+    parts = [MAGIC + VERSION]
+    pending = len(parts[0])
+    for key, value, expiry_time in data_store.snapshot_items():
+        if expiry_time is not None:
+            parts.append(bytes((OP_EXPIRETIME_MS,)) + _INT64.pack(int(expiry_time * 1000)))
+        record = _encode_value(value)
+        #The type byte goes before the key, the loader needs it first
+        parts.append(record[:1])
+        parts.append(_string(key))
+        parts.append(record[1:])
+        pending += len(record) + len(key) + 9
+        keys += 1
+        if pending >= WRITE_CHUNK:
+            chunk = b"".join(parts)
+            crc = zlib.crc32(chunk, crc)
+            file.write(chunk)
+            parts = []
+            pending = 0
+    parts.append(bytes((OP_EOF,)))
+    chunk = b"".join(parts)
+    crc = zlib.crc32(chunk, crc)
+    file.write(chunk)
+    file.write(_UINT32.pack(crc))
+    return keys
+
+
+def save_snapshot(data_store, filename: str, temp_filename: str) -> int:
+    """
+    Write a snapshot to temp_filename, fsync it and rename it over filename
+
+    A crash at any point leaves the previous snapshot intact.
+    Returns the number of keys saved
+    """
+    try:
+        with open(temp_filename, 'wb', buffering=WRITE_CHUNK) as file:
+            keys = write_snapshot(data_store, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, filename)
+        return keys
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+class _Reader:
+    """Cursor over the bytes of a snapshot"""
+
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self) -> int:
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def length(self) -> int:
+        data = self.data
+        value = data[self.pos]
+        self.pos += 1
+        if value < LENGTH_32:
+            return value
+        if value == LENGTH_32:
+            value = _UINT32.unpack_from(data, self.pos)[0]
+            self.pos += 4
+            return value
+        value = _UINT64.unpack_from(data, self.pos)[0]
+        self.pos += 8
+        return value
+
+    def raw(self, size: int) -> bytes:
+        start = self.pos
+        self.pos = start + size
+        return self.data[start:self.pos]
+
+    def string(self) -> str:
+        return decode_arg(self.raw(self.length()))
+
+    def unpack(self, layout: struct.Struct):
+        value = layout.unpack_from(self.data, self.pos)[0]
+        self.pos += layout.size
+        return value
+
+
+def _check_listpack(data, count: int, pairs: bool = False) -> None:
+    """ValueError unless data holds exactly count well-formed entries"""
+    if not count or (pairs and count % 2) or count_entries(data) != count:
+        raise ValueError("listpack does not match its entry count")
+
+
+def _read_value(reader: _Reader, value_type: int, list_fill: int, verify: bool = False):
+    """
+    The next value of reader
+
+    verify checks the compact encodings against the invariants the
+    containers rely on, for payloads that do not come from this server
+    """
+    if value_type == TYPE_STRING:
+        return reader.string()
+    if value_type == TYPE_INT:
+        return reader.unpack(_INT64)
+    if value_type == TYPE_LIST_QUICKLIST:
+        nodes = []
+        for _ in range(reader.length()):
+            count = reader.length()
+            data = reader.raw(reader.length())
+            if verify:
+                _check_listpack(data, count)
+            nodes.append(Listpack.from_bytes(data, count))
+        if verify and not nodes:
+            raise ValueError("empty list")
+        return QuickList.from_nodes(nodes, list_fill)
+    if value_type in (TYPE_HASH_LISTPACK, TYPE_ZSET_LISTPACK):
+        count = reader.length()
+        container = Hash if value_type == TYPE_HASH_LISTPACK else ZSet
+        value = container.from_bytes(reader.raw(reader.length()), count)
+        if verify:
+            _check_listpack(value.data, count, True)
+            entries = Listpack.__iter__(value)
+            fields = [(field, entry) for field, entry in zip(entries, entries)]
+            if len(set(field for field, _ in fields)) != len(fields):
+                raise ValueError("duplicate field or member")
+            if container is ZSet:
+                scores = [(float(score), member) for member, score in fields]
+                if any(math.isnan(score) for score, _ in scores) or scores != sorted(scores):
+                    raise ValueError("sorted set listpack is not in score order")
+        return value
+    if value_type == TYPE_HASH:
+        string = reader.string
+        table = {string(): string() for _ in range(reader.length())}
+        if verify and not table:
+            raise ValueError("empty hash")
+        return Hash.from_table(table)
+    if value_type == TYPE_ZSET:
+        pairs = []
+        for _ in range(reader.length()):
+            member = reader.string()
+            pairs.append((reader.unpack(_DOUBLE), member))
+        if verify:
+            if not pairs or any(math.isnan(score) for score, _ in pairs) or len(set(member for _, member in pairs)) != len(pairs):
+                raise ValueError("empty sorted set, NaN score or duplicate member")
+            pairs.sort()
+        return ZSet.from_pairs(pairs)
+    if value_type == TYPE_SET_INTSET:
+        typecode = chr(reader.byte())
+        if typecode not in INTSET_TYPECODES:
+            raise SnapshotError(f"unknown intset width {typecode!r}")
+        intset = array(typecode)
+        intset.frombytes(reader.raw(reader.length()))
+        if sys.byteorder == 'big':
+            intset.byteswap()
+        if verify and (not intset or any(low >= high for low, high in zip(intset, intset[1:]))):
+            raise ValueError("intset is empty or not sorted")
+        return Set.from_intset(intset)
+    if value_type == TYPE_SET:
+        string = reader.string
+        table = {string() for _ in range(reader.length())}
+        if verify and not table:
+            raise ValueError("empty set")
+        return Set.from_table(table)
+    raise SnapshotError(f"unknown value type {value_type}")
+
+
+def load_snapshot(data_store, filename: str, list_fill: int = -2) -> int:
+    """
+    Load a snapshot into data_store, keys already expired are skipped
+
+    The file is memory-mapped and its checksum verified before the first
+    key is loaded, so a corrupt file raises SnapshotError and leaves
+    data_store untouched. Keys go in through DataStore.load().
+    Returns the number of keys loaded
+    """
+    keys = 0
+    for keys, _ in load_snapshot_steps(data_store, filename, list_fill, None):
+        pass
+    return keys
+
+
+def load_snapshot_steps(data_store, filename: str, list_fill: int = -2, batch: Optional[int] = LOAD_BATCH):
+    """
+    load_snapshot() in steps of batch keys, a single step when it is None
+
+    Yields (keys loaded, bytes of the file read) after every step, the
+    caller may do other work in between. One DataStore.load() call per
+    step, fewer steps load faster
+    """
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        header_size = len(MAGIC) + len(VERSION)
+        if size < header_size + 5:
+            raise SnapshotError("snapshot file is truncated")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise SnapshotError("not a snapshot file")
+            if data[len(MAGIC):header_size] != VERSION:
+                raise SnapshotError(f"unsupported snapshot version {data[len(MAGIC):header_size]!r}")
+            if data[size - 5] != OP_EOF or zlib.crc32(memoryview(data)[:size - 4]) != _UINT32.unpack_from(data, size - 4)[0]:
+                raise SnapshotError("snapshot checksum mismatch")
+            reader = _Reader(data)
+            records = _iter_records(reader, header_size, size - 5, list_fill)
+            keys = 0
+            while True:
+                try:
+                    if batch is None:
+                        keys = data_store.load(records)
+                        break
+                    items = list(islice(records, batch))
+                    if not items:
+                        break
+                    keys += data_store.load(items)
+                except (IndexError, struct.error, ValueError) as e:
+                    raise SnapshotError(f"snapshot record at offset {reader.pos} is corrupt: {e}")
+                yield keys, reader.pos
+    yield keys, size
+
+
+def _iter_records(reader: _Reader, start: int, end: int, list_fill: int):
+    """(key, value, expiry or None) of every record not yet expired"""
+    #Keys and plain strings are decoded inline, they are most of the file
+    data = reader.data
+    unpack_int64 = _INT64.unpack_from
+    now_ms = time.time() * 1000
+    pos = start
+    while pos < end:
+        opcode = data[pos]
+        pos += 1
+        expiry_ms = None
+        if opcode == OP_EXPIRETIME_MS:
+            expiry_ms = unpack_int64(data, pos)[0]
+            opcode = data[pos + 8]
+            pos += 9
+        size = data[pos]
+        if size < LENGTH_32:
+            pos += 1
+        else:
+            reader.pos = pos
+            size = reader.length()
+            pos = reader.pos
+        key = str(data[pos:pos + size], ENCODING, ENCODING_ERRORS)
+        pos += size
+        if opcode == TYPE_STRING and data[pos] < LENGTH_32:
+            size = data[pos]
+            pos += 1 + size
+            value = str(data[pos - size:pos], ENCODING, ENCODING_ERRORS)
+        else:
+            reader.pos = pos
+            value = _read_value(reader, opcode, list_fill)
+            pos = reader.pos
+        reader.pos = pos
+        if expiry_ms is None:
+            yield key, value, None
+        elif expiry_ms > now_ms:
+            yield key, value, expiry_ms / 1000
+    if pos != end:
+        raise SnapshotError("snapshot records overrun the end of file")
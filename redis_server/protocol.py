@@ -0,0 +1,241 @@
+"""
+Incremental RESP2 request parser
+
+Parses multi-bulk (*N / $len) frames as sent by real clients and the
+legacy inline protocol (space separated words terminated by CRLF) used
+by telnet. Data is accumulated in a single bytearray and consumed with a
+read offset, so a buffer holding many pipelined commands is parsed in
+one pass and compacted only once per call.
+"""
+
+ENCODING = 'utf-8'
+ENCODING_ERRORS = 'surrogateescape'
+
+MAX_INLINE_SIZE = 64 * 1024
+MAX_MULTIBULK_LENGTH = 1024 * 1024
+MAX_BULK_LENGTH = 512 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when a client sends a malformed request"""
+
+
+def decode_arg(data) -> str:
+    """
+    Decode a raw argument into str without losing information
+
+    Bytes that are not valid UTF-8 are mapped to lone surrogates, so
+    encoding the result with encode_arg gives back the original bytes.
+    """
+    return str(data, ENCODING, ENCODING_ERRORS)
+
+
+def encode_arg(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode(ENCODING, ENCODING_ERRORS)
+
+
+def canonical_int(text):
+    """
+    The 64-bit integer text stands for, None unless written canonically
+
+    "007", "+7", " 7" or "-0" are strings that merely parse as integers,
+    storing them as int would change what GET returns.
+    """
+    if not text or len(text) > 20 or not (text[0] == '-' or text[0].isdigit()):
+        return None
+    try:
+        value = int(text)
+    except ValueError:
+        return None
+    if str(value) != text or not -2 ** 63 <= value < 2 ** 63:
+        return None
+    return value
+
+
+def format_double(value: float) -> str:
+    """Shortest text that parses back to value, "3" rather than "3.0" like Redis"""
+    if value == float('inf'):
+        return "inf"
+    if value == float('-inf'):
+        return "-inf"
+    if value.is_integer() and abs(value) < 1e17:
+        return str(int(value))
+    return repr(value)
+
+
+class RESPParser:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._pos = 0
+        #State of a multi-bulk request that is only partially received
+        self._multibulk_len = 0
+        self._args = []
+        #Set once a malformed request is seen, the connection should be closed
+        self.error = None
+        #Bytes of the stream up to the end of the last complete request
+        self.parsed_bytes = 0
+        self._compacted = 0
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+
+    def parse(self) -> list:
+        """
+        Parse every complete request currently in the buffer
+
+        Returns:
+          list of commands, each one a list of str arguments. Commands that
+          precede a malformed request are still returned and self.error is set
+        """
+        commands = []
+        buffer = self.buffer
+        with memoryview(buffer) as view:
+            try:
+                while self._pos < len(buffer) and self.error is None:
+                    if self._multibulk_len:
+                        args = self._parse_bulks(buffer, view)
+                    elif buffer[self._pos] == 42:  # '*'
+                        args = self._parse_multibulk_header(buffer, view)
+                    else:
+                        args = self._parse_inline(buffer)
+                    if args is None:
+                        break
+                    self.parsed_bytes = self._compacted + self._pos
+                    if args:
+                        commands.append(args)
+            except ProtocolError as e:
+                self.error = e
+        #Compact once per call instead of once per command
+        if self._pos:
+            del buffer[:self._pos]
+            self._compacted += self._pos
+            self._pos = 0
+        return commands
+
+    def _parse_inline(self, buffer):
+        end = buffer.find(b"\n", self._pos)
+        if end == -1:
+            if len(buffer) - self._pos > MAX_INLINE_SIZE:
+                raise ProtocolError("Protocol error: too big inline request")
+            return None
+        line = buffer[self._pos:end]
+        self._pos = end + 1
+        return [decode_arg(part) for part in line.split()]
+
+    def _read_length(self, buffer, prefix, limit, name):
+        """Read a '<prefix><number>\\r\\n' header, None if incomplete"""
+        end = buffer.find(b"\r\n", self._pos)
+        if end == -1:
+            if len(buffer) - self._pos > MAX_INLINE_SIZE:
+                raise ProtocolError(f"Protocol error: too big {name} count")
+            return None
+        if buffer[self._pos] != prefix:
+            got = chr(buffer[self._pos])
+            raise ProtocolError(f"Protocol error: expected '{chr(prefix)}', got '{got}'")
+        try:
+            length = int(buffer[self._pos + 1:end])
+        except ValueError:
+            raise ProtocolError(f"Protocol error: invalid {name} length")
+        if length > limit:
+            raise ProtocolError(f"Protocol error: invalid {name} length")
+        self._pos = end + 2
+        return length
+
+    def _parse_multibulk_header(self, buffer, view):
+        length = self._read_length(buffer, 42, MAX_MULTIBULK_LENGTH, 'multibulk')
+        if length is None:
+            return None
+        if length <= 0:
+            return []
+        self._multibulk_len = length
+        self._args = []
+        return self._parse_bulks(buffer, view)
+
+    def _parse_bulks(self, buffer, view):
+        args = self._args
+        while self._multibulk_len:
+            start = self._pos
+            length = self._read_length(buffer, 36, MAX_BULK_LENGTH, 'bulk')  # '$'
+            if length is None:
+                return None
+            if length < 0:
+                raise ProtocolError("Protocol error: invalid bulk length")
+            data_start = self._pos
+            data_end = data_start + length
+            if len(buffer) < data_end + 2:
+                #Wait for the rest of the value, re-read the header next time
+                self._pos = start
+                return None
+            args.append(decode_arg(view[data_start:data_end]))
+            self._pos = data_end + 2
+            self._multibulk_len -= 1
+        self._args = []
+        return args
+
+
+def encode_command(args) -> bytes:
+    """Encode a command as a RESP multi-bulk request"""
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = encode_arg(arg)
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+class RESPReplyParser:
+    """
+    Splits a stream of RESP replies into complete top-level replies
+
+    Used on connections where this server is the client, replies are
+    returned as raw bytes so they can be relayed without re-encoding.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+
+    def parse(self) -> list:
+        replies = []
+        buffer = self.buffer
+        pos = 0
+        while pos < len(buffer):
+            end = self._reply_end(buffer, pos)
+            if end == -1:
+                break
+            replies.append(bytes(buffer[pos:end]))
+            pos = end
+        if pos:
+            del buffer[:pos]
+        return replies
+
+    def _reply_end(self, buffer, pos):
+        """Offset just past the reply starting at pos, -1 if incomplete"""
+        remaining = 1
+        while remaining:
+            line_end = buffer.find(b"\r\n", pos)
+            if line_end == -1:
+                return -1
+            kind = buffer[pos]
+            remaining -= 1
+            if kind == 36:  # '$'
+                length = int(buffer[pos + 1:line_end])
+                pos = line_end + 2
+                if length >= 0:
+                    pos += length + 2
+                    if pos > len(buffer):
+                        return -1
+            elif kind == 42:  # '*'
+                count = int(buffer[pos + 1:line_end])
+                pos = line_end + 2
+                if count > 0:
+                    remaining += count
+            elif kind in (43, 45, 58):  # '+', '-', ':'
+                pos = line_end + 2
+            else:
+                raise ProtocolError(f"Protocol error: unexpected reply type '{chr(kind)}'")
+        return pos
@@ -0,0 +1,622 @@
+"""
+Primary-replica replication
+
+A replica connects to its master and sends PING, REPLCONF listening-port,
+REPLCONF capa psync2 and PSYNC <replid> <offset> in one go. The master
+answers PSYNC with either
+
+  +CONTINUE <replid>             partial resync: the bytes the replica
+                                 missed are still in the backlog and are
+                                 sent right away
+  +FULLRESYNC <replid> <offset>  a BGSAVE is forked and its snapshot sent
+                                 as $<length>\\r\\n<bytes> once written,
+                                 followed by every write made since the
+                                 fork
+
+after which every write command, as propagated to the AOF, is streamed to
+the replica. Replication offsets count the bytes of that stream: the
+master adds every record it sends, a replica every record it applies.
+The last repl_backlog_size bytes are kept in a ring buffer, so a replica
+whose link dropped resumes with PSYNC <replid> <its offset + 1> as long as
+the bytes from that offset are still there.
+
+Replicas are read-only, send REPLCONF ACK <offset> every second and
+reconnect on their own; the master pings them every 10 seconds so an idle
+link can be told from a dead one. REPLICAOF NO ONE promotes a replica,
+its former replid stays valid as replid2 so the other replicas of the old
+master can partially resync from it. Keys expire on every node from the
+absolute times in the stream.
+"""
+import errno
+import os
+import selectors
+import socket
+import time
+from .protocol import RESPParser, encode_command
+from .response import ok, errorm, simple_string
+from .persistence.snapshot import SnapshotError, load_snapshot
+
+#Commands the server hands to Replication.command with the connection
+REPLICATION_COMMANDS = {"REPLICAOF", "SLAVEOF", "REPLCONF", "PSYNC"}
+
+#Seconds between the PINGs a master sends down the replication stream
+REPL_PING_PERIOD = 10
+#Seconds between the REPLCONF ACKs of a replica, and between the newlines
+#a master sends replicas waiting for their snapshot to keep them alive
+REPL_ACK_PERIOD = 1
+#Seconds before a replica tries to connect to its master again
+REPL_RECONNECT_DELAY = 1
+#Bytes read from the master link at a time, the snapshot included
+REPL_READ_SIZE = 256 * 1024
+
+NO_REPLID = "0" * 40
+
+
+def new_replid() -> str:
+    return os.urandom(20).hex()
+
+
+class ReplicationBacklog:
+    """
+    The last size bytes of the replication stream in a ring buffer
+
+    Stream bytes are numbered by replication offset from 1, the backlog
+    holds first_offset to end_offset
+    """
+
+    def __init__(self, size: int, end_offset: int = 0):
+        self.size = size
+        self.buffer = bytearray(size)
+        #Where the next byte goes
+        self.index = 0
+        self.histlen = 0
+        self.end_offset = end_offset
+
+    @property
+    def first_offset(self) -> int:
+        return self.end_offset - self.histlen + 1
+
+    def append(self, data: bytes) -> None:
+        length = len(data)
+        size = self.size
+        if length >= size:
+            self.buffer[:] = data[length - size:]
+            self.index = 0
+        else:
+            index = self.index
+            first = min(length, size - index)
+            self.buffer[index:index + first] = data[:first]
+            if first < length:
+                self.buffer[:length - first] = data[first:]
+            self.index = (index + length) % size
+        self.histlen = min(self.histlen + length, size)
+        self.end_offset += length
+
+    def covers(self, offset: int) -> bool:
+        """True if every byte from offset on is held, end_offset + 1 included"""
+        return self.first_offset <= offset <= self.end_offset + 1
+
+    def read_from(self, offset: int) -> bytes:
+        length = self.end_offset - offset + 1
+        start = (self.index - length) % self.size
+        if start + length <= self.size:
+            return bytes(self.buffer[start:start + length])
+        return bytes(self.buffer[start:]) + bytes(self.buffer[:start + length - self.size])
+
+
+class Replication:
+    """Replication state of a RedisServer, as a master and as a replica"""
+
+    def __init__(self, server):
+        self.server = server
+        self.config = server.persistence_config
+        self.replid = new_replid()
+        #Replid this node had before a promotion or a new master, offsets
+        #below second_replid_offset still belong to it
+        self.replid2 = NO_REPLID
+        self.second_replid_offset = -1
+        self.master_repl_offset = 0
+        #Created when the first replica attaches or on a sync with a master
+        self.backlog = None
+        #Replica connections: client socket -> replica state
+        self.replicas = {}
+        #REPLCONF listening-port of connections that did not PSYNC yet
+        self.listening_ports = {}
+        self.last_ping_time = 0.0
+        self.last_keepalive_time = 0.0
+        #pid of the BGSAVE child whose snapshot waiting replicas get
+        self.rdb_child = None
+        #Set while this node is a replica
+        self.master_host = None
+        self.master_port = None
+        self.master_link = None
+        self.last_connect_try = 0.0
+        self.link_down_since = 0.0
+
+    @property
+    def is_replica(self) -> bool:
+        return self.master_host is not None
+
+    def command(self, client, parts):
+        """Run REPLICAOF, REPLCONF or PSYNC for client, b"" when there is no reply"""
+        name = parts[0].upper()
+        if name in ("REPLICAOF", "SLAVEOF"):
+            return self.replicaof_command(parts[1:])
+        if name == "REPLCONF":
+            return self.replconf(client, parts[1:])
+        return self.psync(client, parts[1:])
+
+    def replicaof_command(self, args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'replicaof' command")
+        if args[0].lower() == 'no' and args[1].lower() == 'one':
+            if self.is_replica:
+                self.promote()
+            return ok()
+        try:
+            port = int(args[1])
+        except ValueError:
+            return errorm("Invalid master port")
+        if self.is_replica and (self.master_host, self.master_port) == (args[0], port):
+            return simple_string("OK Already connected to specified master")
+        self.replicaof(args[0], port)
+        return ok()
+
+    def replicaof(self, host: str, port: int) -> None:
+        """Follow host:port, the dataset is kept until the sync replaces it"""
+        self._close_master_link()
+        self.master_host, self.master_port = host, port
+        #They resync from this node once it follows the new master
+        self._disconnect_replicas()
+        print(f"Connecting to MASTER {host}:{port}")
+        self._connect_master()
+
+    def promote(self) -> None:
+        """REPLICAOF NO ONE: keep the dataset and start a new history"""
+        self._close_master_link()
+        self.master_host = self.master_port = None
+        self.replid2 = self.replid
+        self.second_replid_offset = self.master_repl_offset + 1
+        self.replid = new_replid()
+        print("MASTER MODE enabled")
+
+    def replconf(self, client, args):
+        if len(args) % 2:
+            return errorm("syntax error")
+        for option, value in zip(args[0::2], args[1::2]):
+            option = option.lower()
+            if option == 'ack':
+                #Replicas get no reply to their ACKs
+                replica = self.replicas.get(client)
+                if replica is not None:
+                    try:
+                        replica["ack_offset"] = int(value)
+                    except ValueError:
+                        pass
+                    replica["ack_time"] = time.time()
+                return b""
+            if option == 'listening-port':
+                try:
+                    self.listening_ports[client] = int(value)
+                except ValueError:
+                    return errorm("value is not an integer or out of range")
+            elif option not in ('capa', 'ip-address'):
+                return errorm(f"Unrecognized REPLCONF option: {option}")
+        return ok()
+
+    def psync(self, client, args):
+        if len(args) != 2:
+            return errorm("wrong number of arguments for 'psync' command")
+        if client in self.replicas:
+            return b""
+        if self.is_replica and (self.master_link is None or self.master_link["state"] != 'connected'):
+            return b"-NOMASTERLINK Can't SYNC while not connected with my master\r\n"
+        if self.server.persistence_manager.loading:
+            return b"-LOADING Redis is loading the dataset in memory\r\n"
+        try:
+            offset = int(args[1])
+        except ValueError:
+            offset = -1
+        now = time.time()
+        replica = {"state" : 'wait_bgsave_start', "port" : self.listening_ports.pop(client, 0),
+                   "ack_offset" : 0, "ack_time" : now, "pending" : []}
+        self.replicas[client] = replica
+        if self._partial_resync(client, replica, args[0], offset):
+            return b""
+        print(f"Full resync requested by replica {self.server.clients[client]['addr']}")
+        if self.backlog is None:
+            self.backlog = ReplicationBacklog(self._backlog_size(), self.master_repl_offset)
+        self._start_full_sync()
+        return b""
+
+    def _partial_resync(self, client, replica, replid: str, offset: int) -> bool:
+        backlog = self.backlog
+        if backlog is None:
+            return False
+        if replid != self.replid and not (replid == self.replid2 and offset <= self.second_replid_offset):
+            return False
+        if not backlog.covers(offset):
+            return False
+        replica["state"] = 'online'
+        data = backlog.read_from(offset)
+        self.server._queue_reply(client, f"+CONTINUE {self.replid}\r\n".encode() + data)
+        print(f"Partial resynchronization request from {self.server.clients[client]['addr']} accepted, "
+              f"sending {len(data)} bytes of backlog")
+        return True
+
+    def _start_full_sync(self) -> None:
+        """Fork the BGSAVE replicas waiting for a snapshot get"""
+        waiting = [client for client, replica in self.replicas.items() if replica["state"] == 'wait_bgsave_start']
+        if not waiting:
+            return
+        manager = self.server.persistence_manager
+        if manager.bgsave_child is not None or manager.aof_rewrite_child is not None:
+            #cron() tries again once that child is done
+            return
+        if not manager.bgsave(self.server.storage):
+            for client in waiting:
+                self.server._disconnect_client(client)
+            return
+        self.rdb_child = manager.bgsave_child
+        #The snapshot holds every write up to this offset
+        reply = f"+FULLRESYNC {self.replid} {self.master_repl_offset}\r\n".encode()
+        for client in waiting:
+            self.replicas[client]["state"] = 'wait_bgsave_end'
+            self.server._queue_reply(client, reply)
+
+    def _finish_full_sync(self) -> None:
+        manager = self.server.persistence_manager
+        if self.rdb_child is None or manager.bgsave_child == self.rdb_child:
+            return
+        self.rdb_child = None
+        waiting = [client for client, replica in self.replicas.items() if replica["state"] == 'wait_bgsave_end']
+        for client in waiting:
+            replica = self.replicas[client]
+            if manager.last_bgsave_status != 'ok':
+                print("BGSAVE for replication failed")
+                self.server._disconnect_client(client)
+                continue
+            try:
+                size = self.server._queue_bulk_file(client, self.config.snapshot_filename)
+            except OSError as e:
+                print(f"Can't send the snapshot to replica: {e}")
+                self.server._disconnect_client(client)
+                continue
+            for record in replica["pending"]:
+                self.server._queue_reply(client, record)
+            replica["pending"] = []
+            replica["state"] = 'online'
+            replica["ack_time"] = time.time()
+            print(f"Synchronization with replica {self.server.clients[client]['addr']} succeeded, "
+                  f"{size} bytes of snapshot")
+
+    def feed(self, args) -> None:
+        """Stream a write to the replicas, called once the command succeeded"""
+        if self.backlog is None:
+            return
+        self._feed_record(encode_command(args))
+
+    def _feed_record(self, record: bytes) -> None:
+        self.backlog.append(record)
+        self.master_repl_offset += len(record)
+        for client, replica in self.replicas.items():
+            state = replica["state"]
+            if state == 'online':
+                self.server._queue_reply(client, record)
+            elif state == 'wait_bgsave_end':
+                #Sent after the snapshot, which does not hold it
+                replica["pending"].append(record)
+
+    def client_closed(self, client) -> None:
+        self.listening_ports.pop(client, None)
+        if self.replicas.pop(client, None) is not None:
+            print("Connection with replica lost")
+
+    def _disconnect_replicas(self) -> None:
+        for client in list(self.replicas):
+            self.server._disconnect_client(client)
+
+    def cron(self) -> None:
+        """Pings, ACKs, timeouts and reconnects, run every persistence interval"""
+        now = time.time()
+        timeout = int(self.config.get('repl_timeout', 60))
+        if self.replicas:
+            #Finish first: a new BGSAVE would replace rdb_child
+            self._finish_full_sync()
+            self._start_full_sync()
+            if not self.is_replica and now - self.last_ping_time >= REPL_PING_PERIOD:
+                self.last_ping_time = now
+                self._feed_record(encode_command(["PING"]))
+            keepalive = now - self.last_keepalive_time >= REPL_ACK_PERIOD
+            if keepalive:
+                self.last_keepalive_time = now
+            for client, replica in list(self.replicas.items()):
+                if replica["state"] != 'online':
+                    if keepalive:
+                        self.server._queue_reply(client, b"\n")
+                elif now - replica["ack_time"] > timeout:
+                    print("Disconnecting timedout replica")
+                    self.server._disconnect_client(client)
+        if not self.is_replica:
+            return
+        link = self.master_link
+        if link is None:
+            if now - self.last_connect_try >= REPL_RECONNECT_DELAY:
+                self._connect_master()
+        elif now - link["last_io"] > timeout:
+            self._close_master_link("MASTER timeout: no data nor PING received")
+        elif link["state"] == 'connected' and now - link["last_ack"] >= REPL_ACK_PERIOD:
+            link["last_ack"] = now
+            link["out"] += encode_command(["REPLCONF", "ACK", str(self.master_repl_offset)])
+            self._flush_master_link(link)
+
+    def _connect_master(self) -> None:
+        self.last_connect_try = time.time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            error = sock.connect_ex((self.master_host, self.master_port))
+            if error not in (0, errno.EINPROGRESS):
+                raise OSError(error, os.strerror(error))
+        except OSError as e:
+            print(f"Error connecting to MASTER {self.master_host}:{self.master_port}: {e}")
+            sock.close()
+            return
+        self.master_link = {
+            "sock" : sock,
+            #connecting, handshake, psync, transfer_size, transfer, connected
+            "state" : 'connecting',
+            "buffer" : bytearray(),
+            "out" : bytearray(),
+            "want_write" : True,
+            "replies" : 0,
+            "last_io" : time.time(),
+            "last_ack" : 0.0,
+            "parser" : None,
+            "replid" : None,
+            "offset" : 0,
+            "transfer_path" : None,
+            "transfer_file" : None,
+            "transfer_size" : 0,
+            "transfer_left" : 0,
+        }
+        self.server.selector.register(sock, selectors.EVENT_WRITE, self._handle_master_link)
+
+    def _close_master_link(self, reason=None) -> None:
+        link = self.master_link
+        if link is None:
+            return
+        self.master_link = None
+        self.link_down_since = time.time()
+        if reason:
+            print(f"Connection with master lost: {reason}")
+        try:
+            self.server.selector.unregister(link["sock"])
+        except (KeyError, ValueError):
+            pass
+        link["sock"].close()
+        if link["transfer_file"] is not None:
+            link["transfer_file"].close()
+            try:
+                os.remove(link["transfer_path"])
+            except OSError:
+                pass
+
+    def _flush_master_link(self, link) -> None:
+        sock = link["sock"]
+        try:
+            while link["out"]:
+                sent = sock.send(link["out"])
+                del link["out"][:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self._close_master_link(e)
+            return
+        want_write = bool(link["out"])
+        if want_write != link["want_write"]:
+            link["want_write"] = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.server.selector.modify(sock, events, self._handle_master_link)
+
+    def _handle_master_link(self, sock, mask) -> None:
+        link = self.master_link
+        if link is None or link["sock"] is not sock:
+            return
+        if link["state"] == 'connecting':
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._close_master_link(f"Error condition on socket for SYNC: {os.strerror(error)}")
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print("MASTER <-> REPLICA sync started")
+            link["state"] = 'handshake'
+            #Registered for writability only so far, the flush re-registers
+            link["want_write"] = None
+            link["out"] += b"".join([
+                encode_command(["PING"]),
+                encode_command(["REPLCONF", "listening-port", str(self.server.port)]),
+                encode_command(["REPLCONF", "capa", "psync2"]),
+                encode_command(["PSYNC", self.replid, str(self.master_repl_offset + 1)]),
+            ])
+            self._flush_master_link(link)
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._flush_master_link(link)
+            if self.master_link is not link:
+                return
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            data = sock.recv(REPL_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close_master_link(e)
+            return
+        if not data:
+            self._close_master_link("connection closed by master")
+            return
+        link["last_io"] = time.time()
+        if link["state"] == 'connected':
+            self._apply_stream(link, data)
+        else:
+            link["buffer"] += data
+            self._process_sync(link)
+
+    def _process_sync(self, link) -> None:
+        """Handshake replies, the PSYNC reply and the snapshot, in that order"""
+        buffer = link["buffer"]
+        while link["state"] != 'connected':
+            if link["state"] == 'transfer':
+                chunk = buffer[:link["transfer_left"]]
+                link["transfer_file"].write(chunk)
+                link["transfer_left"] -= len(chunk)
+                del buffer[:len(chunk)]
+                if link["transfer_left"] or not self._load_transfer(link):
+                    return
+                continue
+            end = buffer.find(b"\r\n")
+            if end == -1:
+                return
+            #Newlines are the master's keepalive while it writes the snapshot
+            line = buffer[:end].decode('utf-8', 'replace').lstrip("\n")
+            del buffer[:end + 2]
+            if link["state"] == 'handshake':
+                if line.startswith('-'):
+                    print(f"Master replied to the handshake with an error: {line}")
+                link["replies"] += 1
+                if link["replies"] == 3:
+                    link["state"] = 'psync'
+            elif link["state"] == 'psync':
+                if not self._psync_reply(link, line):
+                    return
+            elif line.startswith('$'):
+                try:
+                    size = int(line[1:])
+                except ValueError:
+                    self._close_master_link(f"Bad protocol from MASTER, the first byte is not '$': {line}")
+                    return
+                link["transfer_path"] = os.path.join(self.config.temp_dir, f"temp-repl-{os.getpid()}.rdb")
+                link["transfer_file"] = open(link["transfer_path"], 'wb')
+                link["transfer_size"] = link["transfer_left"] = size
+                link["state"] = 'transfer'
+                print(f"MASTER <-> REPLICA sync: receiving {size} bytes from master")
+            elif line:
+                self._close_master_link(f"Bad protocol from MASTER, the first byte is not '$': {line}")
+                return
+        if buffer:
+            data = bytes(buffer)
+            buffer.clear()
+            self._apply_stream(link, data)
+
+    def _psync_reply(self, link, line: str) -> bool:
+        fields = line.split()
+        if line.startswith('+FULLRESYNC') and len(fields) == 3:
+            link["replid"] = fields[1]
+            link["offset"] = int(fields[2])
+            link["state"] = 'transfer_size'
+            print(f"Full resync from master: {fields[1]}:{fields[2]}")
+            return True
+        if line.startswith('+CONTINUE'):
+            if len(fields) > 1 and fields[1] != self.replid:
+                #The master was promoted, our offsets continue its history
+                self.replid2 = self.replid
+                self.second_replid_offset = self.master_repl_offset + 1
+                self.replid = fields[1]
+                self._disconnect_replicas()
+            if self.backlog is None:
+                self.backlog = ReplicationBacklog(self._backlog_size(), self.master_repl_offset)
+            link["state"] = 'connected'
+            link["parser"] = RESPParser()
+            print("MASTER <-> REPLICA sync: Master accepted a Partial Resynchronization")
+            return True
+        self._close_master_link(f"Unexpected reply to PSYNC from master: {line}")
+        return False
+
+    def _load_transfer(self, link) -> bool:
+        """Replace the dataset with the snapshot received from the master"""
+        link["transfer_file"].close()
+        link["transfer_file"] = None
+        storage = self.server.storage
+        filename = self.config.snapshot_filename
+        try:
+            os.replace(link["transfer_path"], filename)
+            storage.flush()
+            keys = load_snapshot(storage, filename, int(self.config.get('list_max_listpack_size', -2)))
+        except (OSError, SnapshotError) as e:
+            self._close_master_link(f"Failed trying to load the MASTER synchronization DB from disk: {e}")
+            return False
+        print(f"MASTER <-> REPLICA sync: Finished with success, {keys} keys loaded")
+        self.replid = link["replid"]
+        self.replid2 = NO_REPLID
+        self.second_replid_offset = -1
+        self.master_repl_offset = link["offset"]
+        self.backlog = ReplicationBacklog(self._backlog_size(), self.master_repl_offset)
+        self._disconnect_replicas()
+        self.server.persistence_manager.restart_aof(storage)
+        link["state"] = 'connected'
+        link["parser"] = RESPParser()
+        return True
+
+    def _apply_stream(self, link, data: bytes) -> None:
+        parser = link["parser"]
+        parser.feed(data)
+        execute = self.server.command_handler.execute_replicated
+        for args in parser.parse():
+            record = encode_command(args)
+            if args[0].upper() != "PING":
+                reply = execute(*args)
+                if reply[:1] == b"-":
+                    print(f"Error applying {args[0]} from master: {reply.decode(errors='replace').strip()}")
+            #Sub-replicas get the stream as received, PINGs included
+            self._feed_record(record)
+        if parser.error:
+            self._close_master_link(f"Protocol error from master: {parser.error}")
+
+    def _backlog_size(self) -> int:
+        return int(self.config.get('repl_backlog_size', 1024 * 1024))
+
+    def info(self) -> dict:
+        """Fields of the INFO replication section"""
+        now = time.time()
+        info = {"role" : "slave" if self.is_replica else "master"}
+        if self.is_replica:
+            link = self.master_link
+            connected = link is not None and link["state"] == 'connected'
+            transferring = link is not None and link["state"] == 'transfer'
+            info.update({
+                "master_host" : self.master_host,
+                "master_port" : self.master_port,
+                "master_link_status" : "up" if connected else "down",
+                "master_last_io_seconds_ago" : int(now - link["last_io"]) if link else -1,
+                "master_sync_in_progress" : int(transferring),
+                "slave_repl_offset" : self.master_repl_offset,
+            })
+            if transferring:
+                info["master_sync_total_bytes"] = link["transfer_size"]
+                info["master_sync_read_bytes"] = link["transfer_size"] - link["transfer_left"]
+            if not connected:
+                info["master_link_down_since_seconds"] = int(now - self.link_down_since)
+            info["slave_read_only"] = 1
+        info["connected_slaves"] = len(self.replicas)
+        for index, (client, replica) in enumerate(self.replicas.items()):
+            state = "online" if replica["state"] == 'online' else "wait_bgsave"
+            ip = self.server.clients[client]["addr"][0]
+            info[f"slave{index}"] = (f"ip={ip},port={replica['port']},state={state},"
+                                     f"offset={replica['ack_offset']},lag={int(now - replica['ack_time'])}")
+        backlog = self.backlog
+        info.update({
+            "master_replid" : self.replid,
+            "master_replid2" : self.replid2,
+            "master_repl_offset" : self.master_repl_offset,
+            "second_repl_offset" : self.second_replid_offset,
+            "repl_backlog_active" : int(backlog is not None),
+            "repl_backlog_size" : backlog.size if backlog else self._backlog_size(),
+            "repl_backlog_first_byte_offset" : backlog.first_offset if backlog else 0,
+            "repl_backlog_histlen" : backlog.histlen if backlog else 0,
+        })
+        return info
+
+    def close(self) -> None:
+        self._close_master_link()
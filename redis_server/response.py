@@ -1,3 +1,8 @@
+from .protocol import encode_arg
+
+#Integer replies for 0..9999 are built once, like Redis shared integers
+SHARED_INTEGERS = 10000
+_shared_integer_replies = [b":%d\r\n" % value for value in range(SHARED_INTEGERS)]
 def ok():
     return  b"+OK\r\n"
 def pong():
@@ -7,13 +12,20 @@ def null_bulk_string():
 def simple_string(value):
     return f"+{value}\r\n".encode()
 def bulk_string(value):
-    if value in None:
+    if value is None:
         return null_bulk_string()
-    return f"$len{value}\r\n{value}\r\n".encode()
+    data = encode_arg(value)
+    return b"$%d\r\n%s\r\n" % (len(data), data)
 def errorm(message):
     return f"-ERR {message}\r\n".encode()
+def wrongtype():
+    return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+def null_array():
+    return b"*-1\r\n"
 def integar(value):
-    return f":{value}\r\n".encode()
+    if 0 <= value < SHARED_INTEGERS:
+        return _shared_integer_replies[value]
+    return b":%d\r\n" % value
 def array(items):
     if not items:
         return b"*0\r\n"
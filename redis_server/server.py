@@ -1,19 +1,42 @@
+import os
 import socket
-import select
+import selectors
+from collections import deque
 from .command import CommandHandler
 from .storage import DataStore
+from .protocol import RESPParser, RESPReplyParser, encode_command
+from .timers import TimerQueue
 import time
 from .persistence  import PersistenceManager, PersistenceConfig
+from .replication import Replication, REPLICATION_COMMANDS
+from .cluster import Cluster, CLUSTER_COMMANDS
+from .sharding import BROADCAST_COMMANDS
 class RedisServer:
-    def __init__(self, host ='localhost', port = 6379, persistence_config = None):
+    def __init__(self, host ='localhost', port = 6379, persistence_config = None, shard = None):
         self.host = host
         self.port = port
         self.running = False
         self.server_socket = None
+        self.unix_socket = None
+        #ShardRouter when running as one worker of a sharded deployment
+        self.shard = shard
+        #Connections to other shard workers, used to forward commands
+        self.shard_links = {}
         self.clients = {}
+        #Clients that produced replies during this loop iteration
+        self.clients_pending_write = set()
+        #Clients whose socket buffer was full, waiting for writability
+        self.clients_waiting_write = set()
         self.storage = DataStore()
-        self.last_cleanup_time = time.time()
+        self.selector = None
+        self.timers = TimerQueue()
         self.cleanup_interval = 0.1 #100ms cleanup interval
+        self.fast_expire_duration = 0.001 #1ms fast expire cycle
+        self.last_fast_expire_time = 0.0
+        self.tcp_backlog = 511
+        self.max_accepts_per_call = 1000
+        self.read_buffer_size = 16 * 1024
+        self.max_iov = 1024 #chunks passed to a single sendmsg call
         
         #initilaize Persistence
         
@@ -23,50 +46,96 @@ class RedisServer:
         #Command handler needs referecne to Persistence manager for logging
         
         self.command_handler = CommandHandler(self.storage, self.persistence_manager)
-        self.last_persistence_time = time.time()
+        self.replication = Replication(self)
+        self.command_handler.replication = self.replication
+        self.cluster = Cluster(self)
         self.persistence_interval = 0.1 #100ms persistence interval
         
     def start(self):
         """"start persistence"""
         self.persistence_manager.start()
         print("Recovering data from persistence files")
-        recovery_success = self.persistence_manager.recover_data(self.storage, self.command_handler)
-        
-        if recovery_success:
-            print("Data recovery completed successfully")
-            
+        if self.persistence_config.get('async_loading', False):
+            #Clients connect right away and get -LOADING until it is done
+            self.persistence_manager.begin_loading(self.storage, self.command_handler)
         else:
-            print("Data reocvery failed, starting with an empty database")
+            self._recovery_done(self.persistence_manager.recover_data(self.storage, self.command_handler))
         
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        if self.shard and self.shard.mode == 'proxy':
+            #Every worker accepts on the same port, the kernel spreads connections
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen()
+        self.server_socket.listen(self.tcp_backlog)
         self.server_socket.setblocking(False)
+        
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self._accept_client)
+        if self.shard and self.shard.mode == 'proxy':
+            self._listen_unix(self.shard.socket_path(self.shard.index))
+        self.timers.add_periodic(self.cleanup_interval, self._background_cleanup)
+        self.timers.add_periodic(self.persistence_interval, self._background_persistence_task)
+        if self.persistence_manager.loading:
+            self.timers.add(0, self._background_loading)
+        self.cluster.start()
+        master = self.persistence_config.master_address
+        if master:
+            self.replication.replicaof(*master)
         self.running = True
         print(f"Redis-style server listening on {self.host} : {self.port}")
         self._event_loop()
         
+    def _recovery_done(self, success):
+        if success:
+            print("Data recovery completed successfully")
+        else:
+            #Serving a partly loaded store would lose every later write
+            print("Data recovery failed, refusing to start")
+            raise SystemExit(1)
+    
+    def _background_loading(self):
+        """Load one time slice of the dataset, between two event loop iterations"""
+        success = self.persistence_manager.load_step()
+        if success is None:
+            #A one-shot timer added now is not due again in this run_due(),
+            #so the loop polls the sockets before the next slice
+            self.timers.add(0, self._background_loading)
+            return
+        self._recovery_done(success)
+        
+    def _listen_unix(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.unix_socket.bind(path)
+        self.unix_socket.listen(self.tcp_backlog)
+        self.unix_socket.setblocking(False)
+        self.selector.register(self.unix_socket, selectors.EVENT_READ, self._accept_client)
+        
     def _event_loop(self):
         while self.running:
             try:
-                read, _, _ = select.select([self.server_socket] + list(self.clients.keys()), [], [], 0.5)
-                for sock  in read:
-                    if sock is self.server_socket:
-                        self._accept_client()
-                    else:
+                #Sleep until a socket is ready or the next timer is due
+                timeout = self.timers.time_until_next(default=0.5)
+                for key, mask in self.selector.select(timeout):
+                    sock = key.fileobj
+                    if key.data is not None:
+                        #Listening sockets and shard links carry their own handler
+                        key.data(sock, mask)
+                        continue
+                    if mask & selectors.EVENT_READ and sock in self.clients:
                         self._handle_client(sock)
-                current_time = time.time()
+                    if mask & selectors.EVENT_WRITE and sock in self.clients:
+                        self._write_to_client(sock)
                 
-                #Background cleanup every 100ms
-                if current_time - self.last_cleanup_time >= self.cleanup_interval:
-                     self._background_cleanup()
-                     self.last_cleanup_time = current_time
-                     
-                #Persistence tasks every 100ms
-                if current_time - self.last_persistence_time >= self.persistence_interval:
-                    self._background_persistence_task()
-                    self.last_persistence_time = current_time
+                self._fast_expire_cycle()
+                #The AOF gets this iteration's writes before any client sees
+                #a reply to them; with appendfsync always that is one fsync
+                self.persistence_manager.flush_aof()
+                #One write per client for everything its batch produced
+                self._handle_clients_with_pending_writes()
+                self.timers.run_due()
             except KeyboardInterrupt:
                 break
             except Exception as e:
@@ -74,26 +143,54 @@ class RedisServer:
                 
     def _background_persistence_task(self):
         try:
-            self.persistence_manager.periodic_tasks()
+            self.persistence_manager.periodic_tasks(self.storage)
         except Exception as e:
             print(f"Error during persistence task: {e}")
-                
-    def _accept_client(self):
         try:
-         client,  addr = self.server_socket.accept()
-         client.setblocking(False)
-         self.clients[client] = {"addr" : addr, "buffer" : b""}
-         print(f"Client Connected from {addr}")
+            self.replication.cron()
+        except Exception as e:
+            print(f"Error during replication task: {e}")
+        try:
+            self.cluster.cron()
         except Exception as e:
-            print(f"error connecting client: {e}")
+            print(f"Error during cluster task: {e}")
+                
+    def _accept_client(self, listener, mask = None):
+        #Drain the accept queue so a connection burst needs only one wakeup
+        for _ in range(self.max_accepts_per_call):
+            try:
+                client,  addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                print(f"error connecting client: {e}")
+                return
+            client.setblocking(False)
+            if client.family == socket.AF_INET:
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.clients[client] = {
+                "addr" : addr,
+                "parser" : RESPParser(),
+                #Pending reply chunks, sent together with a single sendmsg
+                "reply" : [],
+                "reply_bytes" : 0,
+                "soft_limit_reached_time" : None,
+                "close_after_reply" : False,
+                #Replies queued behind a command forwarded to another shard
+                "deferred" : deque(),
+                #Snapshot sent to a replica: [fd, header, offset, size]
+                "transfer" : None,
+            }
+            self.selector.register(client, selectors.EVENT_READ)
+            print(f"Client Connected from {addr}")
             
     def _handle_client(self, client):
         try :
-            data  = client.recv(4096)
+            data  = client.recv(self.read_buffer_size)
             if not  data:
                 self._disconnect_client(client)
                 return
-            self.clients[client]["buffer"] += data
+            self.clients[client]["parser"].feed(data)
             self.process_buffer(client)
         except ConnectionError:
             self._disconnect_client(client)
@@ -102,29 +199,333 @@ class RedisServer:
             self._disconnect_client(client)
             
     def  process_buffer(self,client):
-        buffer = self.clients[client]["buffer"]
-        while b"\r\n" in buffer:
-            command, buffer = buffer.split(b"\r\n",1)
-            if command:
-                try:
-                  response = self.process_command(command.decode())
-                  client.send(response)
-                except Exception as e:
-                    print(f"Error proccessing command: {e}")
-                    error_response = f"-ERR  {str(e)}\r\n".encode()
-                    client.send(error_response)
-        self.clients[client]["buffer"] = buffer
+        state = self.clients[client]
+        parser = state["parser"]
+        for parts in parser.parse():
+            if state["close_after_reply"]:
+                break
+            if parts and parts[0].upper() in REPLICATION_COMMANDS:
+                #Replication commands need the connection they came on
+                self._add_reply(client, self.replication.command(client, parts))
+                continue
+            if parts and parts[0].upper() in CLUSTER_COMMANDS:
+                self._add_reply(client, self.cluster.command(client, parts))
+                continue
+            if parts and self.cluster.enabled:
+                redirect = self.cluster.route(client, parts)
+                if redirect:
+                    self._add_reply(client, redirect)
+                    continue
+            if self.shard and self._route_to_shard(client, parts):
+                continue
+            try:
+              response = self.process_command(parts)
+            except Exception as e:
+                print(f"Error proccessing command: {e}")
+                response = f"-ERR  {str(e)}\r\n".encode()
+            self._add_reply(client, response)
+        if parser.error and not state["close_after_reply"]:
+            #Requests before the malformed one were answered, now drop the client
+            self._add_reply(client, f"-ERR {parser.error}\r\n".encode())
+            state["close_after_reply"] = True
+        
+    def _add_reply(self, client, data):
+        state = self.clients[client]
+        if state["close_after_reply"] or not data:
+            return
+        if state["deferred"]:
+            #Keep pipeline order while a forwarded command is in flight
+            state["deferred"].append([data])
+            return
+        self._queue_reply(client, data)
+        
+    def _queue_reply(self, client, data):
+        state = self.clients[client]
+        state["reply"].append(data)
+        state["reply_bytes"] += len(data)
+        self.clients_pending_write.add(client)
+        if self._output_buffer_limit_reached(state["reply_bytes"], state):
+            print(f"Client {state['addr']} scheduled to be closed for overcoming of output buffer limits")
+            #Drop what is queued, the client is closed once the loop reaches it
+            state["reply"] = []
+            state["reply_bytes"] = 0
+            state["close_after_reply"] = True
+            
+    def _output_buffer_limit_reached(self, used, state):
+        """state holds the client's soft_limit_reached_time between calls"""
+        hard_limit = int(self.persistence_config.get('client_output_buffer_hard_limit', 0))
+        soft_limit = int(self.persistence_config.get('client_output_buffer_soft_limit', 0))
+        soft_seconds = int(self.persistence_config.get('client_output_buffer_soft_seconds', 0))
+        if hard_limit and used >= hard_limit:
+            return True
+        if soft_limit and used >= soft_limit:
+            now = time.time()
+            if state["soft_limit_reached_time"] is None:
+                state["soft_limit_reached_time"] = now
+            elif now - state["soft_limit_reached_time"] >= soft_seconds:
+                return True
+        else:
+            state["soft_limit_reached_time"] = None
+        return False
+        
+    def _queue_bulk_file(self, client, path):
+        """
+        Queue a file as a bulk string without its trailing CRLF, the way a
+        master sends its snapshot; replies queued so far go out before it
+        and later ones after it. Returns the file size
+        """
+        state = self.clients[client]
+        fd = os.open(path, os.O_RDONLY)
+        size = os.fstat(fd).st_size
+        head = b"".join(state["reply"]) + b"$%d\r\n" % size
+        state["reply"] = []
+        state["reply_bytes"] = 0
+        state["transfer"] = [fd, head, 0, size]
+        self.clients_pending_write.add(client)
+        return size
+        
+    def _send_transfer(self, client, state):
+        """sendfile() the queued file, raises BlockingIOError when the socket is full"""
+        transfer = state["transfer"]
+        fd, head, offset, size = transfer
+        while head:
+            sent = client.send(head)
+            head = transfer[1] = head[sent:]
+        while offset < size:
+            sent = os.sendfile(client.fileno(), fd, offset, size - offset)
+            if not sent:
+                raise ConnectionError("file truncated while sending it")
+            offset = transfer[2] = offset + sent
+        os.close(fd)
+        state["transfer"] = None
+        
+    def _handle_clients_with_pending_writes(self):
+        pending = self.clients_pending_write
+        self.clients_pending_write = set()
+        for client in pending:
+            if client not in self.clients:
+                continue
+            state = self.clients[client]
+            if state["close_after_reply"] and not state["reply"]:
+                #Output buffer limit reached, nothing left worth sending
+                self._disconnect_client(client)
+            elif client not in self.clients_waiting_write:
+                #Clients already waiting for writability are flushed by the poller
+                self._write_to_client(client)
+                
+    def _write_to_client(self, client):
+        state = self.clients[client]
+        reply = state["reply"]
+        try:
+            if state["transfer"] is not None:
+                self._send_transfer(client, state)
+            while reply:
+                #writev-style send of every queued chunk in one syscall
+                sent = client.sendmsg(reply[:self.max_iov])
+                state["reply_bytes"] -= sent
+                done = 0
+                while sent and sent >= len(reply[done]):
+                    sent -= len(reply[done])
+                    done += 1
+                del reply[:done]
+                if sent:
+                    reply[0] = reply[0][sent:]
+        except (BlockingIOError, InterruptedError):
+            self._wait_writable(client)
+            return
+        except OSError as e:
+            print(f"Error writing to client: {e}")
+            self._disconnect_client(client)
+            return
+        if client in self.clients_waiting_write:
+            self.clients_waiting_write.discard(client)
+            self.selector.modify(client, selectors.EVENT_READ)
+        state["soft_limit_reached_time"] = None
+        if state["close_after_reply"]:
+            self._disconnect_client(client)
+            
+    def _wait_writable(self, client):
+        if client not in self.clients_waiting_write:
+            #Only ask for write events while output is pending
+            self.clients_waiting_write.add(client)
+            self.selector.modify(client, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            
+    def _route_to_shard(self, client, parts):
+        """
+        Send a command to the shard owning its keys
+
+        Returns True when the command was answered here (MOVED/CROSSSLOT)
+        or forwarded, False when it should be executed locally
+        """
+        if (self.shard.mode == 'proxy' and parts and parts[0].upper() in BROADCAST_COMMANDS
+                and client.family != socket.AF_UNIX):
+            #Commands forwarded by another worker arrive on the Unix socket
+            #and only run here
+            self._broadcast_to_shards(client, parts)
+            return True
+        route = self.shard.route(self.command_handler.get_keys(parts[0], parts[1:]))
+        if route is None:
+            return False
+        owner, slot = route
+        if owner < 0:
+            self._add_reply(client, b"-CROSSSLOT Keys in request don't hash to the same shard\r\n")
+        elif self.shard.mode == 'moved':
+            self._add_reply(client, f"-MOVED {slot} {self.host}:{self.shard.listen_port(owner)}\r\n".encode())
+        else:
+            self._forward_to_shard(client, owner, parts)
+        return True
+        
+    def _broadcast_to_shards(self, client, parts):
+        """Run a command on every worker, the client gets one combined reply"""
+        slot = [None]
+        self.clients[client]["deferred"].append(slot)
+        gather = {"replies" : [], "count" : self.shard.count,
+                  "combine" : BROADCAST_COMMANDS[parts[0].upper()]}
+        for owner in range(self.shard.count):
+            if owner != self.shard.index:
+                self._forward_to_shard(client, owner, parts, slot, gather)
+        try:
+            response = self.process_command(parts)
+        except Exception as e:
+            print(f"Error proccessing command: {e}")
+            response = f"-ERR  {str(e)}\r\n".encode()
+        self._shard_reply(client, slot, gather, response)
+        
+    def _forward_to_shard(self, client, owner, parts, slot = None, gather = None):
+        """
+        Send a command to another worker
+
+        The reply fills slot, or is collected in gather when the command
+        was broadcast to every worker
+        """
+        if slot is None:
+            #Placeholder filled in when the owner replies
+            slot = [None]
+            self.clients[client]["deferred"].append(slot)
+        link = self.shard_links.get(owner)
+        if link is None:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.shard.socket_path(owner))
+                sock.setblocking(False)
+            except OSError as e:
+                self._shard_reply(client, slot, gather, f"-ERR shard {owner} unavailable: {e}\r\n".encode())
+                return
+            link = {"sock" : sock, "shard" : owner, "parser" : RESPReplyParser(),
+                    "out" : bytearray(), "waiting" : deque(), "want_write" : False}
+            self.shard_links[owner] = link
+            self.selector.register(sock, selectors.EVENT_READ, self._handle_shard_link)
+        link["waiting"].append((client, slot, gather))
+        link["out"] += encode_command(parts)
+        self._flush_shard_link(link)
+        
+    def _flush_shard_link(self, link):
+        sock = link["sock"]
+        try:
+            while link["out"]:
+                sent = sock.send(link["out"])
+                del link["out"][:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self._close_shard_link(link, e)
+            return
+        want_write = bool(link["out"])
+        if want_write != link["want_write"]:
+            link["want_write"] = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(sock, events, self._handle_shard_link)
+        
+    def _handle_shard_link(self, sock, mask):
+        link = next((l for l in self.shard_links.values() if l["sock"] is sock), None)
+        if link is None:
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._flush_shard_link(link)
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            data = sock.recv(self.read_buffer_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close_shard_link(link, e)
+            return
+        if not data:
+            self._close_shard_link(link, "connection closed")
+            return
+        link["parser"].feed(data)
+        for reply in link["parser"].parse():
+            self._shard_reply(*link["waiting"].popleft(), reply)
+            
+    def _shard_reply(self, client, slot, gather, reply):
+        if gather is not None:
+            gather["replies"].append(reply)
+            if len(gather["replies"]) < gather["count"]:
+                return
+            reply = gather["combine"](gather["replies"])
+        slot[0] = reply
+        self._release_deferred(client)
+            
+    def _release_deferred(self, client):
+        """Move replies at the head of the deferred queue to the output buffer"""
+        state = self.clients.get(client)
+        if state is None:
+            return
+        deferred = state["deferred"]
+        while deferred and deferred[0][0] is not None:
+            data = deferred.popleft()[0]
+            if not state["close_after_reply"]:
+                self._queue_reply(client, data)
+        
+    def _close_shard_link(self, link, reason):
+        print(f"Lost link to shard {link['shard']}: {reason}")
+        self.shard_links.pop(link["shard"], None)
+        try:
+            self.selector.unregister(link["sock"])
+        except (KeyError, ValueError):
+            pass
+        link["sock"].close()
+        error = f"-ERR shard {link['shard']} unavailable\r\n".encode()
+        for client, slot, gather in link["waiting"]:
+            self._shard_reply(client, slot, gather, error)
         
     def _background_cleanup(self):
+        """Slow expire cycle, limited to a share of every cleanup interval"""
+        if self.persistence_manager.loading:
+            #Keys are not expired before the whole dataset is there
+            return
         try:
-          expired_count = self.storage.cleanup_expired_keys()
+          time_percent = float(self.persistence_config.get('active_expire_cycle_time_percent', 25))
+          time_limit = self.cleanup_interval * time_percent / 100
+          expired_count = self.storage.active_expire_cycle(time_limit)
           if expired_count > 0:
               print(f"Cleaned up {expired_count} expired keys")
         except Exception as e:
               print(f"error during background cleanup: {e}")
               
-    def process_command(self,command_line):
-        parts = command_line.strip().split()
+    def _fast_expire_cycle(self):
+        """
+        Short expire cycle run before the loop sleeps
+
+        Only runs while the slow cycle reports that too many volatile keys
+        are already expired, and at most once every two fast durations.
+        """
+        if self.persistence_manager.loading:
+            return
+        acceptable_stale = float(self.persistence_config.get('active_expire_acceptable_stale', 10))
+        if self.storage.stats["expired_stale_perc"] * 100 <= acceptable_stale:
+            return
+        now = time.perf_counter()
+        if now - self.last_fast_expire_time < self.fast_expire_duration * 2:
+            return
+        self.last_fast_expire_time = now
+        try:
+            self.storage.active_expire_cycle(self.fast_expire_duration)
+        except Exception as e:
+            print(f"error during fast expire cycle: {e}")
+              
+    def process_command(self,parts):
         if not  parts:
             return b"-ERR empty command\r\n"
         return self.command_handler.execute(parts[0],*parts[1:])
@@ -132,21 +533,41 @@ class RedisServer:
         try: 
           addr = self.clients.get(client,{}).get("addr","unknown")
           print(f"Client {addr} disconnected ")
+          if client in self.clients:
+              self.selector.unregister(client)
+              transfer = self.clients[client]["transfer"]
+              if transfer is not None:
+                  os.close(transfer[0])
+              self.replication.client_closed(client)
+              self.cluster.client_closed(client)
           client.close()
           self.clients.pop(client,None)
+          self.clients_pending_write.discard(client)
+          self.clients_waiting_write.discard(client)
         except Exception as e:
             print(f"Error disconnecting client: {e}")
             
     def stop(self):
         self.running = False
+        self.replication.close()
+        self.cluster.close()
         try:
             self.persistence_manager.stop()
         except Exception as e:
             print(f"Error stopping persistence: {e}")
         
-        for client in self.clients.keys():
+        for client in list(self.clients.keys()):
             self._disconnect_client(client)
+        for link in list(self.shard_links.values()):
+            link["sock"].close()
         if self.server_socket:
          self.server_socket.close()
+        if self.unix_socket:
+            path = self.unix_socket.getsockname()
+            self.unix_socket.close()
+            if os.path.exists(path):
+                os.remove(path)
+        if self.selector:
+            self.selector.close()
         print("Server Stopped")
         
\ No newline at end of file
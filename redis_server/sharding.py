@@ -0,0 +1,169 @@
+"""
+Multi-process sharding
+
+The keyspace is split into 16384 CRC16 hash slots, the same scheme as
+Redis Cluster. In sharded mode main.py forks one worker process per shard,
+each owning a contiguous range of slots with its own DataStore and AOF.
+
+Two modes are supported:
+  proxy - every worker accepts on the same port (SO_REUSEPORT). Commands
+          for keys owned by another worker are forwarded over that
+          worker's Unix socket and the reply is relayed back. FLUSHALL
+          and DBSIZE go to every worker and their replies are combined,
+          a flush must not clear only the slice of the receiving worker.
+  moved - worker i listens on port + i and answers -MOVED for keys it
+          does not own, leaving routing to cluster-aware clients.
+"""
+import binascii
+import os
+import signal
+from typing import List, Optional
+
+HASH_SLOTS = 16384
+
+SHARD_MODES = ('proxy', 'moved')
+
+
+def combine_ok(replies: List[bytes]) -> bytes:
+    """+OK when every worker succeeded, the first error otherwise"""
+    for reply in replies:
+        if reply[:1] == b"-":
+            return reply
+    return b"+OK\r\n"
+
+
+def combine_sum(replies: List[bytes]) -> bytes:
+    """Sum of the integer replies of the workers, the first error otherwise"""
+    total = 0
+    for reply in replies:
+        if reply[:1] != b":":
+            return reply
+        total += int(reply[1:])
+    return f":{total}\r\n".encode()
+
+
+#Keyless commands run on every worker in proxy mode, with how replies combine
+BROADCAST_COMMANDS = {
+    'FLUSHALL' : combine_ok,
+    'DBSIZE' : combine_sum,
+}
+
+
+def crc16(data: bytes) -> int:
+    """
+    CRC16-CCITT (XMODEM), the checksum Redis Cluster uses for key slots
+
+    binascii.crc_hqx computes exactly this polynomial and initial value
+    in C, it is hashed for every new key by the slot index of DataStore
+    """
+    return binascii.crc_hqx(data, 0)
+
+
+def key_hash_slot(key: str) -> int:
+    """
+    Hash slot of a key
+
+    When the key contains a non-empty {hash tag} only the tag is hashed,
+    so related keys can be forced into the same slot.
+    """
+    data = key.encode('utf-8', 'surrogateescape')
+    start = data.find(b"{")
+    if start != -1:
+        end = data.find(b"}", start + 1)
+        if end != -1 and end != start + 1:
+            data = data[start + 1:end]
+    return crc16(data) & (HASH_SLOTS - 1)
+
+
+class ShardRouter:
+    """Decides which worker process owns the keys of a command"""
+
+    def __init__(self, index: int, count: int, mode: str = 'proxy',
+                 host: str = 'localhost', port: int = 6379, socket_dir: str = './data'):
+        if mode not in SHARD_MODES:
+            raise ValueError(f"Invalid shard mode. Must be one of {SHARD_MODES}")
+        self.index = index
+        self.count = count
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.socket_dir = socket_dir
+
+    def shard_for_slot(self, slot: int) -> int:
+        return slot * self.count // HASH_SLOTS
+
+    def socket_path(self, shard: int) -> str:
+        return os.path.join(self.socket_dir, f"shard-{shard}.sock")
+
+    def listen_port(self, shard: int) -> int:
+        if self.mode == 'moved':
+            return self.port + shard
+        return self.port
+
+    def route(self, keys: List[str]):
+        """
+        Returns:
+          None when every key is local, otherwise (shard, slot) of the
+          owner, or (-1, -1) when the keys span several shards
+        """
+        owner = None
+        first_slot = None
+        for key in keys:
+            slot = key_hash_slot(key)
+            shard = self.shard_for_slot(slot)
+            if owner is None:
+                owner, first_slot = shard, slot
+            elif shard != owner:
+                return (-1, -1)
+        if owner is None or owner == self.index:
+            return None
+        return (owner, first_slot)
+
+
+def run_sharded(count: int, host: str, port: int, mode: str = 'proxy', config_dict: Optional[dict] = None) -> None:
+    """Fork one RedisServer per shard and wait for them, forwarding SIGINT/SIGTERM"""
+    from .server import RedisServer
+    from .persistence import PersistenceConfig
+
+    children = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            config = PersistenceConfig(config_dict)
+            config.set('aof_filename', f"appendonly-{index}.aof")
+            config.set('snapshot_filename', f"dump-{index}.rdb")
+            router = ShardRouter(index, count, mode, host, port, config.data_dir)
+            server = RedisServer(host, router.listen_port(index), config, shard=router)
+
+            def terminate(signum, frame):
+                raise KeyboardInterrupt
+
+            signal.signal(signal.SIGTERM, terminate)
+            try:
+                server.start()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.stop()
+                os._exit(0)
+        children.append(pid)
+    print(f"Started {count} shard workers ({mode} mode): {children}")
+
+    def shutdown(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    while children:
+        try:
+            pid, _ = os.wait()
+        except KeyboardInterrupt:
+            shutdown(signal.SIGINT, None)
+            continue
+        except ChildProcessError:
+            break
+        if pid in children:
+            children.remove(pid)
@@ -1,65 +1,366 @@
+import sys
 import time
+import heapq
 import random
 import fnmatch
+from bisect import bisect_left, insort
+from binascii import crc_hqx
+from .eviction import lru_clock, lfu_touch
+from .sharding import HASH_SLOTS, key_hash_slot
+
+ACTIVE_EXPIRE_KEYS_PER_LOOP = 20
+
+#SCAN visits at most COUNT times this many slots per call, so a MATCH that
+#hits nothing still returns to the client regularly
+SCAN_SLOTS_PER_COUNT = 100
+
+GLOB_SPECIAL = "*?[\\"
+
+#Approximate CPython costs that sys.getsizeof does not see: a dict entry
+#(hash, key and value pointers plus its index slot, at typical load) and
+#the slots in the sampling list and the slot index
+DICT_ENTRY_OVERHEAD = 32
+KEY_ENTRY_OVERHEAD = DICT_ENTRY_OVERHEAD + 16
+#_expires entry, its float and the (deadline, key) heap tuple
+EXPIRE_ENTRY_OVERHEAD = DICT_ENTRY_OVERHEAD + sys.getsizeof(0.0) + sys.getsizeof((0.0, "")) + 8
+ACCESS_ENTRY_OVERHEAD = DICT_ENTRY_OVERHEAD + sys.getsizeof(2 ** 40)
+
+def glob_prefix(pattern):
+    """Literal text a glob pattern starts with, every match shares it"""
+    for index, char in enumerate(pattern):
+        if char in GLOB_SPECIAL:
+            return pattern[:index]
+    return pattern
+
+def pattern_slot(prefix):
+    """Slot of a complete {hash tag} in a literal prefix, None without one"""
+    start = prefix.find("{")
+    if start == -1:
+        return None
+    end = prefix.find("}", start + 1)
+    if end == -1 or end == start + 1:
+        return None
+    return key_hash_slot(prefix[:end + 1])
+
 class DataStore:
     def __init__(self):
+       #key -> value, the type is derived from the value when asked for
        self._data = {}
+       #Volatile keys only: key -> absolute expiry time
+       self._expires = {}
+       #(expiry_time, key) ordered by deadline. Entries whose time no longer
+       #matches self._expires are stale and skipped when popped
+       self._expiry_heap = []
+       #Every key once, plus deleted keys not yet noticed. Gives O(1) random
+       #sampling for eviction, ghosts are dropped when they are sampled
+       self._sample_keys = []
+       #Sorted keys of every hash slot, None for empty slots. Gives SCAN a
+       #cursor that survives inserts and deletes, and lets KEYS and SCAN
+       #MATCH with a literal prefix bisect to the matching keys
+       self._slots = [None] * HASH_SLOTS
+       #key -> LRU clock or packed LFU counter, only kept for *-lru/*-lfu
+       self._access = {}
+       self._access_tracking = None
        self._memory_usage = 0
+       self.stats = {
+           "expired_keys" : 0,
+           #Smoothed estimate of volatile keys that are expired but not yet deleted
+           "expired_stale_perc" : 0.0,
+           "expired_time_cap_reached_count" : 0,
+           "expire_cycle_cpu_milliseconds" : 0.0,
+       }
     def set(self, key, value, expiry_time = None):
-       if key in  self._data:
-           old_value,_,_ = self._data[key]
-           self._memory_usage -= self._calculate_memory_usage(key,old_value)
-       data_type = self._get_type(value)
-       self._data[key] =(value, data_type, expiry_time)
-       self._memory_usage += self._calculate_memory_usage(key,value)
-        
-        
+       data = self._data
+       if key in  data:
+           self._memory_usage += self._value_size(value) - self._value_size(data[key])
+       else:
+           self._memory_usage += sys.getsizeof(key) + self._value_size(value) + KEY_ENTRY_OVERHEAD
+           self._sample_keys.append(key)
+           if len(self._sample_keys) > 2 * len(data) + 1024:
+               self._sample_keys = list(data)
+               self._sample_keys.append(key)
+           self._index_key(key)
+       data[key] = value
+       if self._access_tracking:
+           self._touch(key)
+       if expiry_time is None:
+           self._remove_expiry(key)
+       else:
+           self._set_expiry(key, expiry_time)
+
+
+    def update(self, key, value):
+        """Replace the value of an existing key, keeping its expiry"""
+        data = self._data
+        self._memory_usage += self._value_size(value) - self._value_size(data[key])
+        data[key] = value
+        if self._access_tracking:
+            self._touch(key)
+
+
     def  get(self, key):
          if not self._is_key_valid(key):
              return None
-         value, _, _ = self._data[key]
-         return value
+         if self._access_tracking:
+             self._touch(key)
+         return self._data[key]
     def  delete(self, *keys):
         count = 0
         for key in keys:
             if key in self._data:
-                value, _, _, = self._data[key]
-                self._memory_usage -= self._calculate_memory_usage(key, value)
-                del self._data[key]
+                self._delete_key(key)
                 count += 1
         return count
     def exists(self, *keys):
        return sum(1 for key in keys if self._is_key_valid(key))
     def keys(self, pattern ="*"):
-        valid_keys = [key for key in self._data if self._is_key_valid(key)]
+        now = time.time()
+        expires = self._expires
+        prefix = glob_prefix(pattern)
+        if prefix and (len(self._data) > HASH_SLOTS or pattern_slot(prefix) is not None):
+            #Only the keys sharing the prefix are visited
+            candidates = self._prefixed_keys(prefix, 0, HASH_SLOTS)[0]
+        else:
+            candidates = self._data
+        valid_keys = [key for key in candidates if key not in expires or expires[key] > now]
         if pattern == "*":
          return valid_keys
         return [key for key in valid_keys if  fnmatch.fnmatch(key,pattern) ]
-     
-    
+
+    def dbsize(self):
+        return len(self._data)
+
+    def load(self, items):
+        """
+        Insert (key, value, absolute expiry or None) triples in bulk
+
+        Used by loaders: keys new to the store skip the per-key bookkeeping
+        of set() and memory is accounted once for the batch. Slots that were
+        empty are filled in any order and sorted once at the end, keys for
+        other slots are inserted in order. A string overwriting a string is
+        replaced in place; later items win over earlier ones.
+        Returns the number of keys inserted
+        """
+        data = self._data
+        slots = self._slots
+        expires = self._expires
+        getsizeof = sys.getsizeof
+        slot_mask = HASH_SLOTS - 1
+        new_keys = []
+        new_slots = set()
+        memory = 0
+        for key, value, expiry_time in items:
+            old_value = data.get(key)
+            if old_value is not None:
+                if type(old_value) not in (str, int) or type(value) not in (str, int):
+                    self.set(key, value, expiry_time)
+                    continue
+                data[key] = value
+                memory += getsizeof(value) - getsizeof(old_value)
+                if expiry_time is not None:
+                    self._set_expiry(key, expiry_time)
+                elif key in expires:
+                    self._remove_expiry(key)
+                if self._access_tracking:
+                    self._touch(key)
+                continue
+            data[key] = value
+            new_keys.append(key)
+            memory += getsizeof(key) + KEY_ENTRY_OVERHEAD + (
+                getsizeof(value) if type(value) in (str, int) else value.memory_usage())
+            if "{" in key:
+                slot = key_hash_slot(key)
+            else:
+                slot = crc_hqx(key.encode('utf-8', 'surrogateescape'), 0) & slot_mask
+            entries = slots[slot]
+            if entries is None:
+                slots[slot] = [key]
+                new_slots.add(slot)
+            elif slot in new_slots:
+                entries.append(key)
+            else:
+                insort(entries, key)
+            if expiry_time is not None:
+                self._set_expiry(key, expiry_time)
+        for slot in new_slots:
+            slots[slot].sort()
+        self._memory_usage += memory
+        self._sample_keys.extend(new_keys)
+        if self._access_tracking:
+            for key in new_keys:
+                self._touch(key)
+        return len(new_keys)
+
+    def snapshot_items(self):
+        """(key, value, absolute expiry or None) of every live key, for snapshots"""
+        now = time.time()
+        expires = self._expires
+        for key, value in self._data.items():
+            expiry_time = expires.get(key)
+            if expiry_time is None or expiry_time > now:
+                yield key, value, expiry_time
+
+    def _index_key(self, key):
+        if "{" in key:
+            slot = key_hash_slot(key)
+        else:
+            #Same as key_hash_slot() without a hash tag, inlined for SET
+            slot = crc_hqx(key.encode('utf-8', 'surrogateescape'), 0) & (HASH_SLOTS - 1)
+        entries = self._slots[slot]
+        if entries is None:
+            self._slots[slot] = [key]
+        else:
+            insort(entries, key)
+
+    def _unindex_key(self, key):
+        slot = key_hash_slot(key)
+        entries = self._slots[slot]
+        del entries[bisect_left(entries, key)]
+        if not entries:
+            self._slots[slot] = None
+
+    def _prefixed_keys(self, prefix, first_slot, max_slots, count = None):
+        """
+        Keys starting with prefix, slot by slot from first_slot
+
+        Stops after max_slots slots or once count keys were collected.
+        Returns (keys, next slot)
+        """
+        slots = self._slots
+        tag_slot = pattern_slot(prefix)
+        if tag_slot is not None:
+            #Every matching key hashes to the slot of the hash tag
+            if first_slot > tag_slot:
+                return [], HASH_SLOTS
+            first_slot, max_slots = tag_slot, 1
+        found = []
+        slot = first_slot
+        last_slot = min(HASH_SLOTS, first_slot + max_slots)
+        while slot < last_slot:
+            entries = slots[slot]
+            slot += 1
+            if entries is None:
+                continue
+            if not prefix:
+                found.extend(entries)
+            else:
+                index = bisect_left(entries, prefix)
+                while index < len(entries) and entries[index].startswith(prefix):
+                    found.append(entries[index])
+                    index += 1
+            if count is not None and len(found) >= count:
+                break
+        return found, slot if tag_slot is None else HASH_SLOTS
+
+    def count_keys_in_slot(self, slot):
+        entries = self._slots[slot]
+        return len(entries) if entries else 0
+
+    def get_keys_in_slot(self, slot, count):
+        """Up to count keys of a hash slot, in key order"""
+        entries = self._slots[slot]
+        return entries[:count] if entries else []
+
+    def scan(self, cursor, count = 10, pattern = None, type_name = None):
+        """
+        One SCAN step: (next cursor, keys), the cursor is 0 when done
+
+        The cursor is a hash slot and every call returns whole slots, so a
+        key present from the first to the last call is returned at least
+        once whatever is inserted or deleted in between.
+        """
+        if not 0 <= cursor < HASH_SLOTS:
+            return 0, []
+        prefix = glob_prefix(pattern) if pattern else ""
+        candidates, next_slot = self._prefixed_keys(prefix, cursor, count * SCAN_SLOTS_PER_COUNT, count)
+        keys = []
+        for key in candidates:
+            if not self._is_key_valid(key):
+                continue
+            if pattern and not fnmatch.fnmatchcase(key, pattern):
+                continue
+            if type_name and self._get_type(self._data[key]) != type_name:
+                continue
+            keys.append(key)
+        return (next_slot if next_slot < HASH_SLOTS else 0), keys
+
+
     def flush(self):
         self._data.clear()
+        self._expires.clear()
+        self._expiry_heap = []
+        self._sample_keys = []
+        self._slots = [None] * HASH_SLOTS
+        self._access.clear()
         self._memory_usage = 0
     def expire(self, key, seconds):
-        if not self._is_key_valid(key):
-           return False
-        value, data_type, _ = self._data[key]
-        expiry_time = time.time() + seconds
-        self._data[key] =  (value,data_type,expiry_time)
-        return True
+        return self.expire_at(key, time.time() + seconds)
     def expire_at(self, key, timestamp):
         if not self._is_key_valid(key):
            return False
-        value, data_type, _ = self._data[key]
-        self._data[key] =  (value,data_type, timestamp)
+        if timestamp <= time.time():
+            #A deadline in the past deletes the key right away, like Redis
+            self._delete_key(key)
+            return True
+        self._set_expiry(key, timestamp)
         return True
-        
-    def _calculate_memory_usage(self,key, value):
-        key_size = len(str(key).encode('utf-8'))
-        value_size = len(str(value).encode('utf-8'))
-        return key_size + value_size + 64
+
+    def _set_expiry(self, key, timestamp):
+        if key not in self._expires:
+            self._memory_usage += EXPIRE_ENTRY_OVERHEAD
+        self._expires[key] = timestamp
+        heapq.heappush(self._expiry_heap, (timestamp, key))
+        #Keys whose TTL is changed often leave stale heap entries behind
+        if len(self._expiry_heap) > 2 * len(self._expires) + 1024:
+            self._expiry_heap = [(when, k) for k, when in self._expires.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _remove_expiry(self, key):
+        if self._expires.pop(key, None) is not None:
+            self._memory_usage -= EXPIRE_ENTRY_OVERHEAD
+            return True
+        return False
+
+    def _delete_key(self, key):
+        value = self._data.pop(key)
+        self._unindex_key(key)
+        self._remove_expiry(key)
+        if self._access.pop(key, None) is not None:
+            self._memory_usage -= ACCESS_ENTRY_OVERHEAD
+        self._memory_usage -= sys.getsizeof(key) + self._value_size(value) + KEY_ENTRY_OVERHEAD
+
+    def _value_size(self, value):
+        """
+        Bytes used by a value, never serialises it
+
+        Container types keep their own running total in memory_usage()
+        """
+        memory_usage = getattr(value, 'memory_usage', None)
+        if memory_usage is not None:
+            return memory_usage()
+        return sys.getsizeof(value)
+
+    def adjust_memory(self, delta):
+        """Account for a value that was changed in place"""
+        self._memory_usage += delta
+
+    def container_changed(self, key, size_before):
+        """
+        Account for a container value modified in place
+
+        Args:
+          size_before: memory_usage() of the value before the change
+        Empty containers are deleted, like Redis does
+        """
+        value = self._data[key]
+        self._memory_usage += value.memory_usage() - size_before
+        if not len(value):
+            self._delete_key(key)
 
     def _get_type(self,value):
+        type_name = getattr(value, 'type_name', None)
+        if type_name is not None:
+            return type_name
         if isinstance(value, str):
             return "string"
         elif isinstance(value, int):
@@ -72,69 +373,140 @@ class DataStore:
             return "hash"
         else:
             return "string"
-        
+
     def _is_key_valid(self, key):
         if key not in self._data:
             return False
-        value, _, expiration = self._data[key]
-       
+        expiration = self._expires.get(key)
+
         if expiration is not None and expiration <=  time.time():
-             self._memory_usage -= self._calculate_memory_usage(key,value)
-             del self._data[key]
+             self._delete_key(key)
+             self.stats["expired_keys"] += 1
              return False
         return True
     def ttl(self, key):
-        if not self._is_key_valid(key):
-          return -2
-        value, _, expiry__time = self._data[key]
-        if expiry__time == None:
-            return -1
-        remaining = expiry__time - time.time()
-        if remaining<= 0:
-            self._memory_usage -= self._calculate_memory_usage(key, value)
-            del self._data[key]
-            return -2
+        remaining = self._remaining(key)
+        if remaining < 0:
+            return remaining
         return int(remaining)
     def pttl(self, key):
+        remaining = self._remaining(key)
+        if remaining < 0:
+            return remaining
+        return int(remaining * 1000)
+    def _remaining(self, key):
+        """Seconds left before key expires, -2 if missing and -1 if persistent"""
         if not self._is_key_valid(key):
           return -2
-        value, _, expiry__time = self._data[key]
-        if expiry__time == None:
+        expiry_time = self._expires.get(key)
+        if expiry_time is None:
             return -1
-        remaining = expiry__time - time.time()
-        if remaining<= 0:
-            self._memory_usage -= self._calculate_memory_usage(key, value)
-            del self._data[key]
-            return -2
-        return int(remaining * 1000)
+        return max(0.0, expiry_time - time.time())
     def persist(self, key):
         if not self._is_key_valid(key):
             return False
-        value, data_type, _ = self._data[key]
-        self._data[key] = (value,data_type, None)
-        return True
+        return self._remove_expiry(key)
     def get_key_data_type(self, key):
          if not self._is_key_valid(key):
             return "none"
-         _, data_type, _ = self._data[key]
-         return data_type
+         return self._get_type(self._data[key])
+    def set_access_tracking(self, mode):
+        """Start keeping 'lru' clocks or 'lfu' counters per key, None to stop"""
+        if mode != self._access_tracking:
+            self._memory_usage -= len(self._access) * ACCESS_ENTRY_OVERHEAD
+            self._access.clear()
+        self._access_tracking = mode
+    def _touch(self, key):
+        access = self._access
+        if key not in access:
+            self._memory_usage += ACCESS_ENTRY_OVERHEAD
+        if self._access_tracking == 'lfu':
+            access[key] = lfu_touch(access.get(key))
+        else:
+            access[key] = lru_clock()
+    def get_access(self, key):
+        return self._access.get(key)
+    def get_expiry_time(self, key):
+        return self._expires.get(key)
+    def sample_keys(self, count, volatile = False):
+        """
+        Pick up to count random live keys without copying the keyspace
+
+        Args:
+          volatile: sample only keys that have an expiry
+        """
+        if volatile:
+            pool, index_key = self._expiry_heap, lambda entry: entry[1]
+        else:
+            pool, index_key = self._sample_keys, lambda key: key
+        found = []
+        attempts = count * 4
+        while pool and len(found) < count and attempts:
+            attempts -= 1
+            index = random.randrange(len(pool))
+            key = index_key(pool[index])
+            if key in self._data and (not volatile or key in self._expires):
+                found.append(key)
+            elif not volatile:
+                #Swap-remove the ghost of a deleted key
+                pool[index] = pool[-1]
+                pool.pop()
+        return found
     def get_memory_usage(self):
          return self._memory_usage
-    def cleanup_expired_keys(self):
-        if not self._data:
-            return False
+    def expires_count(self):
+        return len(self._expires)
+    def active_expire_cycle(self, time_limit):
+        """
+        Delete expired keys for at most time_limit seconds
+
+        Keys are taken from the head of the expiry heap in batches of
+        ACTIVE_EXPIRE_KEYS_PER_LOOP, so only expired keys are visited. When
+        the time budget runs out before the heap head is in the future, a
+        random sample of the volatile index estimates how much of it is
+        stale; the caller uses that to schedule extra fast cycles.
+
+        Returns the number of keys deleted
+        """
+        start = time.perf_counter()
+        deadline = start + time_limit
+        heap = self._expiry_heap
         expired_keys_number = 0
-        sample_size = min(20,len(self._data))
-        sample_keys = random.sample(list(self._data.keys()),sample_size)
-        
-        for key in sample_keys:
-            value,_, expiry_time = self._data[key]
-            if expiry_time is not None and expiry_time <= time.time():
-                self._memory_usage -= self._calculate_memory_usage(key,value)
-                expired_keys_number += 1
-                del self._data[key]
+        timed_out = False
+        while heap:
+            now = time.time()
+            batch_expired = 0
+            for _ in range(ACTIVE_EXPIRE_KEYS_PER_LOOP):
+                if not heap or heap[0][0] > now:
+                    break
+                expiry_time, key = heapq.heappop(heap)
+                if self._expires.get(key) != expiry_time:
+                    #Stale entry: key was deleted, persisted or given a new TTL
+                    continue
+                self._delete_key(key)
+                batch_expired += 1
+            expired_keys_number += batch_expired
+            if not heap or heap[0][0] > now:
+                break
+            if time.perf_counter() >= deadline:
+                timed_out = True
+                break
+
+        if timed_out:
+            self.stats["expired_time_cap_reached_count"] += 1
+            current_perc = self._sample_stale_fraction(time.time())
+        else:
+            current_perc = 0.0
+        self.stats["expired_keys"] += expired_keys_number
+        self.stats["expired_stale_perc"] = current_perc * 0.05 + self.stats["expired_stale_perc"] * 0.95
+        self.stats["expire_cycle_cpu_milliseconds"] += (time.perf_counter() - start) * 1000
         return expired_keys_number
-        
-            
-     
-        
\ No newline at end of file
+
+    def _sample_stale_fraction(self, now):
+        """Fraction of a random sample of volatile keys whose deadline has passed"""
+        heap = self._expiry_heap
+        if not heap:
+            return 0.0
+        sample_size = min(ACTIVE_EXPIRE_KEYS_PER_LOOP, len(heap))
+        expired = sum(1 for index in random.sample(range(len(heap)), sample_size) if heap[index][0] <= now)
+        return expired / sample_size
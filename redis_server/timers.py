@@ -0,0 +1,66 @@
+"""
+Timer queue for the event loop
+
+Timers are kept in a heap ordered by deadline, so the loop can sleep
+exactly until the next one is due instead of polling every callback
+after each wakeup.
+"""
+import heapq
+import itertools
+import time
+from typing import Callable, Optional
+
+
+class TimerQueue:
+
+    def __init__(self):
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._cancelled = set()
+
+    def add(self, delay: float, callback: Callable[[], None], interval: Optional[float] = None) -> int:
+        """
+        Schedule callback after delay seconds
+
+        Args:
+          interval: when given the timer is re-armed with this period
+        Returns the timer id, usable with cancel()
+        """
+        timer_id = next(self._ids)
+        heapq.heappush(self._heap, (time.monotonic() + delay, timer_id, callback, interval))
+        return timer_id
+
+    def add_periodic(self, interval: float, callback: Callable[[], None]) -> int:
+        return self.add(interval, callback, interval)
+
+    def cancel(self, timer_id: int) -> None:
+        self._cancelled.add(timer_id)
+
+    def time_until_next(self, default: Optional[float] = None) -> Optional[float]:
+        """Seconds until the earliest timer is due, default if none is scheduled"""
+        while self._heap and self._heap[0][1] in self._cancelled:
+            _, timer_id, _, _ = heapq.heappop(self._heap)
+            self._cancelled.discard(timer_id)
+        if not self._heap:
+            return default
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def run_due(self) -> int:
+        """Run every timer whose deadline has passed, returns how many ran"""
+        now = time.monotonic()
+        ran = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, timer_id, callback, interval = heapq.heappop(self._heap)
+            if timer_id in self._cancelled:
+                self._cancelled.discard(timer_id)
+                continue
+            if interval is not None:
+                #Re-arm from the old deadline so periodic timers do not drift
+                next_deadline = max(deadline + interval, now)
+                heapq.heappush(self._heap, (next_deadline, timer_id, callback, interval))
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in timer callback: {e}")
+            ran += 1
+        return ran